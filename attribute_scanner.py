@@ -0,0 +1,188 @@
+import json
+import re
+from ndjson_export import open_ndjson
+
+try:
+    import ahocorasick
+except ImportError:
+    # The ids are then matched with one regular expression compiled from a trie of the ids
+    ahocorasick = None
+
+
+# Characters that can't be next to an id that is matched, so that an id is not found inside a longer one
+ID_CHARACTER = re.compile(r"[\w-]")
+
+
+def trie_pattern(patterns):
+    """
+    Regular expression matching any of the patterns, built from a trie of the patterns so that the regex engine
+    follows the trie instead of trying each pattern in turn at each position. Longer patterns are preferred.
+    """
+    trie = {}
+    for pattern in patterns:
+        node = trie
+        for character in pattern:
+            node = node.setdefault(character, {})
+        node[""] = {}
+
+    def build(node):
+        branches = [re.escape(character) + build(child) for character, child in sorted(node.items()) if character]
+        if not branches:
+            return ""
+        expression = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+        if "" in node:
+            # The pattern may end here, but a longer one is tried first
+            return f"(?:{expression})?"
+        return expression
+
+    return build(trie)
+
+
+class MultiPatternMatcher:
+    """
+    Finds any of a set of ids (e.g. data view ids) in a text in a single pass, whatever the number of ids.
+
+    With the 'pyahocorasick' module the ids are matched with an Aho-Corasick automaton. Without it they are
+    matched with one regular expression compiled from a trie of the ids. Either way the text is scanned once in C.
+    Only whole ids are matched: an id followed or preceded by a letter, digit, '_' or '-' is not a match.
+
+    Args:
+        patterns (iterable): The ids to find.
+    """
+    def __init__(self, patterns):
+        self.patterns = sorted(set(patterns))
+        self._automaton = None
+        self._regex = None
+        if not self.patterns:
+            return
+        if ahocorasick is not None:
+            self._automaton = ahocorasick.Automaton()
+            for pattern in self.patterns:
+                self._automaton.add_word(pattern, pattern)
+            self._automaton.make_automaton()
+        else:
+            self._regex = re.compile(rf"(?<![\w-])(?:{trie_pattern(self.patterns)})(?![\w-])")
+
+    # (start, end, id) of each match, left to right, without overlaps
+    def _matches(self, text):
+        if self._automaton is not None:
+            for end, pattern in self._automaton.iter_long(text):
+                start = end - len(pattern) + 1
+                if not (start > 0 and ID_CHARACTER.match(text, start - 1)) and not ID_CHARACTER.match(text, end + 1):
+                    yield start, end + 1, pattern
+        elif self._regex is not None:
+            for match in self._regex.finditer(text):
+                yield match.start(), match.end(), match.group()
+
+    def search(self, text):
+        """True if any of the ids is in the text."""
+        return next(self._matches(text), None) is not None
+
+    def find(self, text):
+        """Set of the ids found in the text."""
+        return {pattern for start, end, pattern in self._matches(text)}
+
+    def replace(self, text, mapping):
+        """Replace each id of mapping found in the text by its value in mapping."""
+        pieces = []
+        position = 0
+        for start, end, pattern in self._matches(text):
+            if pattern in mapping:
+                pieces += [text[position:start], mapping[pattern]]
+                position = end
+        if not pieces:
+            return text
+        pieces.append(text[position:])
+        return "".join(pieces)
+
+
+class AttributeScan:
+    """
+    Data view ids embedded in the attributes of saved objects, e.g. in searchSourceJSON, panelsJSON, layerListJSON
+    or the ad-hoc data views of Lens and Discover, rather than in the references array.
+
+    Objects are scanned one at a time (scan_object, or scan_line for the lines of an NDJSON export) with a
+    MultiPatternMatcher of all the ids at once. Only the objects with a hit are kept: their metadata, references
+    and the top-level attributes holding an id, so that those attributes can be rewritten with rewrite().
+
+    Args:
+        data_view_ids (iterable): The data view ids to look for.
+    """
+    def __init__(self, data_view_ids):
+        self.data_view_ids = set(data_view_ids)
+        self.matcher = MultiPatternMatcher(self.data_view_ids)
+        self.scanned_count = 0
+        # (type, id) -> {"object": metadata and references, "attributes": {key: value}, "ids": {key: ids found}}
+        self.hits = {}
+
+    def scan_object(self, object):
+        self.scanned_count += 1
+        # The data views being looked for don't embed themselves
+        if object["type"] == "index-pattern" and object["id"] in self.data_view_ids:
+            return
+        attributes = object.get("attributes") or {}
+        if not attributes or not self.matcher.search(json.dumps(attributes)):
+            return
+        hit = {"object": {key: object[key] for key in ("type", "id", "version", "namespaces", "references") if key in object},
+               "attributes": {}, "ids": {}}
+        for key, value in attributes.items():
+            found = self.matcher.find(json.dumps(value))
+            if found:
+                hit["attributes"][key] = value
+                hit["ids"][key] = found
+        self.hits[(object["type"], object["id"])] = hit
+
+    # Scan one line of an NDJSON export. Only the lines holding an id are decoded.
+    def scan_line(self, line):
+        if not self.matcher.search(line):
+            self.scanned_count += 1
+            return
+        object = json.loads(line)
+        if "exportedCount" not in object:
+            self.scan_object(object)
+
+    # Scan every object of an NDJSON export file, plain, gzip or zstd compressed
+    def scan_file(self, file_name):
+        with open_ndjson(file_name) as file:
+            for line in file:
+                if line.strip():
+                    self.scan_line(line)
+        return self
+
+    # (type, id) of the objects embedding the data view id in their attributes
+    def objects_with(self, data_view_id):
+        return [key for key, hit in self.hits.items() if any(data_view_id in ids for ids in hit["ids"].values())]
+
+    def get_object(self, object_type, object_id):
+        hit = self.hits.get((object_type, object_id))
+        return hit["object"] if hit else None
+
+    # Number of top-level attributes, over all objects, embedding the data view id
+    def count(self, data_view_id):
+        return sum(data_view_id in ids for hit in self.hits.values() for ids in hit["ids"].values())
+
+    def rewrite(self, object_type, object_id, id_mapping):
+        """
+        Rewrite the attributes of an object according to an old id -> new id mapping.
+
+        Returns:
+            tuple: (changes, new_attributes), where changes is a list of ('attributes.<key>', old id, new id) and
+                new_attributes holds the rewritten top-level attributes only, as accepted by _bulk_update.
+        """
+        hit = self.hits.get((object_type, object_id))
+        if hit is None:
+            return [], {}
+        changes = []
+        new_attributes = {}
+        for key, ids in hit["ids"].items():
+            replaced_ids = sorted(id for id in ids if id in id_mapping)
+            if not replaced_ids:
+                continue
+            new_attributes[key] = json.loads(self.matcher.replace(json.dumps(hit["attributes"][key]), id_mapping))
+            changes += [(f"attributes.{key}", id, id_mapping[id]) for id in replaced_ids]
+        return changes, new_attributes
+
+    # Data view ids still embedded in objects other than the given (type, id), e.g. the objects that were rewritten
+    def remaining_ids(self, rewritten_objects=()):
+        rewritten_objects = set(rewritten_objects)
+        return {id for key, hit in self.hits.items() if key not in rewritten_objects for ids in hit["ids"].values() for id in ids}
@@ -0,0 +1,397 @@
+"""
+Local stand-in for the Kibana (and GitHub) APIs used by the scripts, serving a synthetic space.
+
+Serves the saved objects _find, _export, _bulk_update and PUT endpoints, the data views and spaces APIs, the
+data view DELETE, and the git data API calls of the GitHub publisher. Every request is counted, with the bytes
+received and sent, per endpoint. Run it on its own, or let run_benchmarks.py start it:
+
+    python3 benchmarks/mock_kibana.py --objects 100000 --duplicated_titles 20 --port 5601
+
+With --throttle_rate, that share of the Kibana requests is answered with a 429 and a Retry-After header, like a
+busy Kibana, to exercise the retries of the scripts.
+
+Control endpoints:
+    GET  /_mock/stats        Request and byte counts since the last reset.
+    POST /_mock/reset_stats  Zero the counts.
+    POST /_mock/reset        Generate the space again (undoing the changes of a cleanup) and zero the counts.
+"""
+import json
+import os
+import random
+import re
+import sys
+import threading
+from argparse import ArgumentParser
+from collections import defaultdict
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from kibana_saved_objects import OBJECT_TYPES, MAX_RESULT_WINDOW  # noqa: E402
+
+
+# Kibana's default savedObjects.maxImportExportSize
+DEFAULT_MAX_EXPORT_SIZE = 10000
+
+
+class SyntheticSpace:
+    """
+    A generated Kibana space: data views (some of them sharing a title) and saved objects referencing them.
+
+    Args:
+        objects (int): Total number of saved objects, data views included.
+        data_views (int): Number of distinct data view titles.
+        duplicated_titles (int): Number of titles that have more than one data view.
+        copies (int): Number of data views of each duplicated title.
+        types (int): Number of saved object types the other objects are spread over.
+        references (int): Number of data view references of each object.
+        seed (int): Seed of the generator, so that a space can be generated again identically.
+    """
+    def __init__(self, objects=10000, data_views=50, duplicated_titles=10, copies=3, types=10, references=2, seed=42):
+        self.settings = dict(objects=objects, data_views=data_views, duplicated_titles=duplicated_titles, copies=copies,
+                             types=types, references=references, seed=seed)
+        self.generate()
+
+    def generate(self):
+        settings = self.settings
+        generator = random.Random(settings["seed"])
+        start = datetime(2024, 1, 1)
+        self.objects = {}
+        self.by_type = defaultdict(list)
+        self.by_reference = defaultdict(list)
+
+        data_view_ids = []
+        for title_number in range(settings["data_views"]):
+            copies = settings["copies"] if title_number < settings["duplicated_titles"] else 1
+            for copy in range(copies):
+                data_view_ids.append(f"dv-{title_number}-{copy}")
+                self._add({"type": "index-pattern", "id": data_view_ids[-1],
+                           "attributes": {"title": f"logs-{title_number}-*", "timeFieldName": "@timestamp"},
+                           "references": []})
+
+        object_types = [object_type for object_type in OBJECT_TYPES if object_type != "index-pattern"][:settings["types"]]
+        for number in range(max(settings["objects"] - len(data_view_ids), 0)):
+            object_type = object_types[number % len(object_types)]
+            referenced_ids = generator.sample(data_view_ids, min(settings["references"], len(data_view_ids)))
+            search_source = {"query": {"query": "", "language": "kuery"}, "index": referenced_ids[0] if referenced_ids else None}
+            self._add({
+                "type": object_type,
+                "id": f"{object_type}-{number}",
+                "attributes": {
+                    "title": f"{object_type} {number}",
+                    "description": "Synthetic object " * 4,
+                    "kibanaSavedObjectMeta": {"searchSourceJSON": json.dumps(search_source)}
+                },
+                "references": [{"type": "index-pattern", "id": referenced_id, "name": f"indexpattern-{position}"}
+                               for position, referenced_id in enumerate(referenced_ids)],
+                "updated_at": (start + timedelta(seconds=number)).isoformat() + "Z"
+            })
+
+    def _add(self, object):
+        object.setdefault("version", "WzEsMV0=")
+        object.setdefault("updated_at", "2024-01-01T00:00:00Z")
+        object["namespaces"] = ["default"]
+        key = (object["type"], object["id"])
+        self.objects[key] = object
+        self.by_type[object["type"]].append(key)
+        for ref in object["references"]:
+            self.by_reference[(ref["type"], ref["id"])].append(key)
+
+    # Like Kibana's partial updates, the top-level attributes sent replace those of the object and the others are kept
+    def update_references(self, object_type, object_id, references, attributes=None):
+        object = self.objects.get((object_type, object_id))
+        if object is None:
+            return None
+        object["attributes"] = dict(object["attributes"], **(attributes or {}))
+        for ref in object["references"]:
+            self.by_reference[(ref["type"], ref["id"])].remove((object_type, object_id))
+        object["references"] = references
+        for ref in references:
+            self.by_reference[(ref["type"], ref["id"])].append((object_type, object_id))
+        object["updated_at"] = datetime.utcnow().isoformat() + "Z"
+        return object
+
+    def delete(self, object_type, object_id):
+        object = self.objects.pop((object_type, object_id), None)
+        if object is not None:
+            self.by_type[object_type].remove((object_type, object_id))
+        return object
+
+    # Keys of the objects of the given types, optionally only those referencing any of the given objects
+    def find(self, object_types, has_reference=None):
+        if has_reference is None:
+            return [key for object_type in object_types for key in self.by_type.get(object_type, [])]
+        object_types = set(object_types)
+        keys = dict.fromkeys(key for ref in has_reference for key in self.by_reference.get((ref["type"], ref["id"]), [])
+                             if key[0] in object_types and key in self.objects)
+        return list(keys)
+
+    # Keys of the given objects and, with deep, of every object they reference
+    def closure(self, keys, deep):
+        found = dict.fromkeys(key for key in keys if key in self.objects)
+        pending = list(found)
+        while deep and pending:
+            object = self.objects[pending.pop()]
+            for ref in object["references"]:
+                key = (ref["type"], ref["id"])
+                if key in self.objects and key not in found:
+                    found[key] = None
+                    pending.append(key)
+        return list(found)
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, space, spaces=1, max_export_size=DEFAULT_MAX_EXPORT_SIZE, throttle_rate=0.0):
+        super().__init__(address, MockHandler)
+        self.space = space
+        self.space_ids = ["default"] + [f"space-{number}" for number in range(1, spaces)]
+        self.max_export_size = max_export_size
+        self.throttle_rate = throttle_rate
+        self.throttle_generator = random.Random(0)
+        self.lock = threading.Lock()
+        self.github = {"refs": {"heads/main": "commit-0"}, "objects": 0}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = defaultdict(lambda: {"requests": 0, "bytes_received": 0, "bytes_sent": 0})
+
+    def record(self, endpoint, bytes_received, bytes_sent):
+        with self.lock:
+            stats = self.stats[endpoint]
+            stats["requests"] += 1
+            stats["bytes_received"] += bytes_received
+            stats["bytes_sent"] += bytes_sent
+
+    def stats_report(self):
+        with self.lock:
+            endpoints = {endpoint: dict(stats) for endpoint, stats in sorted(self.stats.items())}
+        return {
+            "requests": sum(stats["requests"] for stats in endpoints.values()),
+            "bytes_received": sum(stats["bytes_received"] for stats in endpoints.values()),
+            "bytes_sent": sum(stats["bytes_sent"] for stats in endpoints.values()),
+            "endpoints": endpoints
+        }
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b"".join(chunks)
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def _send(self, status, body, content_type="application/json", headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return len(body)
+
+    def _handle(self, method):
+        body = self._read_body() if method in ("POST", "PUT", "PATCH") else b""
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        path = re.sub(r"^/s/[^/]+", "", parts.path)
+        if parts.path.startswith("/_mock/"):
+            # Control calls are not counted
+            return self._control(method, parts.path)
+        if path.startswith("/api/") and self._throttled():
+            bytes_sent = self._send(429, {"statusCode": 429, "error": "Too Many Requests"}, headers={"Retry-After": "0"})
+            self.server.record(f"{method} 429", len(body) + len(self.path), bytes_sent)
+            return
+        endpoint, status, response, content_type = self._route(method, path, query, body)
+        bytes_sent = self._send(status, response, content_type)
+        self.server.record(f"{method} {endpoint}", len(body) + len(self.path), bytes_sent)
+
+    def _throttled(self):
+        with self.server.lock:
+            return self.server.throttle_generator.random() < self.server.throttle_rate
+
+    def _control(self, method, path):
+        if path == "/_mock/stats":
+            return self._send(200, self.server.stats_report())
+        if path == "/_mock/reset_stats" and method == "POST":
+            self.server.reset_stats()
+            return self._send(200, {})
+        if path == "/_mock/reset" and method == "POST":
+            with self.server.lock:
+                self.server.space.generate()
+            self.server.reset_stats()
+            return self._send(200, {})
+        return self._send(404, {})
+
+    def _route(self, method, path, query, body):
+        space = self.server.space
+        json_type = "application/json"
+        if path.startswith("/repos/"):
+            return self._github(method, path, body)
+        if method == "GET" and path == "/api/spaces/space":
+            return "spaces", 200, [{"id": space_id, "name": space_id} for space_id in self.server.space_ids], json_type
+        if method == "GET" and path == "/api/data_views":
+            data_views = [{"id": object["id"], "title": object["attributes"]["title"]}
+                          for object in (space.objects[key] for key in space.by_type.get("index-pattern", []))]
+            return "data_views", 200, {"data_view": data_views}, json_type
+        if method == "GET" and path == "/api/saved_objects/_find":
+            return "_find", *self._find(query), json_type
+        if method == "POST" and path == "/api/saved_objects/_export":
+            status, response = self._export(json.loads(body or b"{}"))
+            return "_export", status, response, "application/ndjson"
+        if method == "PUT" and path == "/api/saved_objects/_bulk_update":
+            saved_objects = []
+            with self.server.lock:
+                for update in json.loads(body):
+                    object = space.update_references(update["type"], update["id"], update.get("references", []), update.get("attributes"))
+                    if object is None:
+                        saved_objects.append({"type": update["type"], "id": update["id"],
+                                              "error": {"statusCode": 404, "message": "Saved object not found"}})
+                    else:
+                        saved_objects.append({"type": object["type"], "id": object["id"], "version": object["version"],
+                                              "references": object["references"]})
+            return "_bulk_update", 200, {"saved_objects": saved_objects}, json_type
+        match = re.match(r"^/api/saved_objects/([^/_][^/]*)/([^/]+)$", path)
+        if method == "PUT" and match:
+            update = json.loads(body or b"{}")
+            with self.server.lock:
+                object = space.update_references(match.group(1), match.group(2), update.get("references", []), update.get("attributes"))
+            if object is None:
+                return "saved_object", 404, {"message": "Saved object not found"}, json_type
+            return "saved_object", 200, object, json_type
+        match = re.match(r"^/api/data_views/data_view/([^/]+)$", path)
+        if method == "DELETE" and match:
+            with self.server.lock:
+                object = space.delete("index-pattern", match.group(1))
+            return "data_view", (200 if object else 404), {}, json_type
+        return "unknown", 404, {"message": f"Not found: {method} {path}"}, json_type
+
+    def _find(self, query):
+        space = self.server.space
+        page = int(query.get("page", ["1"])[0])
+        per_page = int(query.get("per_page", ["20"])[0])
+        if page * per_page > MAX_RESULT_WINDOW:
+            return 400, {"statusCode": 400, "message": f"Result window is too large, page * per_page must be <= {MAX_RESULT_WINDOW}"}
+        has_reference = None
+        if "has_reference" in query:
+            has_reference = json.loads(query["has_reference"][0])
+            if isinstance(has_reference, dict):
+                has_reference = [has_reference]
+        with self.server.lock:
+            keys = space.find(query.get("type", []), has_reference)
+            objects = [space.objects[key] for key in keys]
+        if "filter" in query:
+            match = re.search(r'updated_at >= "([^"]+)"', query["filter"][0])
+            if match:
+                objects = [object for object in objects if object["updated_at"] >= match.group(1)]
+        if "sort_field" in query:
+            objects = sorted(objects, key=lambda object: object.get(query["sort_field"][0], ""),
+                             reverse=query.get("sort_order", ["asc"])[0] == "desc")
+        fields = query.get("fields")
+        page_objects = []
+        for object in objects[(page - 1) * per_page:page * per_page]:
+            if fields is not None:
+                object = dict(object, attributes={field: object["attributes"][field] for field in fields if field in object["attributes"]})
+            page_objects.append(object)
+        return 200, {"page": page, "per_page": per_page, "total": len(objects), "saved_objects": page_objects}
+
+    def _export(self, payload):
+        space = self.server.space
+        with self.server.lock:
+            if payload.get("objects"):
+                keys = space.closure([(object["type"], object["id"]) for object in payload["objects"]],
+                                     payload.get("includeReferencesDeep", False))
+            else:
+                object_types = payload.get("type") or []
+                keys = space.find([object_types] if isinstance(object_types, str) else object_types)
+            if len(keys) > self.server.max_export_size:
+                return 400, json.dumps({"statusCode": 400, "message": f"Can't export more than {self.server.max_export_size} objects"}).encode()
+            lines = [json.dumps(space.objects[key]) for key in keys]
+        lines.append(json.dumps({"excludedObjects": [], "excludedObjectsCount": 0, "exportedCount": len(keys),
+                                 "missingRefCount": 0, "missingReferences": []}))
+        return 200, ("\n".join(lines) + "\n").encode("utf-8")
+
+    # Just enough of the git data API for GitHubArtifactPublisher
+    def _github(self, method, path, body):
+        github = self.server.github
+        json_type = "application/json"
+        path = re.sub(r"^/repos/[^/]+/[^/]+", "", path)
+        with self.server.lock:
+            if method == "GET" and path == "":
+                return "github", 200, {"default_branch": "main"}, json_type
+            match = re.match(r"^/git/refs?/(heads/.+)$", path)
+            if method == "GET" and match:
+                sha = github["refs"].get(match.group(1))
+                return "github", (200 if sha else 404), {"object": {"sha": sha}} if sha else {}, json_type
+            if method == "PATCH" and match:
+                github["refs"][match.group(1)] = json.loads(body)["sha"]
+                return "github", 200, {}, json_type
+            if method == "GET" and path.startswith("/git/commits/"):
+                return "github", 200, {"tree": {"sha": "tree-0"}}, json_type
+            if method == "POST" and path in ("/git/blobs", "/git/trees", "/git/commits"):
+                github["objects"] += 1
+                return "github", 201, {"sha": f"{path.rsplit('/', 1)[1]}-{github['objects']}"}, json_type
+            if method == "POST" and path == "/git/refs":
+                ref = json.loads(body)
+                github["refs"][ref["ref"][len("refs/"):]] = ref["sha"]
+                return "github", 201, {}, json_type
+        return "github", 404, {}, json_type
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_PATCH(self):
+        self._handle("PATCH")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+
+def add_space_arguments(parser):
+    parser.add_argument('--objects', type=int, default=10000, required=False)
+    parser.add_argument('--data_views', type=int, default=50, required=False)
+    parser.add_argument('--duplicated_titles', type=int, default=10, required=False)
+    parser.add_argument('--copies', type=int, default=3, required=False)
+    parser.add_argument('--types', type=int, default=10, required=False)
+    parser.add_argument('--references', type=int, default=2, required=False)
+    parser.add_argument('--seed', type=int, default=42, required=False)
+    parser.add_argument('--spaces', type=int, default=1, required=False)
+    parser.add_argument('--max_export_size', type=int, default=DEFAULT_MAX_EXPORT_SIZE, required=False)
+    parser.add_argument('--throttle_rate', type=float, default=0.0, required=False,
+                        help='Share of the Kibana requests answered with a 429 Too Many Requests')
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Serve a synthetic Kibana space for benchmarks')
+    parser.add_argument('--port', type=int, default=0, required=False)
+    add_space_arguments(parser)
+    args = parser.parse_args()
+
+    space = SyntheticSpace(args.objects, args.data_views, args.duplicated_titles, args.copies, args.types, args.references, args.seed)
+    server = MockServer(("127.0.0.1", args.port), space, args.spaces, args.max_export_size, args.throttle_rate)
+    # The first line tells the benchmark harness where to connect
+    print(f"Listening on http://127.0.0.1:{server.server_address[1]}", flush=True)
+    server.serve_forever()
@@ -0,0 +1,185 @@
+"""
+Benchmark the scripts against the local mock Kibana (mock_kibana.py) at one or several space sizes.
+
+For each size a mock server is started in a separate process with a synthetic space, and each scenario is run
+in this process against it. Every scenario records its wall time, the number of requests and bytes the mock
+received and sent (per endpoint as well) and the peak Python memory allocated by the scenario (tracemalloc).
+
+    python3 benchmarks/run_benchmarks.py --sizes 10000,100000 --output benchmark_results.json
+    python3 benchmarks/run_benchmarks.py --sizes 10000 --baseline benchmark_results.json
+
+With --baseline the results are compared with an earlier results file, and the scenarios that got slower,
+chattier or hungrier by more than --tolerance are reported.
+"""
+import builtins
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+import cleanup_duplicate_dataviews  # noqa: E402
+import find_duplicate_dataviews  # noqa: E402
+import get_spaces  # noqa: E402
+import github_publisher  # noqa: E402
+from http_client import get_http_client, get_headers, configure_http_client  # noqa: E402
+from mock_kibana import add_space_arguments  # noqa: E402
+from structured_logging import shutdown_logging  # noqa: E402
+
+
+SCENARIOS = ["list_spaces", "find", "cleanup_dry_run", "cleanup_apply"]
+
+# Metrics compared with the baseline
+COMPARED_METRICS = ["wall_time", "requests", "bytes_sent", "peak_memory"]
+
+
+def start_mock_server(size, args):
+    command = [sys.executable, os.path.join(BENCHMARKS_DIR, "mock_kibana.py"), "--objects", str(size),
+               "--data_views", str(args.data_views), "--duplicated_titles", str(args.duplicated_titles),
+               "--copies", str(args.copies), "--types", str(args.types), "--references", str(args.references),
+               "--seed", str(args.seed), "--spaces", str(args.spaces), "--max_export_size", str(args.max_export_size),
+               "--throttle_rate", str(args.throttle_rate)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    url = process.stdout.readline().strip().rsplit(" ", 1)[-1]
+    if not url.startswith("http"):
+        process.kill()
+        raise Exception(f"The mock Kibana server didn't start: {url}")
+    return process, url
+
+
+def mock_control(url, action):
+    response = get_http_client().request("GET" if action == "stats" else "POST", f"{url}/_mock/{action}")
+    response.raise_for_status()
+    return response.json()
+
+
+# Set the module globals the scripts expect from their command line
+def configure_scripts(url):
+    for module in (cleanup_duplicate_dataviews, find_duplicate_dataviews):
+        module.cluster_name = "benchmark"
+    cleanup_duplicate_dataviews.timestamp = "benchmark"
+    cleanup_duplicate_dataviews.repo_url = "https://github.com/benchmark/cleanup_duplicate_dataviews"
+    cleanup_duplicate_dataviews.github_username = "benchmark"
+    cleanup_duplicate_dataviews.github_key = "benchmark"
+    cleanup_duplicate_dataviews.github_branch = "benchmark"
+    github_publisher.GITHUB_API_URL = url
+    # The interactive cleanup asks before each delete: every delete is confirmed
+    builtins.input = lambda prompt="": "Y"
+
+
+def run_scenario(scenario, url, args):
+    headers = get_headers("benchmark")
+    if scenario == "list_spaces":
+        return get_spaces.list_kibana_space_ids(headers, url)
+    if scenario == "find":
+        return find_duplicate_dataviews.main(url, headers, "default", args.page_size, args.concurrency)
+    if scenario in ("cleanup_dry_run", "cleanup_apply"):
+        return cleanup_duplicate_dataviews.main(url, headers, "default", scenario == "cleanup_dry_run", args.page_size,
+                                                args.concurrency, args.bulk_size)
+    raise ValueError(f"Unknown scenario: {scenario}")
+
+
+# Run one scenario and measure it. The scripts set up logging to their log file, which is shut down afterwards.
+def measure_scenario(scenario, url, args):
+    mock_control(url, "reset")
+    root_handlers = list(logging.getLogger().handlers)
+    tracemalloc.start()
+    start = time.perf_counter()
+    error = None
+    try:
+        run_scenario(scenario, url, args)
+    except (Exception, SystemExit) as e:
+        error = repr(e)
+    wall_time = time.perf_counter() - start
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    shutdown_logging()
+    for handler in logging.getLogger().handlers:
+        if handler not in root_handlers:
+            logging.getLogger().removeHandler(handler)
+            handler.close()
+    stats = mock_control(url, "stats")
+    return {
+        "scenario": scenario,
+        "error": error,
+        "wall_time": round(wall_time, 3),
+        "requests": stats["requests"],
+        "bytes_received": stats["bytes_received"],
+        "bytes_sent": stats["bytes_sent"],
+        "peak_memory": peak_memory,
+        "endpoints": stats["endpoints"]
+    }
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    baseline_results = {(result["size"], result["scenario"]): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        previous = baseline_results.get((result["size"], result["scenario"]))
+        if previous is None:
+            continue
+        for metric in COMPARED_METRICS:
+            if previous[metric] and result[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(f"{result['scenario']} at {result['size']} objects: {metric} went from "
+                                   f"{previous[metric]} to {result[metric]}")
+    return regressions
+
+
+def print_results(results):
+    print(f"{'size':>9}  {'scenario':<16} {'wall (s)':>9} {'requests':>9} {'MB sent':>9} {'MB received':>12} {'peak MB':>9}  error")
+    for result in results:
+        print(f"{result['size']:>9}  {result['scenario']:<16} {result['wall_time']:>9.3f} {result['requests']:>9} "
+              f"{result['bytes_sent'] / 1e6:>9.2f} {result['bytes_received'] / 1e6:>12.2f} {result['peak_memory'] / 1e6:>9.1f}  "
+              f"{result['error'] or ''}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='Benchmark the scripts against a local mock Kibana')
+    parser.add_argument('--sizes', default='10000', required=False, help='Comma-separated numbers of saved objects, e.g. 10000,100000,1000000')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), required=False)
+    parser.add_argument('--page_size', type=int, default=1000, required=False)
+    parser.add_argument('--concurrency', type=int, default=1, required=False)
+    parser.add_argument('--bulk_size', type=int, default=100, required=False)
+    parser.add_argument('--output', default='benchmark_results.json', required=False)
+    parser.add_argument('--baseline', default=None, required=False, help='Earlier results file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, required=False, help='Allowed increase over the baseline, e.g. 0.2 for 20%%')
+    add_space_arguments(parser)
+    parser.set_defaults(objects=None)
+    args = parser.parse_args()
+
+    configure_http_client(pool_size=max(10, args.concurrency))
+    output_file = os.path.abspath(args.output)
+    baseline_file = os.path.abspath(args.baseline) if args.baseline else None
+    # The scripts write their exports, back-ups and logs to the working directory
+    os.chdir(tempfile.mkdtemp(prefix="benchmark_"))
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(",")]:
+        process, url = start_mock_server(size, args)
+        try:
+            configure_scripts(url)
+            for scenario in args.scenarios.split(","):
+                result = measure_scenario(scenario, url, args)
+                result["size"] = size
+                results.append(result)
+                print(f"{scenario} at {size} objects: {result['wall_time']}s, {result['requests']} requests", file=sys.stderr)
+        finally:
+            process.kill()
+            process.wait()
+
+    with open(output_file, "w") as file:
+        json.dump({"created_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "settings": vars(args), "results": results}, file, indent=2)
+    print_results(results)
+    print(f"Results written to '{output_file}'")
+    if baseline_file:
+        with open(baseline_file) as file:
+            regressions = compare_with_baseline(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        sys.exit(1 if regressions else 0)
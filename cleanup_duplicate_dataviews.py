@@ -1,12 +1,39 @@
 import sys
-import requests
+import json
 import logging
 from collections import defaultdict
 from argparse import ArgumentParser
 from datetime import datetime
 import pytz
 import os
-import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from kibana_saved_objects import SavedObjectSnapshot, SharedObjectRegistry, bulk_update_entry, bulk_update_saved_objects, \
+    count_objects_referencing, iter_saved_objects, snapshot_state_file, DEFAULT_PAGE_SIZE, DEFAULT_BULK_SIZE, DEFAULT_SPACE_WORKERS
+from reference_index import remap_references, change_list
+from attribute_scanner import AttributeScan
+from object_table import ObjectKeys
+from json_stream import STREAM_CHUNK_SIZE
+from snapshot_store import SnapshotStore
+from get_spaces import list_kibana_space_ids
+from github_publisher import GitHubArtifactPublisher
+from ndjson_export import ExportWriter, ExportSnapshot, export_file_name, open_ndjson
+from http_client import get_http_client, add_connection_arguments, configure_connection, write_http_metrics
+from profiling import configure_profiler, get_profiler, profile_phase
+from structured_logging import setup_logging, flush_logging, console, audit
+
+
+# Number of objects exported with one _export request. Kibana's default savedObjects.maxImportExportSize is 10,000.
+DEFAULT_EXPORT_CHUNK_SIZE = 10000
+
+# Number of data views backed up with one _export request
+DEFAULT_BACKUP_BATCH_SIZE = 100
+
+# Number of rewrite batches and deletions run at the same time by the 'apply' command
+DEFAULT_APPLY_WORKERS = 4
+
+# Only one space at a time may prompt the user for input
+prompt_lock = threading.Lock()
 
 
 # Set up timestamp in EST
@@ -21,246 +48,91 @@ def set_timestamp():
 
 # Setup Log file
 def setup_log_file(timestamp):
-    # Create the log file name with the EST timestamp
-    log_file_name = f"log_file_{timestamp}.log"
+    # Create the log file name with the EST timestamp. Each line of the log is a JSON object.
+    log_file_name = f"log_file_{timestamp}.ndjson"
     return log_file_name
 
 
-# Configures logging to redirect logs and print statements to a custom log file
-def setup_logging(log_file="output.log"):
-    """
-    Configures logging to redirect logs and print statements to a custom log file.
-    Overwrites the log file on each run.
-
-    Args:
-        log_file (str): The name of the log file.
-    """
-    # Configure the root logger
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s - %(levelname)s - %(message)s",
-        handlers=[
-            logging.FileHandler(log_file, mode="w"),  # Overwrite log file each run
-            logging.StreamHandler(sys.stdout),  # Print logs to stdout
-        ],
-    )
-
-    # Redirect print statements to logging
-    sys.stdout = LoggerWriter(logging.getLogger(), logging.INFO)
-    sys.stderr = LoggerWriter(logging.getLogger(), logging.ERROR)
-
-
-class LoggerWriter:
-    """
-    A file-like object to redirect print statements to the logging system.
-
-    Args:
-        logger (logging.Logger): Logger instance to write to.
-        log_level (int): Logging level for the messages.
-    """
-    def __init__(self, logger, log_level):
-        self.logger = logger
-        self.log_level = log_level
-
-    def write(self, message):
-        if message.strip():  # Ignore empty messages
-            self.logger.log(self.log_level, message.strip())
-
-    def flush(self):
-        pass  # No action needed for flush
-
-
-# Set up headers for Kibana authentication
-def get_headers(api_key):
-    headers = {
-        'kbn-xsrf': 'true',
-        'Content-Type': 'application/json',
-        'Authorization': f'ApiKey {api_key}'
-    }
-    return headers
-
-
-# Check-in files to a new github branch
-def upload_file_to_github(repo_url, github_username, github_key, local_file_path, repo_file_path, github_branch, timestamp):
-    """
-    Upload or update a file in a GitHub repository.
-
-    Args:
-        repo_url (str): The GitHub repository URL.
-        username (str): GitHub username.
-        password (str): GitHub account password (or Personal Access Token).
-        file_path (str): Path to the local file to be uploaded.
-        repo_file_path (str): Path in the repository where the file should be saved.
-        commit_message (str): Commit message for the file upload.
-        branch (str): The branch where the file should be committed. Default is 'main'.
-    """
-
-    commit_message = f"Uploaded object via script at {timestamp}"
-
-    # Extract repo details from the URL
-    repo = repo_url.split("https://github.com/")[1]
-    api_url = f"https://api.github.com/repos/{repo}"
-
-    # Step 1: Get the default branch's SHA
-    repo_info_url = f"{api_url}"
-    repo_info_response = requests.get(repo_info_url, auth=(github_username, github_key))
-    if repo_info_response.status_code != 200:
-        print(f"Error retrieving repository info: {repo_info_response.status_code} : {repo_info_response.text}")
-        raise Exception("Failed to retrieve repository information.")
-
-    default_branch = repo_info_response.json().get("default_branch", "main")
-    default_branch_url = f"{api_url}/git/ref/heads/{default_branch}"
-    default_branch_response = requests.get(default_branch_url, auth=(github_username, github_key))
-    if default_branch_response.status_code != 200:
-        print(f"Error retrieving default branch '{default_branch}': {default_branch_response.text}")
-        raise Exception("Default branch not found.")
-
-    default_branch_sha = default_branch_response.json()["object"]["sha"]
-
-    # Step 2: Create the new branch
-    create_branch_url = f"{api_url}/git/refs"
-    payload = {
-        "ref": f"refs/heads/{github_branch}",
-        "sha": default_branch_sha
-    }
-    create_branch_response = requests.post(create_branch_url, json=payload, auth=(github_username, github_key))
-    if create_branch_response.status_code == 201:
-        print(f"Branch '{github_branch}' created successfully.")
-    else:
-        print(f"Failed to create branch: {create_branch_response.status_code}, {create_branch_response.text}")
-        raise Exception(f"Failed to create branch: {create_branch_response.text}")
-
-    # Step 3: Read the local file and encode it
-    with open(local_file_path, "rb") as file:
-        content = base64.b64encode(file.read()).decode("utf-8")
-
-    # Step 4: Prepare the payload for file upload
-    file_url = f"{api_url}/contents/{repo_file_path}"
-    payload = {
-        "message": commit_message,
-        "content": content,
-        "branch": github_branch  # Specify the branch
-    }
-
-    # Step 5: Upload the file
-    response = requests.put(file_url, json=payload, auth=(github_username, github_key))
-    if response.status_code in (200, 201):
-        print(f"File successfully uploaded to '{repo_url}/{repo_file_path}' on branch '{github_branch}'.")
-    else:
-        print(f"Failed to upload file: {response.status_code}, {response.text}")
-
-
-# Check-in files to an existing github branch
-def upload_file_to_existing_github(repo_url, github_username, github_key, local_file_path, repo_file_path, github_branch, timestamp):
-    """
-    Upload or update a file in a GitHub repository on the specified branch.
-
-    Args:
-        repo_url (str): The GitHub repository URL.
-        github_username (str): GitHub username.
-        github_key (str): GitHub account password or Personal Access Token.
-        file_path (str): Local path to the file to be uploaded.
-        repo_file_path (str): Path in the repository where the file should be saved.
-        commit_message (str): Commit message for the upload.
-        branch (str): The branch where the file should be committed.
-    """
-    # Commit message
-    commit_message = f"Log file uploaded via script at {timestamp}"
-
-    # Parse repository owner and name from the URL
-    repo = repo_url.split("https://github.com/")[1]
-    api_url = f"https://api.github.com/repos/{repo}/contents/{repo_file_path}"
-
-    # Read the local file and encode it
-    with open(local_file_path, "rb") as file:
-        content = base64.b64encode(file.read()).decode("utf-8")
-
-    # Prepare payload for file upload
-    payload = {
-        "message": commit_message,
-        "content": content,
-        "branch": github_branch
-    }
-
-    # Upload or update the file
-    response = requests.put(api_url, json=payload, auth=(github_username, github_key))
-    if response.status_code in (200, 201):
-        print(f"File successfully uploaded to '{repo_url}/{repo_file_path}' on branch '{github_branch}'.")
-    else:
-        print(f"Failed to upload file: {response.status_code}, {response.text}")
+# Name of the per-object audit file
+def setup_audit_file(timestamp):
+    return f"audit_{timestamp}.ndjson"
 
 
 # Retrieve all kibana objects in the current space
-def retrieve_all_kibana_objects(headers, kibana_url):
+def retrieve_all_kibana_objects(snapshot):
+    space_id = snapshot.space_id
     logging.info(f"Retrieving all Kibana objects in space: '{space_id}'...")
-    find_objects_endpoint = f"{kibana_url}/s/{space_id}/api/saved_objects/_find"
-    object_type = ["config", "config-global", "url", "index-pattern", "action", "query", "tag", "graph-workspace",
-                   "alert", "search", "visualization", "event-annotation-group", "dashboard", "lens", "cases",
-                   "metrics-data-source", "links", "canvas-element", "canvas-workpad", "osquery-saved-query",
-                   "osquery-pack", "csp-rule-template", "map", "infrastructure-monitoring-log-view",
-                   "threshold-explorer-view", "uptime-dynamic-settings", "synthetics-privates-locations", "apm-indices",
-                   "infrastructure-ui-source", "inventory-view", "infra-custom-dashboards", "metrics-explorer-view",
-                   "apm-service-group", "apm-custom-dashboards"]
-    all_kib_objects = []
-    page = 1
-    for type in object_type:
-        params = {
-            #'fields': 'references',
-            'type': type,
-            'per_page': 10000
-        }
-        response = requests.get(find_objects_endpoint, headers=headers, params=params, verify=True)
-        if response.status_code == 200:
-            # response.raise_for_status()
-            data = response.json()
-            data = data.get("saved_objects", [])
-            all_kib_objects.extend([{"id": obj["id"], "type": obj["type"]} for obj in data])
-        else:
-            logging.error(f"Failed to retrieve Kibana objects. Status code: {response.status_code}, Response: : {get_response.text}")
+    # The {"id", "type"} of each object are only built a chunk at a time, for the export requests
+    all_kib_objects = ObjectKeys(snapshot.objects)
 
     num_of_kibana_objects = len(all_kib_objects)
     logging.info(f"{num_of_kibana_objects} Kibana objects were found in this space: '{space_id}'")
     if num_of_kibana_objects == 0:
-        print(f"There are NO Kibana objects in this space: '{space_id}'. No Further action is needed!")
-        print(f"Exiting...")
+        console(f"There are NO Kibana objects in this space: '{space_id}'. No Further action is needed!")
+        console(f"Exiting...")
         sys.exit(0)
     return all_kib_objects, num_of_kibana_objects
 
 
 # Export all Kibana objects using the Saved Objects API and save to an NDJSON file.
-def export_all_kibana_objects(all_kibana_objects, num_of_kibana_objects, headers, kibana_url, dry_run):
+def export_all_kibana_objects(all_kibana_objects, num_of_kibana_objects, headers, kibana_url, dry_run, space_id, output_file="kibana_objects.ndjson",
+                              compression=None, chunk_size=DEFAULT_EXPORT_CHUNK_SIZE):
+    """
+    Streams the export of all the objects to disk, optionally gzip or zstd compressed.
+
+    The objects are exported in chunks of chunk_size objects, one _export request per chunk, so spaces larger than
+    Kibana's export size limit (savedObjects.maxImportExportSize) are exported completely. The chunks are written
+    to the same file. A '<file>.manifest.json' file records the number of exported records and the SHA-256
+    checksum of the uncompressed export, to confirm the backup is complete.
+
+    Returns:
+        str: The export file, or None if no export file was written by this run.
+    """
     export_objects_endpoint = f"{kibana_url}/s/{space_id}/api/saved_objects/_export"
-    OUTPUT_FILE = "kibana_objects.ndjson"  # Path to save the exported objects
+    OUTPUT_FILE = export_file_name(output_file, compression)  # Path to save the exported objects
     logging.info(f"Exporting all Kibana objects in space: '{space_id}' to the '{OUTPUT_FILE}'. This would be used to restore all objects in case something goes wrong...")
     if dry_run:
         logging.info(f"[DRY-RUN] Would Export all Kibana objects in this space: '{space_id}' using the Saved Objects API and save to an NDJSON file: '{OUTPUT_FILE}'")
     else:
         if num_of_kibana_objects > 0:
-            payload = {
-                "objects": all_kibana_objects,
-                "includeReferencesDeep": True
-            }
-            response = requests.post(export_objects_endpoint, headers=headers, json=payload)
-            if response.status_code == 200:
-                with open(OUTPUT_FILE, "w") as file:
-                    file.write(response.text)
-                logging.info(f"All {num_of_kibana_objects} Kibana objects are successfully backed-up to the '{OUTPUT_FILE}' file")
-            else:
-                logging.error(f"Failed to export objects. Status code: {response.status_code}, Response: : {get_response.text}")
+            with ExportWriter(OUTPUT_FILE, compression) as writer:
+                for i in range(0, num_of_kibana_objects, chunk_size):
+                    payload = {
+                        "objects": all_kibana_objects[i:i + chunk_size],
+                        "includeReferencesDeep": True
+                    }
+                    with get_http_client().post(export_objects_endpoint, headers=headers, json=payload, stream=True, idempotent=True) as response:
+                        if response.status_code != 200:
+                            logging.error(f"Failed to export objects. Status code: {response.status_code}, Response: : {response.text}")
+                            break
+                        for line in response.iter_lines(STREAM_CHUNK_SIZE):
+                            writer.write_line(line)
+                else:
+                    writer.close()
+                    manifest_file = writer.write_manifest(num_of_kibana_objects)
+                    logging.info(f"All {num_of_kibana_objects} Kibana objects are successfully backed-up to the '{OUTPUT_FILE}' file "
+                                 f"({writer.record_count} records, sha256: {writer.checksum}). Details saved to: '{manifest_file}'")
+                    return OUTPUT_FILE
+            # The export is incomplete, so the partial file is removed rather than kept as a backup
+            os.remove(OUTPUT_FILE)
         else:
             logging.info(f"There are no Kibana objects to back-up. The '{OUTPUT_FILE}' file is not updated")
-        return OUTPUT_FILE
+    # No export file was written by this run
+    return None
 
 
 # Function to get all data views in the space ID specified
 def get_all_dataviews(space_id, headers, kibana_url):
     dataview_url = f'{kibana_url}/s/{space_id}/api/data_views'
-    response = requests.get(dataview_url, headers=headers, verify=True)
+    response = get_http_client().get(dataview_url, headers=headers, verify=True)
     if response.status_code == 200:
         response = response.json()
         data_views = response['data_view']
     else:
-        logging.error(f"Failed to GET all Data Views . Status code: {response.status_code}, Response: : {get_response.text}")
+        logging.error(f"Failed to GET all Data Views . Status code: {response.status_code}, Response: : {response.text}")
+        # Raised rather than exiting, so that a sweep only fails this space
+        response.raise_for_status()
+        raise Exception(f"Unexpected status code {response.status_code} for the data views of space: '{space_id}'")
     return data_views
 
 
@@ -276,266 +148,812 @@ def find_duplicated_data_views(data_views):
 
 
 # Retrieve all objects that references any duplicated data views, and count the number of references to each data view
-def get_object_references(data_view_ids, kibana_url, space_id, headers):
-    objects_endpoint = f"{kibana_url}/s/{space_id}/api/saved_objects/_find"
-    reference_counts = defaultdict(int)
-    object_type = ["config", "config-global", "url", "index-pattern", "action", "query", "tag", "graph-workspace",
-                   "alert", "search", "visualization", "event-annotation-group", "dashboard", "lens", "cases",
-                   "metrics-data-source", "links", "canvas-element", "canvas-workpad", "osquery-saved-query",
-                   "osquery-pack", "csp-rule-template", "map", "infrastructure-monitoring-log-view",
-                   "threshold-explorer-view", "uptime-dynamic-settings", "synthetics-privates-locations", "apm-indices",
-                   "infrastructure-ui-source", "inventory-view", "infra-custom-dashboards", "metrics-explorer-view",
-                   "apm-service-group", "apm-custom-dashboards"]
-
-    all_objects = []
-    for type in object_type:
-        params = {
-            'fields': 'references',
-            'type': type,
-            'per_page': 10000
-        }
-        response = requests.get(objects_endpoint, headers=headers, params=params, verify=True)
-        response.raise_for_status()
-        data = response.json()
-        all_objects.extend(data.get("saved_objects", []))
+def get_object_references(data_view_ids, snapshot):
+    # The objects come from the run's snapshot, so no request is sent to Kibana here
+    reference_counts = snapshot.reference_counts(data_view_ids)
+    return reference_counts, snapshot.objects
+
+
+# Build the updates of every object referencing a data view that is being replaced by its canonical data view
+def build_reference_updates(reference_index, id_mapping, shared_objects=None, attribute_scan=None):
+    reference_updates = []
+    seen_objects = set()
+    for old_data_view_id in id_mapping:
+        objects = [(object_type, object_id) for object_type, object_id, ref_name in reference_index.references_to(old_data_view_id)]
+        if attribute_scan:
+            # Objects embedding the data view id in their attributes, whether or not they also reference it
+            objects += attribute_scan.objects_with(old_data_view_id)
+        for object_type, object_id in objects:
+            if (object_type, object_id) in seen_objects:
+                continue
+            seen_objects.add((object_type, object_id))
+            object = reference_index.get_object(object_type, object_id)
+            if object is None and attribute_scan:
+                object = attribute_scan.get_object(object_type, object_id)
+            if shared_objects is not None and not shared_objects.claim(object):
+                logging.info(f"Skipping {object_type} with ID: {object_id}. It is shared with another space that already processed it")
+                continue
+            # Every reference of the object is rewritten at once, and the references that don't change are kept
+            changes, new_references = remap_references(object.get("references", []), id_mapping, reference_index.ref_type)
+            new_attributes = {}
+            if attribute_scan:
+                # Only the top-level attributes embedding a replaced id are sent, the others are left as they are
+                attribute_changes, new_attributes = attribute_scan.rewrite(object_type, object_id, id_mapping)
+                changes += attribute_changes
+            reference_updates.append((object, changes, bulk_update_entry(object, new_references, new_attributes)))
+    return reference_updates
+
+
+# Work out the reference rewrites and data view deletions that clean up the duplicates of a space, without changing anything
+def build_cleanup_plan(space_id, data_views, snapshot, shared_objects=None, attribute_scan=None):
+    """
+    Build the cleanup plan of a space from its data views and a snapshot of its saved objects.
 
-    # Count each object's link to a data view
-    for object in all_objects:
-        references = object.get("references", [])
-        for ref in references:
-            if ref["type"] == "index-pattern" and ref["id"] in data_view_ids:
-                reference_counts[ref["id"]] += 1
-    return reference_counts, all_objects
+    The most referenced data view of each duplicate group is kept, every reference to the other data views
+    of the group is rewritten to it, and the data views left with no reference once the rewrites are done
+    are deleted. Works the same with a snapshot of the live space or of an export file. With an attribute_scan
+    of the duplicate data view ids, the ids embedded in attributes are rewritten too, and count as references.
 
+    Returns:
+        dict: The plan, with the duplicate groups, the rewrites (one per object, with the object's full
+            new references array) and the data views to delete.
+    """
+    reference_index = snapshot.reference_index
+    duplicates = find_duplicated_data_views(data_views)
+    titles = {data_view["id"]: data_view["title"] for data_view in data_views}
+    # Old data view ID -> ID of the most referenced data view with the same title
+    id_mapping = {}
+    duplicate_groups = []
+    for title, ids in duplicates.items():
+        most_referenced_id = reference_index.most_referenced(ids)
+        group = {"title": title, "keep": most_referenced_id, "reference_counts": {id: reference_index.count(id) for id in ids}}
+        if attribute_scan:
+            group["attribute_counts"] = {id: attribute_scan.count(id) for id in ids}
+        duplicate_groups.append(group)
+        for id in ids:
+            if id != most_referenced_id:
+                id_mapping[id] = most_referenced_id
+
+    rewrites = []
+    rewritten_references = defaultdict(int)
+    for object, changes, update in build_reference_updates(reference_index, id_mapping, shared_objects, attribute_scan):
+        for ref_name, old_data_view_id, new_data_view_id in changes:
+            rewritten_references[old_data_view_id] += 1
+        rewrites.append(dict(update, changes=change_list(changes)))
+    deletions = []
+    for id in id_mapping:
+        remaining_references = reference_index.count(id) - rewritten_references[id]
+        if attribute_scan:
+            remaining_references += attribute_scan.count(id)
+        deletions.append({"id": id, "title": titles[id], "replaced_by": id_mapping[id], "remaining_references": remaining_references,
+                          "delete": remaining_references == 0})
+    return {
+        "space_id": space_id,
+        "duplicates": duplicate_groups,
+        # Every data view is backed up before it is deleted
+        "backups": [deletion["id"] for deletion in deletions if deletion["delete"]],
+        "rewrites": rewrites,
+        "deletions": deletions
+    }
 
-# Update data view ID in objects referencing duplicated data views
-def update_references(ref_type, ref_name, object_type, object_id, old_data_view_id, new_data_view_id, kibana_url, headers, dry_run):
-    if dry_run:
-        logging.info(f"[DRY-RUN] Would update data view ID in {object_type} with ID: {object_id} from {old_data_view_id} to {new_data_view_id}")
-    else:
-        object_endpoint = f"{kibana_url}/s/{space_id}/api/saved_objects/{object_type}/{object_id}"
-        update_payload = {
-            "references": [
-                {
-                    "type": ref_type,
-                    "id": new_data_view_id,
-                    "name": ref_name
-                }
-            ],
-            "attributes": {}
-        }
-        response = requests.put(object_endpoint, headers=headers, json=update_payload)
-        #response.raise_for_status()  # Raise an error if the request failed
-        if response.status_code == 200:
-            logging.info(f"Updated data view ID in {object} from {old_data_view_id} to {new_data_view_id}")
-            updated_kibana_object = response.json()
-            print(f"Successfully updated data view ID for object type {object_type} with ID {object_id}.")
-            print(f"Old Data View ID: {old_data_view_id}")
-            print(f"New Data View ID: {new_data_view_id}")
-            return updated_kibana_object
+
+# Print a cleanup plan in the same form as the messages of a dry run
+def print_cleanup_plan(plan):
+    if not plan["duplicates"]:
+        console("ALL CLEAR: No Duplicate Data Views found.")
+        return
+    logging.warning("Duplicated data views found:")
+    for group in plan["duplicates"]:
+        console(f"DATA VIEW TITLE: {group['title']}")
+        attribute_counts = group.get("attribute_counts", {})
+        for id, count in group["reference_counts"].items():
+            embedded = f"  (+{attribute_counts[id]} in attributes)" if attribute_counts.get(id) else ""
+            console(f"  ID: {id}  : {count}{embedded}{'  (kept)' if id == group['keep'] else ''}")
+    for rewrite in plan["rewrites"]:
+        audit("rewrite", plan["space_id"], rewrite["type"], rewrite["id"], "planned", changes=rewrite["changes"])
+    console(f"[PLAN] {len(plan['rewrites'])} objects would be UPDATED")
+    for deletion in plan["deletions"]:
+        if deletion["delete"]:
+            console(f"[PLAN] Data View with ID: {deletion['id']} would be DELETED")
         else:
-            logging.error(f"Failed to update object . Status code: {response.status_code}, Response: : {get_response.text}")
+            logging.warning(f"[PLAN] Data View with ID: {deletion['id']} would keep {deletion['remaining_references']} references and would NOT be deleted")
 
 
-# Check if the any object is referencing the Data View to be Deleted
-def has_references(all_objects, data_view_id):
-    for object in all_objects:
-        references = object.get("references", [])
-        for ref in references:
-            if ref['type'] == 'index-pattern' and ref['id'] in data_view_id:
-                return True
-    return False
+# Write the plans of one or several spaces to a plan file, which can be applied with the 'apply' command
+def write_cleanup_plan(space_plans, plan_file):
+    plan = {
+        "cluster_name": cluster_name,
+        "created_at": timestamp,
+        "spaces": space_plans
+    }
+    with open(plan_file, "w") as file:
+        json.dump(plan, file, indent=2)
+    console(f"Cleanup plan of {len(space_plans)} spaces written to '{plan_file}'")
+    return plan_file
 
 
-def backup_data_view(kibana_url, headers, space_id, data_view_id, output_file):
-    export_objects_endpoint = f"{kibana_url}/s/{space_id}/api/saved_objects/_export"
-    payload = {
-        "objects": [
-            {
-                "id": data_view_id,
-                "type": "index-pattern"
-            }
-        ],
-        "includeReferencesDeep": True
-    }
+# Look for the duplicate data view ids in the attributes of every saved object of a space
+def scan_attributes(kibana_url, headers, space_id, data_views, export_file=None, page_size=DEFAULT_PAGE_SIZE, concurrency=1):
+    """
+    Scan the attributes (searchSourceJSON, panelsJSON, layerListJSON, ad-hoc data views...) of every saved object
+    of a space for the ids of the duplicate data views, all ids at once with one multi-pattern matcher.
 
-    response = requests.post(export_objects_endpoint, headers=headers, json=payload)
+    The objects are read from export_file when there is one, e.g. the export written earlier in the run, and
+    streamed from the _find API with all their attributes otherwise. Either way only one object is held at a time.
 
-    if response.status_code == 200:
-        # Write the backup data to a file (one for each data view)
-        with open(f"data_view_{data_view_id}_backup.ndjson", "w") as file:
-            file.write(response.text)
-        logging.info(f"Backup successful for data view: '{data_view_id}'! Saved to: 'data_view_{data_view_id}_backup.ndjson'")
-
-        # # Check-in data views to Github
-        # dataview_local_file = f"data_view_{data_view_id}_backup.ndjson"
-        # dataview_repo_file_path = dataview_local_file
-        # upload_file_to_existing_github(repo_url, github_username, github_key, dataview_local_file, dataview_repo_file_path,
-        #                                github_branch, timestamp)
+    Returns:
+        AttributeScan: The objects embedding a duplicate data view id, or None if there is no duplicate.
+    """
+    data_view_ids = [id for ids in find_duplicated_data_views(data_views).values() for id in ids]
+    if not data_view_ids:
+        return None
+    attribute_scan = AttributeScan(data_view_ids)
+    with profile_phase("attribute_scan", space_id) as span:
+        if export_file:
+            attribute_scan.scan_file(export_file)
+        else:
+            # fields=() returns every attribute of the objects
+            for object in iter_saved_objects(kibana_url, space_id, headers, page_size=page_size, fields=(), concurrency=concurrency):
+                attribute_scan.scan_object(object)
+        span.items = attribute_scan.scanned_count
+    logging.info(f"{attribute_scan.scanned_count} objects scanned for {len(data_view_ids)} duplicate data view ids: "
+                 f"{len(attribute_scan.hits)} objects embed them in their attributes")
+    return attribute_scan
+
+
+# Plan the cleanup of a space from an export file, without sending any request to Kibana or GitHub
+def plan_from_export(export_file, space_id, plan_file="cleanup_plan.json", scan=False):
+    log_file_name = setup_log_file(timestamp)
+    setup_logging(log_file_name, audit_file=setup_audit_file(timestamp))
+    console(f"Planning the cleanup of space: '{space_id}' in the cluster: '{cluster_name}' from the export file: '{export_file}'")
+    snapshot = ExportSnapshot(export_file, space_id)
+    attribute_scan = scan_attributes(None, None, space_id, snapshot.data_views, export_file) if scan else None
+    plan = build_cleanup_plan(space_id, snapshot.data_views, snapshot, attribute_scan=attribute_scan)
+    print_cleanup_plan(plan)
+    return write_cleanup_plan([plan], plan_file)
+
+
+# Plan the cleanup of one live space. Nothing is changed in Kibana.
+def plan_space(kibana_url, headers, space_id, page_size=DEFAULT_PAGE_SIZE, concurrency=1, query_mode='full', shared_objects=None,
+               state_dir=None, scan=False):
+    console(f"Planning the cleanup of space: '{space_id}' in the cluster: '{cluster_name}'")
+    data_views = get_all_dataviews(space_id, headers, kibana_url)
+    referenced_ids = None
+    if query_mode == 'has_reference':
+        # Only the objects referencing a duplicate data view are needed for the plan
+        referenced_ids = [id for ids in find_duplicated_data_views(data_views).values() for id in ids]
+    state_file = snapshot_state_file(state_dir, kibana_url, space_id) if state_dir and referenced_ids is None else None
+    snapshot = SavedObjectSnapshot(kibana_url, space_id, headers, page_size=page_size, concurrency=concurrency,
+                                   referenced_ids=referenced_ids, state_file=state_file)
+    attribute_scan = scan_attributes(kibana_url, headers, space_id, data_views, page_size=page_size, concurrency=concurrency) if scan else None
+    plan = build_cleanup_plan(space_id, data_views, snapshot, shared_objects, attribute_scan)
+    print_cleanup_plan(plan)
+    return plan
+
+
+# Update data view ID in objects referencing duplicated data views
+def update_references(reference_updates, kibana_url, space_id, headers, dry_run, bulk_size=DEFAULT_BULK_SIZE):
+    if dry_run:
+        for object, changes, update in reference_updates:
+            audit("rewrite", space_id, update["type"], update["id"], "dry_run", changes=change_list(changes))
+        return [object for object, changes, update in reference_updates]
+
+    updated_objects = []
+    updates = [update for object, changes, update in reference_updates]
+    results = bulk_update_saved_objects(kibana_url, space_id, headers, updates, bulk_size)
+    for (object, changes, update), result in zip(reference_updates, results):
+        if result["success"]:
+            audit("rewrite", space_id, update["type"], update["id"], "done", changes=change_list(changes))
+            updated_objects.append(object)
+        else:
+            audit("rewrite", space_id, update["type"], update["id"], "failed", changes=change_list(changes), error=result["error"])
+            logging.error(f"Failed to update {update['type']} with ID: {update['id']}. Error: {result['error']}")
+    console(f"Successfully updated data view IDs for {len(updated_objects)} of {len(reference_updates)} objects.")
+    return updated_objects
+
+
+# Check if the any object is referencing the Data View to be Deleted, or still embeds its ID in its attributes
+def has_references(reference_index, data_view_id, embedded_ids=()):
+    return reference_index.has_references(data_view_id) or data_view_id in embedded_ids
+
+
+# Name of the backup file of a data view. The same ID can be used by data views of different spaces.
+def data_view_backup_file(space_id, data_view_id):
+    return f"data_view_{space_id}_{data_view_id}_backup.ndjson"
+
+
+# Collect the export lines of the given objects from an NDJSON export stream, and return the references still to be collected
+def collect_export_lines(lines, wanted_objects, exported_lines):
+    pending_references = set()
+    for line in lines:
+        if not line.strip():
+            continue
+        object = json.loads(line)
+        key = (object.get("type"), object.get("id"))
+        if key in wanted_objects and key not in exported_lines:
+            exported_lines[key] = line.rstrip("\n")
+            pending_references.update((ref["type"], ref["id"]) for ref in object.get("references", []))
+    return pending_references - set(exported_lines)
+
+
+# Objects of the backup of a data view: the data view and, recursively, every object it references
+def backup_closure(data_view_id, exported_lines):
+    closure = []
+    stack = [("index-pattern", data_view_id)]
+    while stack:
+        key = stack.pop()
+        if key in closure or key not in exported_lines:
+            continue
+        closure.append(key)
+        object = json.loads(exported_lines[key])
+        stack.extend((ref["type"], ref["id"]) for ref in object.get("references", []))
+    return closure
+
+
+# Back up the data views to be deleted, one backup file per data view
+def backup_data_views(kibana_url, headers, space_id, data_view_ids, export_file=None, batch_size=DEFAULT_BACKUP_BATCH_SIZE):
+    """
+    Writes a 'data_view_<space_id>_<id>_backup.ndjson' file for each data view, holding the data view and the objects it references.
+
+    When the full-space export of this run is on disk, the backups are cut out of it, so no request is sent to Kibana.
+    Otherwise the data views are exported in batches of batch_size with one _export request per batch, and the
+    stream is split into the per-data-view files locally.
+
+    A data view whose batch failed, or which is missing from the export, is logged and reported as failed; the
+    others are still backed up. The caller must not delete the failed ones.
+
+    Args:
+        kibana_url (str): The Kibana URL.
+        headers (dict): Headers used to authenticate to Kibana.
+        space_id (str): The Kibana space of the data views.
+        data_view_ids (list): IDs of the data views to back up.
+        export_file (str): The full-space export of this run, if there is one.
+        batch_size (int): Number of data views exported per request.
+
+    Returns:
+        tuple: (backup_files, failed_ids), the dict of data view ID -> backup file and the list of the IDs of the
+            data views that could not be backed up.
+    """
+    exported_lines = {}
+    wanted_objects = {("index-pattern", data_view_id) for data_view_id in data_view_ids}
+    if export_file and os.path.exists(export_file):
+        logging.info(f"Backing up {len(data_view_ids)} data views from the full export: '{export_file}'")
+        # Each pass over the export picks up the objects referenced by the objects found in the previous pass
+        searched_objects = set()
+        while wanted_objects:
+            searched_objects |= wanted_objects
+            with open_ndjson(export_file) as file:
+                wanted_objects = collect_export_lines(file, wanted_objects, exported_lines) - searched_objects
     else:
-        logging.error(f"Failed to backup data view {data_view_id}. Error: {response.text}")
-        sys.exit(1)
+        export_objects_endpoint = f"{kibana_url}/s/{space_id}/api/saved_objects/_export"
+        for i in range(0, len(data_view_ids), batch_size):
+            payload = {
+                "objects": [{"id": data_view_id, "type": "index-pattern"} for data_view_id in data_view_ids[i:i + batch_size]],
+                "includeReferencesDeep": True
+            }
+            with get_http_client().post(export_objects_endpoint, headers=headers, json=payload, stream=True, idempotent=True) as response:
+                if response.status_code != 200:
+                    # The data views of the batch are missing from exported_lines, so they are reported as failed below
+                    logging.error(f"Failed to backup data views {data_view_ids[i:i + batch_size]}. Error: {response.text}")
+                    continue
+                # includeReferencesDeep already returned every referenced object, so every line is kept for the split below
+                for line in response.iter_lines(STREAM_CHUNK_SIZE):
+                    if not line:
+                        continue
+                    line = line.decode("utf-8")
+                    object = json.loads(line)
+                    if "exportedCount" not in object:
+                        exported_lines[(object["type"], object["id"])] = line
+
+    backup_files = {}
+    failed_ids = []
+    for data_view_id in data_view_ids:
+        closure = backup_closure(data_view_id, exported_lines)
+        if not closure:
+            logging.error(f"Failed to backup data view {data_view_id}. It was not found in the export")
+            failed_ids.append(data_view_id)
+            continue
+        # Write the backup data to a file (one for each data view)
+        backup_file = data_view_backup_file(space_id, data_view_id)
+        with open(backup_file, "w") as file:
+            for key in closure:
+                file.write(exported_lines[key] + "\n")
+            file.write(json.dumps({"excludedObjects": [], "excludedObjectsCount": 0, "exportedCount": len(closure),
+                                   "missingRefCount": 0, "missingReferences": []}) + "\n")
+        logging.info(f"Backup successful for data view: '{data_view_id}'! Saved to: '{backup_file}'")
+        backup_files[data_view_id] = backup_file
+    return backup_files, failed_ids
+
+
+# Delete a data view. Returns None on success, or the error.
+def delete_dataview(data_view_id, kibana_url, space_id, headers):
+    dataview_url = f'{kibana_url}/s/{space_id}/api/data_views/data_view/{data_view_id}'
+    response = get_http_client().delete(dataview_url, headers=headers)
+    if response.status_code == 200:
+        return None
+    return f"Status code: {response.status_code}, Response: {response.text}"
 
 
 # Delete Data View if it has no references by other Kibana Objects
-def delete_dataview_if_no_references(data_view_id, all_objects, kibana_url, space_id, headers, dry_run):
+def delete_dataview_if_no_references(data_view_id, reference_index, kibana_url, space_id, headers, dry_run, embedded_ids=()):
     if dry_run:
         logging.info(f"[DRY-RUN] Would check if data view with id: '{data_view_id}' is referenced by any object. If no object is referecning this Data View, you would be prompted to choose if you want it deleted.")
-        delete_data_view = input(f"Do you want this Data View with ID: {data_view_id} to be DELETED? Enter 'Y' for Yes, 'N' for No: ").upper()
+        with prompt_lock:
+            flush_logging()
+            delete_data_view = input(f"Do you want this Data View with ID: {data_view_id} to be DELETED? Enter 'Y' for Yes, 'N' for No: ").upper()
         if delete_data_view == "Y":
-            print(f"[DRY-RUN] Data View with ID: {data_view_id} would be DELETED \n")
+            console(f"[DRY-RUN] Data View with ID: {data_view_id} would be DELETED")
+            return True
         elif delete_data_view == "N":
-            print(f"[DRY-RUN] Data View with ID: {data_view_id} would NOT be deleted \n")
+            console(f"[DRY-RUN] Data View with ID: {data_view_id} would NOT be deleted")
         else:
-            print(f"Invalid Entry. Re-run script and Enter 'Y' or 'N'")
-        return None
+            console(f"Invalid Entry. Re-run script and Enter 'Y' or 'N'")
+        return False
     else:
-        if not has_references(all_objects, data_view_id):
-            dataview_url = f'{kibana_url}/s/{space_id}/api/data_views/data_view/{data_view_id}'
-            delete_data_view = input(f"Do you want this Data View with ID: {data_view_id} to be DELETED? Enter 'Y' for Yes, 'N' for No: ").upper()
+        if not has_references(reference_index, data_view_id, embedded_ids):
+            with prompt_lock:
+                flush_logging()
+                delete_data_view = input(f"Do you want this Data View with ID: {data_view_id} to be DELETED? Enter 'Y' for Yes, 'N' for No: ").upper()
             if delete_data_view == "Y":
-                response = requests.delete(dataview_url, headers=headers)
-                if response.status_code == 200:
-                    print("")
-                    print(f"Data view with ID {data_view_id} successfully DELETED.")
+                error = delete_dataview(data_view_id, kibana_url, space_id, headers)
+                if error is None:
+                    console(f"Data view with ID {data_view_id} successfully DELETED.")
+                    return True
                 else:
-                    print("")
-                    print(f"Failed to delete Old data view {data_view_id} . Status code: {response.status_code}, Response: {response.text}")
+                    console(f"Failed to delete Old data view {data_view_id} . {error}")
             elif delete_data_view == "N":
-                print(f"You elected NOT to delete Data View with ID: {data_view_id}. Hence this Data View would NOT be deleted \n")
+                console(f"You elected NOT to delete Data View with ID: {data_view_id}. Hence this Data View would NOT be deleted")
             else:
-                print(f"Invalid Entry. Re-run script and Enter a valid entry: 'Y' or 'N'")
-            return None
+                console(f"Invalid Entry. Re-run script and Enter a valid entry: 'Y' or 'N'")
+            return False
         else:
-            print("")
-            print(f"Data view {data_view_id} has references and was NOT deleted.")
+            console(f"Data view {data_view_id} has references and was NOT deleted.")
+            return False
 
 
-# main
-def main(kibana_url, headers, space_id, dry_run):
-    log_file_name = setup_log_file(timestamp)
-    setup_logging(log_file_name)  # Initialize logging
+# Clean up the duplicate data views of one space and return a summary of what was done
+def cleanup_space(kibana_url, headers, space_id, dry_run, page_size=DEFAULT_PAGE_SIZE, concurrency=1, bulk_size=DEFAULT_BULK_SIZE,
+                  query_mode='full', shared_objects=None, all_spaces=False, publisher=None, export_compression=None,
+                  export_chunk_size=DEFAULT_EXPORT_CHUNK_SIZE, state_dir=None, store=None, scan=False):
     updated_objects_count = 0
     data_views_to_be_deleted = []
     objects_config_before_update = []
     updated_objects = []
-
-    print(f"Running the script for space: '{space_id}' in the cluster: '{cluster_name}'")
-    all_kibana_objects, num_of_kibana_objects = retrieve_all_kibana_objects(headers, kibana_url)
-    kibana_objects = export_all_kibana_objects(all_kibana_objects, num_of_kibana_objects, headers, kibana_url, dry_run)
-    local_file_path = f"{kibana_objects}"
-    repo_file_path = f"all_objects/{local_file_path}"
-    upload_file_to_github(repo_url, github_username, github_key, local_file_path, repo_file_path, github_branch, timestamp)
-    data_views = get_all_dataviews(space_id, headers, kibana_url)
-    duplicates = find_duplicated_data_views(data_views)
-    print("")
+    attribute_scan = None
+
+    console(f"Running the script for space: '{space_id}' in the cluster: '{cluster_name}'")
+    # Saved objects are fetched once and shared by every duplicate group below
+    # With a state directory only the objects changed since the previous run are fetched
+    state_file = snapshot_state_file(state_dir, kibana_url, space_id) if state_dir else None
+    snapshot = SavedObjectSnapshot(kibana_url, space_id, headers, page_size=page_size, concurrency=concurrency,
+                                   state_file=state_file)
+    full_snapshot = snapshot
+    with profile_phase("inventory", space_id) as span:
+        all_kibana_objects, num_of_kibana_objects = retrieve_all_kibana_objects(snapshot)
+        span.items = num_of_kibana_objects
+    # In a sweep each space gets its own export file
+    output_file = f"kibana_objects_{space_id}.ndjson" if all_spaces else "kibana_objects.ndjson"
+    with profile_phase("export", space_id) as span:
+        kibana_objects = export_all_kibana_objects(all_kibana_objects, num_of_kibana_objects, headers, kibana_url, dry_run,
+                                                   space_id, output_file, export_compression, export_chunk_size)
+        span.items = num_of_kibana_objects
+    if kibana_objects and publisher:
+        publisher.add(kibana_objects, f"all_objects/{kibana_objects}")
+        publisher.add(f"{kibana_objects}.manifest.json", f"all_objects/{kibana_objects}.manifest.json")
+    with profile_phase("data_view_fetch", space_id) as span:
+        data_views = get_all_dataviews(space_id, headers, kibana_url)
+        span.items = len(data_views)
+    with profile_phase("duplicate_detection", space_id) as span:
+        duplicates = find_duplicated_data_views(data_views)
+        span.items = len(data_views)
     if not duplicates:
-        logging.info("ALL CLEAR: No Duplicate Data Views found.")
+        console("ALL CLEAR: No Duplicate Data Views found.")
     else:
         dup_data_view_ids = []
         logging.warning("Duplicated data views found:")
-        for title, ids in duplicates.items():
-            # Get the reference counts for each data view ID in the duplicated group
-            reference_counts, all_objects = get_object_references(ids, kibana_url, space_id, headers)
-            print(f"DATA VIEW TITLE: {title}")
-            for id in ids:
-                print(f"  ID: {id}  : {reference_counts[id]}")
-                dup_data_view_ids.append(id)
-                most_referenced_id = max(reference_counts, key=reference_counts.get)
-                if id != most_referenced_id:
-                    data_views_to_be_deleted.append(id)
-                    for object in all_objects:
-                        object_references = object.get("references", [])
-                        for ref in object_references:
-                            if ref["id"] == id:
-                                object_type = object['type']
-                                object_id = object['id']
-                                old_data_view_id = ref["id"]
-                                ref_type = ref["type"]
-                                ref_name = ref["name"]
-                                new_data_view_id = most_referenced_id
-                                print("")
-                                update_references(ref_type, ref_name, object_type, object_id, old_data_view_id, new_data_view_id, kibana_url, headers, dry_run)
-                                updated_objects.append(object)
-                                print("")
-                                print("")
-                                updated_objects_count += 1
-            print("")
-
-    print("")
+        if query_mode == 'has_reference':
+            # From here on only the objects referencing a duplicate data view are needed, so they are requested
+            # from Kibana with a has_reference query. The re-fetch after the updates is limited to them as well.
+            snapshot = SavedObjectSnapshot(kibana_url, space_id, headers, page_size=page_size, concurrency=concurrency,
+                                           referenced_ids=[id for ids in duplicates.values() for id in ids])
+        # Old data view ID -> ID of the most referenced data view with the same title
+        id_mapping = {}
+        with profile_phase("reference_count", space_id) as span:
+            for title, ids in duplicates.items():
+                # Get the reference counts for each data view ID in the duplicated group
+                reference_counts, all_objects = get_object_references(ids, snapshot)
+                most_referenced_id = snapshot.reference_index.most_referenced(ids)
+                console(f"DATA VIEW TITLE: {title}")
+                for id in ids:
+                    console(f"  ID: {id}  : {reference_counts[id]}")
+                    dup_data_view_ids.append(id)
+                    if id != most_referenced_id:
+                        data_views_to_be_deleted.append(id)
+                        id_mapping[id] = most_referenced_id
+            span.items = len(snapshot.objects)
+        if scan:
+            # Read from the export written above rather than fetched again, when this run wrote one
+            attribute_scan = scan_attributes(kibana_url, headers, space_id, data_views, kibana_objects, page_size, concurrency)
+
+        # All the objects referencing the duplicates are rewritten together in _bulk_update batches
+        with profile_phase("reference_rewrite", space_id) as span:
+            reference_updates = build_reference_updates(snapshot.reference_index, id_mapping, shared_objects, attribute_scan)
+            updated_objects = update_references(reference_updates, kibana_url, space_id, headers, dry_run, bulk_size)
+            updated_objects_count = len(updated_objects)
+            span.items = len(reference_updates)
+
+    if updated_objects and not dry_run:
+        # References were rewritten in Kibana, so the snapshot is re-fetched once for the review and delete checks
+        with profile_phase("post_rewrite_refresh", space_id) as span:
+            span.items = len(snapshot.refresh())
     if updated_objects:
+        # Each object is listed with its reference changes in the audit file, not on the console
         if dry_run:
-            logging.info("[DRY-RUN] The following objects would be updated:")
-            for object in updated_objects:
-                print(object)
-            print("")
-            print(f"[DRY-RUN] {updated_objects_count} objects would have been UPDATED if this code actually ran")
-            print("")
+            console(f"[DRY-RUN] {updated_objects_count} objects would have been UPDATED if this code actually ran")
         else:
-            print("The following objects were updated:")
-            for object in updated_objects:
-                print(object)
-            print("")
-            print(f"{updated_objects_count} objects in total were UPDATED")
-            print("")
+            console(f"{updated_objects_count} objects in total were UPDATED")
     else:
-        print("ALL CLEAR: No objects needed to be updated")
-        print("")
+        console("ALL CLEAR: No objects needed to be updated")
     if duplicates:
-        print("REVIEW DUPLICATE DATA VIEWS BEFORE REMOVING DUPLICATES WITH ZERO REFERENCES")
+        console("REVIEW DUPLICATE DATA VIEWS BEFORE REMOVING DUPLICATES WITH ZERO REFERENCES")
         for title, ids in duplicates.items():
             # Get the reference counts for each data view ID in the duplicated group
-            reference_counts, all_objects = get_object_references(ids, kibana_url, space_id, headers)
-            print(f"Title: {title}")
+            reference_counts, all_objects = get_object_references(ids, snapshot)
+            console(f"Title: {title}")
             for id in ids:
-                print(f"  ID: {id}  : {reference_counts[id]}")
+                console(f"  ID: {id}  : {reference_counts[id]}")
                 dup_data_view_ids.append(id)
-            print("")
-    print("")
+    deleted_data_views = []
+    # Data view ids still embedded in the attributes of objects that were not rewritten
+    embedded_ids = attribute_scan.remaining_ids((object["type"], object["id"]) for object in updated_objects) if attribute_scan else set()
     if data_views_to_be_deleted:
         logging.warning("ID of Data views to be deleted:")
-        print(data_views_to_be_deleted)
+        console(data_views_to_be_deleted)
         try:
             data_views_to_be_deleted
         except NameError:
-            print("")
             data_views_to_be_deleted = []
-        for data_view_id in data_views_to_be_deleted:
-            # Backup each data view
-            backup_data_view(kibana_url, headers, space_id, data_view_id, f"Data_view_{data_view_id}_back_up.ndjson")
+        # Backup all the data views at once, from the full export when it was written by this run
+        with profile_phase("backup", space_id) as span:
+            backup_files, failed_backups = backup_data_views(kibana_url, headers, space_id, data_views_to_be_deleted, kibana_objects)
+            span.items = len(backup_files)
+        # The time spent waiting for the answer to each prompt is part of this phase
+        with profile_phase("delete", space_id) as span:
+            for data_view_id in data_views_to_be_deleted:
+                # A data view is never deleted without a backup
+                if data_view_id in failed_backups:
+                    console(f"Data view with ID: '{data_view_id}' was not deleted. It could not be backed up")
+                    audit("delete", space_id, "index-pattern", data_view_id, "not_deleted", reason="backup failed")
+                    continue
+                # Check-in data views back-ups to Github with the rest of the run's files
+                if publisher:
+                    publisher.add(backup_files[data_view_id])
+
+                # Delete each data view
+                if delete_dataview_if_no_references(data_view_id, snapshot.reference_index, kibana_url, space_id, headers, dry_run,
+                                                    embedded_ids):
+                    deleted_data_views.append(data_view_id)
+                    audit("delete", space_id, "index-pattern", data_view_id, "dry_run" if dry_run else "done")
+                else:
+                    audit("delete", space_id, "index-pattern", data_view_id, "not_deleted")
+            span.items = len(data_views_to_be_deleted)
 
-            # Check-in data views back-ups to Github
-            dataview_local_file = f"data_view_{data_view_id}_backup.ndjson"
-            dataview_repo_file_path = dataview_local_file
-            upload_file_to_existing_github(repo_url, github_username, github_key, dataview_local_file, dataview_repo_file_path, github_branch, timestamp)
+    else:
+        console("ALL CLEAR: No Data Views needed to be deleted")
+
+    if store:
+        if updated_objects and not dry_run and snapshot is not full_snapshot:
+            full_snapshot.refresh()
+        # The space as left by the run is kept in the local store for later investigations
+        store.save_space(cluster_name, space_id,
+                         [object for object in full_snapshot.objects
+                          if not (object["type"] == "index-pattern" and object["id"] in deleted_data_views)],
+                         [data_view for data_view in data_views if data_view["id"] not in deleted_data_views])
+
+    return {
+        "space_id": space_id,
+        "status": "ok",
+        "duplicate_titles": len(duplicates),
+        "duplicate_data_views": sum(len(ids) for ids in duplicates.values()),
+        "updated_objects": updated_objects_count,
+        "deleted_data_views": deleted_data_views
+    }
 
-            # Delete each data view
-            delete_dataview_if_no_references(data_view_id, all_objects, kibana_url, space_id, headers, dry_run)
 
+# Run cleanup_space for one space of a multi-space sweep, turning failures into a summary entry
+def cleanup_space_in_sweep(kibana_url, headers, space_id, dry_run, page_size, concurrency, bulk_size, query_mode, shared_objects,
+                           publisher, export_compression, export_chunk_size, state_dir, store, scan=False):
+    # The thread is named after the space so that each log line shows the space it belongs to
+    threading.current_thread().name = space_id
+    try:
+        return cleanup_space(kibana_url, headers, space_id, dry_run, page_size, concurrency, bulk_size, query_mode,
+                             shared_objects, all_spaces=True, publisher=publisher, export_compression=export_compression,
+                             export_chunk_size=export_chunk_size, state_dir=state_dir, store=store, scan=scan)
+    except SystemExit as e:
+        status = "no objects" if e.code in (0, None) else "failed"
+        return {"space_id": space_id, "status": status, "duplicate_titles": 0, "duplicate_data_views": 0,
+                "updated_objects": 0, "deleted_data_views": []}
+    except Exception as e:
+        logging.error(f"Failed to clean up space: '{space_id}'. Error: {e}")
+        return {"space_id": space_id, "status": "failed", "duplicate_titles": 0, "duplicate_data_views": 0,
+                "updated_objects": 0, "deleted_data_views": []}
+
+
+# Print the combined summary of a multi-space sweep
+def print_sweep_summary(summaries, dry_run):
+    prefix = "[DRY-RUN] " if dry_run else ""
+    console(f"{prefix}SUMMARY OF ALL SPACES")
+    for summary in summaries:
+        console(f"  Space: '{summary['space_id']}'  Status: {summary['status']}  "
+                f"Duplicate titles: {summary['duplicate_titles']}  Duplicate data views: {summary['duplicate_data_views']}  "
+                f"Updated objects: {summary['updated_objects']}  Deleted data views: {len(summary['deleted_data_views'])}")
+    console(f"{prefix}{len(summaries)} spaces processed. {sum(s['updated_objects'] for s in summaries)} objects updated and "
+            f"{sum(len(s['deleted_data_views']) for s in summaries)} data views deleted in total")
+
+
+class ActionResults:
+    """
+    Writes the outcome of every action of an 'apply' run (backup, rewrite or delete) to an NDJSON result file,
+    one line per action, and keeps a count of each status. Safe to use from several worker threads.
+
+    Statuses: 'done', 'failed', 'skipped' (e.g. a data view still referenced) and 'dry_run'.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.counts = defaultdict(int)
+        self._lock = threading.Lock()
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.file_name, "w")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._file.close()
+
+    def record(self, space_id, action, object_type, object_id, status, detail=None):
+        result = {"space_id": space_id, "action": action, "type": object_type, "id": object_id, "status": status, "detail": detail}
+        with self._lock:
+            self._file.write(json.dumps(result) + "\n")
+            self._file.flush()
+            self.counts[(action, status)] += 1
+
+
+# Apply the plan of one space: back up the data views to delete, rewrite the references, then delete the data views
+def apply_space_plan(kibana_url, headers, space_plan, dry_run, results, workers=DEFAULT_APPLY_WORKERS, bulk_size=DEFAULT_BULK_SIZE,
+                     publisher=None):
+    """
+    Runs every action of a space plan without prompting. Rewrites are sent in _bulk_update batches of bulk_size
+    and the batches and deletions are spread over a pool of workers. A data view is only deleted if it was
+    backed up and if Kibana reports no object referencing it any more, right before the delete.
+    """
+    space_id = space_plan["space_id"]
+    prefix = "[DRY-RUN] " if dry_run else ""
+    console(f"{prefix}Applying the cleanup plan of space: '{space_id}' in the cluster: '{cluster_name}'")
+
+    # Backups are read-only, so they are taken in dry runs as well
+    backed_up = set()
+    if space_plan["backups"]:
+        with profile_phase("backup", space_id) as span:
+            backup_files, failed_backups = backup_data_views(kibana_url, headers, space_id, space_plan["backups"])
+            span.items = len(backup_files)
+        for data_view_id in space_plan["backups"]:
+            if data_view_id in backup_files:
+                backed_up.add(data_view_id)
+                results.record(space_id, "backup", "index-pattern", data_view_id, "done", backup_files[data_view_id])
+                if publisher:
+                    publisher.add(backup_files[data_view_id])
+            else:
+                results.record(space_id, "backup", "index-pattern", data_view_id, "failed", "The data view could not be exported")
+
+    rewrites = space_plan["rewrites"]
+    # Data view ids left embedded in attributes by failed rewrites. The delete check below only sees the references.
+    embedded_ids = set()
+    if dry_run:
+        for rewrite in rewrites:
+            audit("rewrite", space_id, rewrite["type"], rewrite["id"], "dry_run", changes=rewrite["changes"])
+            results.record(space_id, "rewrite", rewrite["type"], rewrite["id"], "dry_run")
     else:
-        print("ALL CLEAR: No Data Views needed to be deleted")
-    # log_file_name = setup_log_file(timestamp)
-    log_file = log_file_name
-    log_repo_file_path = log_file
-    upload_file_to_existing_github(repo_url, github_username, github_key, log_file, log_repo_file_path, github_branch, timestamp)
+        updates = [{key: value for key, value in rewrite.items() if key != "changes"} for rewrite in rewrites]
+        batches = [updates[i:i + bulk_size] for i in range(0, len(updates), bulk_size)]
+        with profile_phase("reference_rewrite", space_id) as span, ThreadPoolExecutor(max_workers=workers) as executor:
+            span.items = len(updates)
+            batch_results = executor.map(
+                lambda batch: list(bulk_update_saved_objects(kibana_url, space_id, headers, batch, len(batch))), batches)
+            updated_count = 0
+            for rewrite, result in zip(rewrites, (result for batch_result in batch_results for result in batch_result)):
+                results.record(space_id, "rewrite", result["type"], result["id"], "done" if result["success"] else "failed",
+                               result["error"])
+                updated_count += result["success"]
+                if not result["success"]:
+                    embedded_ids.update(change["from"] for change in rewrite["changes"] if change["name"].startswith("attributes."))
+        console(f"Successfully updated data view IDs for {updated_count} of {len(rewrites)} objects.")
+
+    def delete(deletion):
+        data_view_id = deletion["id"]
+        if not deletion["delete"]:
+            return "skipped", f"{deletion['remaining_references']} references were not planned to be rewritten"
+        if data_view_id not in backed_up:
+            return "skipped", "The data view was not backed up"
+        if data_view_id in embedded_ids:
+            return "skipped", "The data view ID is still embedded in the attributes of objects whose rewrite failed"
+        if dry_run:
+            return "dry_run", "The references are checked again right before the delete"
+        # The plan may be out of date, so Kibana is asked again whether anything still references the data view
+        remaining_references = count_objects_referencing(kibana_url, space_id, headers, data_view_id)
+        if remaining_references:
+            return "skipped", f"{remaining_references} objects still reference the data view"
+        error = delete_dataview(data_view_id, kibana_url, space_id, headers)
+        return ("done", None) if error is None else ("failed", error)
+
+    with profile_phase("delete", space_id) as span, ThreadPoolExecutor(max_workers=workers) as executor:
+        span.items = len(space_plan["deletions"])
+        for deletion, (status, detail) in zip(space_plan["deletions"], executor.map(delete, space_plan["deletions"])):
+            results.record(space_id, "delete", "index-pattern", deletion["id"], status, detail)
+            if status == "done":
+                console(f"Data view with ID {deletion['id']} successfully DELETED.")
+            elif status == "dry_run":
+                console(f"[DRY-RUN] Data View with ID: {deletion['id']} would be DELETED")
+            else:
+                logging.warning(f"Data view {deletion['id']} was NOT deleted ({status}): {detail}")
+
+
+# 'plan' command: write the cleanup plan of one space or of every space, without changing anything
+def plan_main(kibana_url, headers, space_id, plan_file, page_size=DEFAULT_PAGE_SIZE, concurrency=1, query_mode='full',
+              all_spaces=False, space_workers=DEFAULT_SPACE_WORKERS, state_dir=None, scan=False):
+    log_file_name = setup_log_file(timestamp)
+    setup_logging(log_file_name, show_thread=all_spaces, audit_file=setup_audit_file(timestamp))
+    if state_dir:
+        os.makedirs(state_dir, exist_ok=True)
+    if not all_spaces:
+        return write_cleanup_plan([plan_space(kibana_url, headers, space_id, page_size, concurrency, query_mode,
+                                              state_dir=state_dir, scan=scan)], plan_file)
+
+    space_ids = list_kibana_space_ids(headers, kibana_url)
+    # Objects shared by several spaces are only rewritten by the plan of the first space that reaches them
+    shared_objects = SharedObjectRegistry()
+
+    def plan_sweep_space(sweep_space_id):
+        threading.current_thread().name = sweep_space_id
+        try:
+            return plan_space(kibana_url, headers, sweep_space_id, page_size, concurrency, query_mode, shared_objects, state_dir,
+                              scan)
+        except SystemExit as e:
+            # A space that exits (e.g. one without objects) must not stop the plan of the others
+            if e.code not in (0, None):
+                logging.error(f"Failed to plan the cleanup of space: '{sweep_space_id}'")
+            return None
+        except Exception as e:
+            logging.error(f"Failed to plan the cleanup of space: '{sweep_space_id}'. Error: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=space_workers) as executor:
+        space_plans = [space_plan for space_plan in executor.map(plan_sweep_space, space_ids) if space_plan is not None]
+    return write_cleanup_plan(space_plans, plan_file)
+
+
+# 'apply' command: run every action of a plan file unattended and write the outcome of each action to a result file
+def apply_main(kibana_url, headers, plan_file, dry_run, workers=DEFAULT_APPLY_WORKERS, bulk_size=DEFAULT_BULK_SIZE):
+    log_file_name = setup_log_file(timestamp)
+    audit_file_name = setup_audit_file(timestamp)
+    setup_logging(log_file_name, audit_file=audit_file_name)
+    with open(plan_file) as file:
+        plan = json.load(file)
+    if plan.get("cluster_name") not in (None, cluster_name):
+        logging.error(f"The plan '{plan_file}' was made for the cluster '{plan['cluster_name']}', not '{cluster_name}'")
+        sys.exit(1)
+
+    publisher = GitHubArtifactPublisher(repo_url, github_username, github_key, github_branch)
+    publisher.prepare()
+    results_file = f"apply_results_{timestamp}.ndjson"
+    try:
+        with ActionResults(results_file) as results:
+            for space_plan in plan["spaces"]:
+                apply_space_plan(kibana_url, headers, space_plan, dry_run, results, workers, bulk_size, publisher)
+        prefix = "[DRY-RUN] " if dry_run else ""
+        console(f"{prefix}Plan applied. Outcome of each action written to '{results_file}':")
+        for (action, status), count in sorted(results.counts.items()):
+            console(f"  {action}: {count} {status}")
+    finally:
+        publisher.add(plan_file)
+        publisher.add(results_file)
+        # The log records still on the logging queue are written before the files are uploaded
+        flush_logging()
+        publisher.add(log_file_name)
+        publisher.add(audit_file_name)
+        with profile_phase("github_upload"):
+            publisher.publish(f"Applied cleanup plan via script at {timestamp}")
+
+
+# main
+def main(kibana_url, headers, space_id, dry_run, page_size=DEFAULT_PAGE_SIZE, concurrency=1, bulk_size=DEFAULT_BULK_SIZE,
+         query_mode='full', all_spaces=False, space_workers=DEFAULT_SPACE_WORKERS, export_compression=None,
+         export_chunk_size=DEFAULT_EXPORT_CHUNK_SIZE, state_dir=None, store_file=None, scan=False):
+    log_file_name = setup_log_file(timestamp)
+    audit_file_name = setup_audit_file(timestamp)
+    setup_logging(log_file_name, show_thread=all_spaces, audit_file=audit_file_name)  # Initialize logging
+
+    # Every file of the run is committed to the GitHub branch at once at the end of the run. The repository is
+    # checked up front, so that nothing is changed in Kibana if the back-ups can't be uploaded.
+    publisher = GitHubArtifactPublisher(repo_url, github_username, github_key, github_branch)
+    publisher.prepare()
+    if state_dir:
+        os.makedirs(state_dir, exist_ok=True)
+    store = SnapshotStore(store_file) if store_file else None
+
+    try:
+        if all_spaces:
+            space_ids = list_kibana_space_ids(headers, kibana_url)
+            console(f"Running the script for {len(space_ids)} spaces in the cluster: '{cluster_name}' with {space_workers} spaces at a time")
+            # Objects shared by several spaces are only processed by the first space that reaches them
+            shared_objects = SharedObjectRegistry()
+            with ThreadPoolExecutor(max_workers=space_workers) as executor:
+                summaries = list(executor.map(
+                    lambda sweep_space_id: cleanup_space_in_sweep(kibana_url, headers, sweep_space_id, dry_run, page_size, concurrency,
+                                                                  bulk_size, query_mode, shared_objects, publisher,
+                                                                  export_compression, export_chunk_size, state_dir, store, scan),
+                    space_ids))
+            print_sweep_summary(summaries, dry_run)
+        else:
+            cleanup_space(kibana_url, headers, space_id, dry_run, page_size, concurrency, bulk_size, query_mode, publisher=publisher,
+                          export_compression=export_compression, export_chunk_size=export_chunk_size, state_dir=state_dir,
+                          store=store, scan=scan)
+    finally:
+        # The files written so far are uploaded even if the run failed, to keep the back-ups and the log for the audit
+        flush_logging()
+        publisher.add(log_file_name)
+        publisher.add(audit_file_name)
+        with profile_phase("github_upload"):
+            publisher.publish(f"Uploaded objects via script at {timestamp}")
 
 
 if __name__ == "__main__":
     parser = ArgumentParser(description='Automate the process of cleaning up duplicate data views!')
-    parser.add_argument('--kibana_url', default='None', required=True)
-    parser.add_argument('--api_key', default='None', required=True)
+    parser.add_argument('command', nargs='?', choices=['run', 'plan', 'apply'], default='run',
+                        help="'run' (default) cleans up interactively, 'plan' writes a cleanup plan to --plan_file and "
+                             "'apply' runs the actions of --plan_file unattended")
+    add_connection_arguments(parser)
     parser.add_argument('--cluster_name', default='None', required=True)
-    parser.add_argument('--space_id', default='None', required=True)
+    parser.add_argument('--space_id', default='None', required=False)
+    parser.add_argument('--all_spaces', '--all-spaces', action='store_true', help='Clean up every space of the cluster instead of --space_id')
+    parser.add_argument('--space_workers', type=int, default=DEFAULT_SPACE_WORKERS, required=False)
     parser.add_argument('--dry_run', choices=['True', 'False', 'false'], default='True')
+    parser.add_argument('--page_size', type=int, default=DEFAULT_PAGE_SIZE, required=False)
+    parser.add_argument('--concurrency', type=int, default=1, required=False)
+    parser.add_argument('--bulk_size', type=int, default=DEFAULT_BULK_SIZE, required=False)
+    parser.add_argument('--query_mode', choices=['full', 'has_reference'], default='full', required=False)
+    parser.add_argument('--export_compression', choices=['none', 'gzip', 'zstd'], default='none', required=False)
+    parser.add_argument('--export_chunk_size', type=int, default=DEFAULT_EXPORT_CHUNK_SIZE, required=False)
+    parser.add_argument('--incremental', action='store_true', help='Only fetch the saved objects changed since the previous run')
+    parser.add_argument('--state_dir', default='snapshot_state', required=False)
+    parser.add_argument('--store', default=None, required=False, help='SQLite file the saved objects and data views are stored in')
+    parser.add_argument('--export_file', default=None, required=False, help='Plan the cleanup offline from this NDJSON export')
+    parser.add_argument('--plan_file', default='cleanup_plan.json', required=False)
+    parser.add_argument('--scan_attributes', action='store_true',
+                        help='Also rewrite the duplicate data view IDs embedded in attributes (searchSourceJSON, panelsJSON...), '
+                             'and keep the data views still embedded')
+    parser.add_argument('--apply_workers', type=int, default=DEFAULT_APPLY_WORKERS, required=False)
+    parser.add_argument('--metrics_textfile_dir', default=None, required=False,
+                        help="Directory of the node exporter's textfile collector, for the Prometheus request metrics")
+    parser.add_argument('--profile', action='store_true', help='Time each phase of the run and write a phase breakdown next to the log')
+    parser.add_argument('--profile_cprofile', action='store_true', help='With --profile, write a cProfile of each phase')
+    parser.add_argument('--profile_memory', action='store_true', help='With --profile, record the peak allocated memory of each phase')
 
     parser.add_argument('--github_username', default='None', required=False)
     parser.add_argument('--github_key', default='None', required=False)
 
     args = parser.parse_args()
+    if args.command != 'apply' and not args.all_spaces and args.space_id == 'None':
+        parser.error("one of the arguments --space_id or --all_spaces is required")
+    if not args.export_file and 'None' in (args.kibana_url, args.api_key):
+        parser.error("the arguments --kibana_url and --api_key are required unless --export_file is used")
     kibana_url = args.kibana_url
     api_key = args.api_key
     cluster_name = args.cluster_name
     space_id = args.space_id
+    page_size = args.page_size
+    concurrency = args.concurrency
+    bulk_size = args.bulk_size
     dry_run = args.dry_run
 
     github_username = args.github_username
@@ -549,8 +967,33 @@ if __name__ == "__main__":
     # Get timestamp
     timestamp = set_timestamp()
 
+    if args.export_file:
+        # Offline: the plan is read from the export file, and nothing is sent to Kibana or GitHub
+        plan_from_export(args.export_file, space_id, args.plan_file, args.scan_attributes)
+        sys.exit(0)
+    state_dir = args.state_dir if args.incremental else None
+    configure_profiler(args.profile, args.profile_cprofile, args.profile_memory, f"profile_{timestamp}")
+
     repo_url = "https://github.com/olajio/cleanup_duplicate_dataviews"
     github_branch = f"{github_username}-{timestamp}"
 
-    headers = get_headers(api_key)
-    main(kibana_url, headers, space_id, dry_run)
+    # Every Kibana and GitHub call of the run goes through the same pooled keep-alive connections
+    headers = configure_connection(args, max(concurrency * args.space_workers if args.all_spaces else concurrency, args.apply_workers))
+    try:
+        if args.command == 'plan':
+            plan_main(kibana_url, headers, space_id, args.plan_file, page_size, concurrency, args.query_mode, args.all_spaces,
+                      args.space_workers, state_dir, args.scan_attributes)
+        elif args.command == 'apply':
+            apply_main(kibana_url, headers, args.plan_file, dry_run, args.apply_workers, bulk_size)
+        else:
+            main(kibana_url, headers, space_id, dry_run, page_size, concurrency, bulk_size, args.query_mode, args.all_spaces,
+                 args.space_workers, None if args.export_compression == 'none' else args.export_compression, args.export_chunk_size,
+                 state_dir, args.store, args.scan_attributes)
+    finally:
+        # Per-endpoint request counts, latencies and bytes of the whole run, next to the log file
+        prometheus_file = f"http_metrics_{timestamp}.prom"
+        if args.metrics_textfile_dir:
+            # A stable name, so that each run replaces the metrics of the previous one
+            prometheus_file = os.path.join(args.metrics_textfile_dir, f"kibana_cleanup_{cluster_name}.prom")
+        write_http_metrics(f"http_metrics_{timestamp}.json", prometheus_file, {"cluster": cluster_name, "command": args.command})
+        get_profiler().write_report()
@@ -1,28 +1,24 @@
-import requests
+import sys
 import logging
+import os
 from collections import defaultdict
 from argparse import ArgumentParser
-
-
-# Set up headers for Kibana authentication
-def get_headers(api_key):
-    headers = {
-        'kbn-xsrf': 'true',
-        'Content-Type': 'application/json',
-        'Authorization': f'ApiKey {api_key}'
-    }
-    return headers
+from kibana_saved_objects import SavedObjectSnapshot, snapshot_state_file, DEFAULT_PAGE_SIZE
+from snapshot_store import SnapshotStore
+from ndjson_export import ExportSnapshot
+from http_client import get_http_client, add_connection_arguments, configure_connection, write_http_metrics
 
 
 # Function to get all data views in the space ID specified
 def get_all_dataviews(space_id, headers, kibana_url):
     dataview_url = f'{kibana_url}/s/{space_id}/api/data_views'
-    response = requests.get(dataview_url, headers=headers, verify=True)
+    response = get_http_client().get(dataview_url, headers=headers, verify=True)
     if response.status_code == 200:
         response = response.json()
         data_views = response['data_view']
     else:
-        logging.error(f"Failed to GET all Data Views . Status code: {response.status_code}, Response: : {get_response.text}")
+        logging.error(f"Failed to GET all Data Views . Status code: {response.status_code}, Response: : {response.text}")
+        sys.exit(1)
     return data_views
 
 
@@ -38,43 +34,50 @@ def find_duplicated_data_views(data_views):
 
 
 # Retrieve all objects that references any duplicated data views, and count the number of references to each data view
-def get_object_references(data_view_ids, kibana_url, space_id, headers):
-    objects_endpoint = f"{kibana_url}/s/{space_id}/api/saved_objects/_find"
-    reference_counts = defaultdict(int)
-    object_type = ["config", "config-global", "url", "index-pattern", "action", "query", "tag", "graph-workspace",
-                   "alert", "search", "visualization", "event-annotation-group", "dashboard", "lens", "cases",
-                   "metrics-data-source", "links", "canvas-element", "canvas-workpad", "osquery-saved-query",
-                   "osquery-pack", "csp-rule-template", "map", "infrastructure-monitoring-log-view",
-                   "threshold-explorer-view", "uptime-dynamic-settings", "synthetics-privates-locations", "apm-indices",
-                   "infrastructure-ui-source", "inventory-view", "infra-custom-dashboards", "metrics-explorer-view",
-                   "apm-service-group", "apm-custom-dashboards"]
-
-    all_objects = []
-    for type in object_type:
-        params = {
-            'fields': 'references',
-            'type': type,
-            'per_page': 10000
-        }
-        response = requests.get(objects_endpoint, headers=headers, params=params, verify=True)
-        response.raise_for_status()
-        data = response.json()
-        all_objects.extend(data.get("saved_objects", []))
-
-    # Count each object's link to a data view
-    for object in all_objects:
-        references = object.get("references", [])
-        for ref in references:
-            if ref["type"] == "index-pattern" and ref["id"] in data_view_ids:
-                reference_counts[ref["id"]] += 1
-    return reference_counts, all_objects
+def get_object_references(data_view_ids, snapshot):
+    # The objects come from the run's snapshot, so no request is sent to Kibana here
+    reference_counts = snapshot.reference_counts(data_view_ids)
+    return reference_counts, snapshot.objects
 
 
 # main
-def main(kibana_url, headers, space_id):
+def main(kibana_url, headers, space_id, page_size=DEFAULT_PAGE_SIZE, concurrency=1, query_mode='full', state_dir=None,
+         store_file=None, from_store=False, export_file=None):
     print(f"RUNNING THE SCRIPT FOR SPACE: '{space_id}' IN ELASTIC CLUSTER: '{cluster_name}'")
-    data_views = get_all_dataviews(space_id, headers, kibana_url)
-    duplicates = find_duplicated_data_views(data_views)
+    store = SnapshotStore(store_file) if store_file else None
+    export_snapshot = ExportSnapshot(export_file, space_id) if export_file else None
+    if export_snapshot:
+        # Offline: the export file is streamed once, and no request is sent to Kibana
+        data_views = export_snapshot.data_views
+        duplicates = find_duplicated_data_views(data_views)
+    elif from_store:
+        # Everything is answered by indexed queries on the local store, no request is sent to Kibana
+        stored_space = store.space(cluster_name, space_id)
+        data_views = stored_space.data_views()
+        duplicates = stored_space.duplicate_data_views()
+    else:
+        data_views = get_all_dataviews(space_id, headers, kibana_url)
+        duplicates = find_duplicated_data_views(data_views)
+    # Saved objects are fetched once and shared by every duplicate group below
+    referenced_ids = None
+    state_file = None
+    if state_dir:
+        # Only the objects changed since the previous run are fetched
+        os.makedirs(state_dir, exist_ok=True)
+        state_file = snapshot_state_file(state_dir, kibana_url, space_id)
+    if query_mode == 'has_reference' and not store:
+        # Only the objects referencing a duplicate data view are requested from Kibana
+        referenced_ids = [id for ids in duplicates.values() for id in ids]
+    elif query_mode == 'has_reference' and not (from_store or export_snapshot):
+        # The store must hold every object of the space, so they are all fetched
+        logging.warning("query_mode 'has_reference' is ignored with a store: every saved object of the space is fetched to be stored")
+    if export_snapshot:
+        snapshot = export_snapshot
+    elif from_store:
+        snapshot = stored_space
+    else:
+        snapshot = SavedObjectSnapshot(kibana_url, space_id, headers, page_size=page_size, concurrency=concurrency,
+                                       referenced_ids=referenced_ids, state_file=state_file)
     print("")
     if not duplicates:
         print("ALL CLEAR: No duplicated Data views found.")
@@ -83,19 +86,33 @@ def main(kibana_url, headers, space_id):
         logging.warning("Duplicate data views found:")
         for title, ids in duplicates.items():
             # Get the reference counts for each data view ID in the duplicated group
-            reference_counts, all_objects = get_object_references(ids, kibana_url, space_id, headers)
+            reference_counts, all_objects = get_object_references(ids, snapshot)
             print("")
             print(f"DATA VIEW TITLE: {title}")
             for id in ids:
                 print(f"  ID: {id}  : {reference_counts[id]} references")
                 dup_data_view_ids.append(id)
+    if store and not from_store and not export_snapshot:
+        # Every object of the space is kept in the store, so later investigations can run with --from_store
+        store.save_space(cluster_name, space_id, snapshot.objects, data_views)
+        logging.info(f"Saved objects and data views of space: '{space_id}' stored in '{store_file}'")
 
 if __name__ == "__main__":
     parser = ArgumentParser(description='Automate the process of finding duplicate data views!')
-    parser.add_argument('--kibana_url', default='None', required=True)
-    parser.add_argument('--api_key', default='None', required=True)
+    add_connection_arguments(parser)
     parser.add_argument('--cluster_name', default='None', required=True)
     parser.add_argument('--space_id', default='None', required=True)
+    parser.add_argument('--page_size', type=int, default=DEFAULT_PAGE_SIZE, required=False)
+    parser.add_argument('--concurrency', type=int, default=1, required=False)
+    parser.add_argument('--query_mode', choices=['full', 'has_reference'], default='full', required=False)
+    parser.add_argument('--incremental', action='store_true', help='Only fetch the saved objects changed since the previous run')
+    parser.add_argument('--state_dir', default='snapshot_state', required=False)
+    parser.add_argument('--store', default=None, required=False, help='SQLite file the saved objects and data views are stored in')
+    parser.add_argument('--from_store', action='store_true', help='Find the duplicates in the --store file instead of Kibana')
+    parser.add_argument('--export_file', default=None, required=False, help='Find the duplicates offline in this NDJSON export')
+    parser.add_argument('--metrics_file', default=None, required=False, help='Write the per-endpoint request metrics to this JSON file')
+    parser.add_argument('--metrics_textfile_dir', default=None, required=False,
+                        help="Directory of the node exporter's textfile collector, for the Prometheus request metrics")
 
 
     args = parser.parse_args()
@@ -103,6 +120,23 @@ if __name__ == "__main__":
     api_key = args.api_key
     cluster_name = args.cluster_name
     space_id = args.space_id
-
-    headers = get_headers(api_key)
-    main(kibana_url, headers, space_id)
+    page_size = args.page_size
+    concurrency = args.concurrency
+
+    # Every Kibana and GitHub call of the run goes through the same pooled keep-alive connections
+    headers = configure_connection(args, concurrency)
+    if args.from_store and not args.store:
+        parser.error("--from_store requires --store")
+    if args.query_mode == 'has_reference' and args.store and not (args.from_store or args.export_file):
+        parser.error("--query_mode has_reference can't be used with --store: the store needs every saved object of the space")
+    if not (args.export_file or args.from_store) and 'None' in (args.kibana_url, args.api_key):
+        parser.error("the arguments --kibana_url and --api_key are required unless --export_file or --from_store is used")
+    try:
+        main(kibana_url, headers, space_id, page_size, concurrency, args.query_mode, args.state_dir if args.incremental else None,
+             args.store, args.from_store, args.export_file)
+    finally:
+        if args.metrics_file or args.metrics_textfile_dir:
+            prometheus_file = None
+            if args.metrics_textfile_dir:
+                prometheus_file = os.path.join(args.metrics_textfile_dir, f"kibana_find_duplicates_{cluster_name}.prom")
+            write_http_metrics(args.metrics_file or "http_metrics.json", prometheus_file, {"cluster": cluster_name})
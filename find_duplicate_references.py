@@ -1,63 +1,191 @@
-import requests
+import sys
 import json
+import logging
 from collections import defaultdict
+from argparse import ArgumentParser
+from datetime import datetime
+from kibana_saved_objects import iter_saved_object_pages, bulk_update_entry, bulk_update_saved_objects, SharedObjectRegistry, \
+    OBJECT_TYPES, DEFAULT_PAGE_SIZE, DEFAULT_BULK_SIZE, DEFAULT_PAGE_CONCURRENCY
+from get_spaces import list_kibana_space_ids
+from http_client import add_connection_arguments, configure_connection, write_http_metrics
+from structured_logging import setup_logging, flush_logging, console, audit
 
-# Configuration: Replace these values with your Kibana host, authentication, and desired object type.
-KIBANA_HOST = "http://localhost:5601"
-USERNAME = "your_username"       # If authentication is required.
-PASSWORD = "your_password"       # If authentication is required.
-OBJECT_TYPE = "visualization"    # You can change this to any other saved object type.
-PAGE_SIZE = 100                  # Number of objects per request.
 
+# Referenced objects that appear more than once in the references of a saved object
 def find_duplicate_references(saved_object):
-    reference_counts = defaultdict(int)
-    duplicates = {}
-    for ref in saved_object.get("references", []):
-        key = (ref.get("type"), ref.get("id"))
-        reference_counts[key] += 1
-        if reference_counts[key] > 1:
-            duplicates[key] = reference_counts[key]
-    return duplicates
-
-def get_saved_objects(object_type, page=1, per_page=PAGE_SIZE):
-    # Construct the API endpoint URL. The _find endpoint allows pagination.
-    url = f"{KIBANA_HOST}/api/saved_objects/_find"
-    params = {
-        "type": object_type,
-        "page": page,
-        "per_page": per_page
-    }
-    headers = {
-        "kbn-xsrf": "true",  # Required by Kibana API for non-GET requests and sometimes GET as well.
-        "Content-Type": "application/json"
-    }
-    # If authentication is needed, include HTTP Basic Auth.
-    response = requests.get(url, params=params, headers=headers, auth=(USERNAME, PASSWORD))
-    response.raise_for_status()
-    return response.json()
-
-def scan_saved_objects():
-    page = 1
-    total = None
-
-    while True:
-        data = get_saved_objects(OBJECT_TYPE, page)
-        saved_objects = data.get("saved_objects", [])
-        if total is None:
-            total = data.get("total", 0)
-            print(f"Found {total} objects of type '{OBJECT_TYPE}'.")
-
-        for obj in saved_objects:
-            duplicates = find_duplicate_references(obj)
-            if duplicates:
-                print(f"Object ID {obj.get('id')} has duplicate references:")
-                for (ref_type, ref_id), count in duplicates.items():
-                    print(f"  {ref_type} with id {ref_id} appears {count} times.")
-
-        # Pagination: Check if we've fetched all objects.
-        if page * PAGE_SIZE >= total:
-            break
-        page += 1
+    """
+    Returns:
+        dict: (type, id) of each object referenced more than once -> the names of its references.
+    """
+    references = saved_object.get("references") or []
+    if len(references) < 2:
+        return {}
+    keys = [(ref.get("type"), ref.get("id")) for ref in references]
+    # Most objects have no duplicate, and are ruled out without building the dict
+    if len(set(keys)) == len(keys):
+        return {}
+    names = defaultdict(list)
+    for key, ref in zip(keys, references):
+        names[key].append(ref.get("name"))
+    return {key: key_names for key, key_names in names.items() if len(key_names) > 1}
+
+
+# Remove the references that repeat an earlier one exactly (same name, type and id)
+def dedupe_references(references):
+    """
+    References to the same object under different names are kept: Kibana uses them for different parts of the
+    object (e.g. the layers of a Lens visualization), so only the exact copies are removed.
+
+    Returns:
+        list: The references without the exact copies, in their original order.
+    """
+    seen = set()
+    kept = []
+    for ref in references:
+        key = (ref.get("name"), ref.get("type"), ref.get("id"))
+        if key not in seen:
+            seen.add(key)
+            kept.append(ref)
+    return kept
+
+
+class ScanResults:
+    """
+    Writes the objects with duplicate references to an NDJSON result file, one line per object: its space, type
+    and id, and each object it references more than once with the number and names of the references.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.file_name, "w")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._file.close()
+
+    def record(self, space_id, object, duplicates):
+        self._file.write(json.dumps({
+            "space_id": space_id,
+            "type": object["type"],
+            "id": object["id"],
+            "duplicates": [{"type": ref_type, "id": ref_id, "count": len(names), "names": names}
+                           for (ref_type, ref_id), names in duplicates.items()]
+        }) + "\n")
+
+
+# Scan every saved object of a space for duplicate references, and optionally remove the exact copies
+def scan_space(kibana_url, headers, space_id, results, object_types=None, page_size=DEFAULT_PAGE_SIZE,
+               concurrency=DEFAULT_PAGE_CONCURRENCY, dedupe=False, dry_run=True, bulk_size=DEFAULT_BULK_SIZE, shared_objects=None):
+    """
+    Streams the references of every saved object of the space with concurrent _find pages (see
+    iter_saved_object_pages) and records each object with duplicate references in results. Only the pages in
+    flight are held in memory, plus, with dedupe, the updates of the objects holding exact copies.
+
+    With dedupe, the objects whose references hold exact copies are rewritten with the copies removed, in
+    _bulk_update requests of bulk_size objects, once the scan of the space is over: _find pages by offset, so
+    objects rewritten during the scan could move between pages and be skipped or seen twice.
+
+    Returns:
+        dict: Number of objects scanned, with duplicates, and per dedupe outcome.
+    """
+    console(f"Scanning the saved objects of space: '{space_id}' for duplicate references...")
+    counts = defaultdict(int)
+    updates = []
+    for page in iter_saved_object_pages(kibana_url, space_id, headers, object_types, page_size, concurrency=concurrency):
+        counts["scanned"] += len(page)
+        for object in page:
+            duplicates = find_duplicate_references(object)
+            if not duplicates:
+                continue
+            # An object shared by several spaces is reported and rewritten by the first space that reaches it
+            if shared_objects is not None and not shared_objects.claim(object):
+                continue
+            results.record(space_id, object, duplicates)
+            counts["with_duplicates"] += 1
+            if dedupe:
+                references = dedupe_references(object["references"])
+                if len(references) < len(object["references"]):
+                    updates.append((len(object["references"]) - len(references), bulk_update_entry(object, references)))
+
+    if updates and dry_run:
+        for removed, update in updates:
+            audit("dedupe", space_id, update["type"], update["id"], "dry_run", removed_references=removed)
+        counts["dedupe_dry_run"] = len(updates)
+    elif updates:
+        outcomes = bulk_update_saved_objects(kibana_url, space_id, headers, [update for removed, update in updates], bulk_size)
+        for (removed, update), result in zip(updates, outcomes):
+            if result["success"]:
+                audit("dedupe", space_id, update["type"], update["id"], "done", removed_references=removed)
+                counts["dedupe_done"] += 1
+            else:
+                audit("dedupe", space_id, update["type"], update["id"], "failed", removed_references=removed, error=result["error"])
+                logging.error(f"Failed to update {update['type']} with ID: {update['id']}. Error: {result['error']}")
+                counts["dedupe_failed"] += 1
+    console(f"{counts['scanned']} objects scanned in space: '{space_id}', {counts['with_duplicates']} with duplicate references"
+            + (f", {len(updates)} with exact copies to remove" if dedupe else ""))
+    return counts
+
+
+def main(kibana_url, headers, space_id, all_spaces=False, object_types=None, page_size=DEFAULT_PAGE_SIZE,
+         concurrency=DEFAULT_PAGE_CONCURRENCY, dedupe=False, dry_run=True, bulk_size=DEFAULT_BULK_SIZE, results_file=None):
+    timestamp = datetime.now().strftime("%Y_%m_%d-%H_%M_%S")
+    results_file = results_file or f"duplicate_references_{timestamp}.ndjson"
+    setup_logging(f"find_duplicate_references_{timestamp}.ndjson", audit_file=f"dedupe_audit_{timestamp}.ndjson" if dedupe else None)
+    space_ids = list_kibana_space_ids(headers, kibana_url) if all_spaces else [space_id]
+    if not space_ids:
+        logging.error("No space to scan")
+        sys.exit(1)
+    # Objects shared by several spaces are only reported once
+    shared_objects = SharedObjectRegistry()
+    counts = defaultdict(int)
+    with ScanResults(results_file) as results:
+        for scan_space_id in space_ids:
+            try:
+                space_counts = scan_space(kibana_url, headers, scan_space_id, results, object_types, page_size, concurrency, dedupe,
+                                          dry_run, bulk_size, shared_objects)
+            except Exception as e:
+                logging.error(f"Failed to scan space: '{scan_space_id}'. Error: {e}")
+                counts["failed_spaces"] += 1
+                continue
+            for key, count in space_counts.items():
+                counts[key] += count
+    console(f"{len(space_ids)} spaces scanned: {counts['scanned']} objects, {counts['with_duplicates']} with duplicate references. "
+            f"Results written to '{results_file}'")
+    for key in ("dedupe_done", "dedupe_failed", "dedupe_dry_run", "failed_spaces"):
+        if counts[key]:
+            console(f"  {key}: {counts[key]}")
+    flush_logging()
+    return counts
+
 
 if __name__ == "__main__":
-    scan_saved_objects()
+    parser = ArgumentParser(description='Find the saved objects referencing the same object more than once, in every type and space')
+    add_connection_arguments(parser)
+    parser.add_argument('--space_id', default='None', required=False)
+    parser.add_argument('--all_spaces', '--all-spaces', action='store_true', help='Scan every space of the cluster instead of --space_id')
+    parser.add_argument('--object_types', default=None, required=False, help='Comma-separated saved object types. Defaults to every type')
+    parser.add_argument('--page_size', type=int, default=DEFAULT_PAGE_SIZE, required=False)
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_PAGE_CONCURRENCY, required=False,
+                        help='Number of _find pages requested at the same time')
+    parser.add_argument('--results_file', default=None, required=False, help='NDJSON file of the objects with duplicate references')
+    parser.add_argument('--dedupe', action='store_true', help='Remove the exact copies (same name, type and id) from the references')
+    parser.add_argument('--dry_run', choices=['True', 'False', 'false'], default='True')
+    parser.add_argument('--bulk_size', type=int, default=DEFAULT_BULK_SIZE, required=False)
+    parser.add_argument('--metrics_file', default=None, required=False, help='Write the per-endpoint request metrics to this JSON file')
+
+    args = parser.parse_args()
+    if not args.all_spaces and args.space_id == 'None':
+        parser.error("one of the arguments --space_id or --all_spaces is required")
+    if 'None' in (args.kibana_url, args.api_key):
+        parser.error("the arguments --kibana_url and --api_key are required")
+    object_types = args.object_types.split(",") if args.object_types else OBJECT_TYPES
+
+    headers = configure_connection(args, args.concurrency)
+    try:
+        main(args.kibana_url, headers, args.space_id, args.all_spaces, object_types, args.page_size, args.concurrency, args.dedupe,
+             args.dry_run.lower() == 'true', args.bulk_size, args.results_file)
+    finally:
+        if args.metrics_file:
+            write_http_metrics(args.metrics_file)
@@ -1,13 +1,7 @@
+import logging
 import requests
 from argparse import ArgumentParser
-
-def get_headers(api_key):
-    headers = {
-        'kbn-xsrf': 'true',
-        'Content-Type': 'application/json',
-        'Authorization': f'ApiKey {api_key}'
-    }
-    return headers
+from http_client import get_http_client, get_headers
 
 def list_kibana_space_ids(headers, kibana_url):
     """Fetch all Kibana spaces and list only the space IDs."""
@@ -15,7 +9,7 @@ def list_kibana_space_ids(headers, kibana_url):
 
     try:
         # Send the GET request to the Kibana API
-        response = requests.get(kibana_space_url, headers=headers, verify=True)
+        response = get_http_client().get(kibana_space_url, headers=headers, verify=True)
         response.raise_for_status()
 
         # Parse the response JSON
@@ -26,7 +20,7 @@ def list_kibana_space_ids(headers, kibana_url):
         return space_ids
 
     except requests.exceptions.RequestException as e:
-        print(f"Error fetching Kibana spaces: {e}")
+        logging.error(f"Error fetching Kibana spaces: {e}")
         return []
 
 
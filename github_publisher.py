@@ -0,0 +1,108 @@
+import base64
+import logging
+import os
+import threading
+from http_client import get_http_client
+from structured_logging import console
+
+
+# Base URL of the GitHub REST API
+GITHUB_API_URL = "https://api.github.com"
+
+# Size of the pieces a file is read and base64-encoded in. A multiple of 3, so the pieces encode without padding.
+ENCODE_CHUNK_SIZE = 3 * 256 * 1024
+
+
+# Stream the JSON body of a blob creation request, base64-encoding the file piece by piece
+def iter_blob_payload(local_file_path):
+    yield b'{"encoding": "base64", "content": "'
+    with open(local_file_path, "rb") as file:
+        while True:
+            chunk = file.read(ENCODE_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield base64.b64encode(chunk)
+    yield b'"}'
+
+
+class GitHubArtifactPublisher:
+    """
+    Collects the files written by a run (exports, data view back-ups, the log file) and publishes them
+    to a new GitHub branch as a single commit, using the git data API: one blob per file, one tree,
+    one commit and one ref update. Files are streamed and encoded in pieces, never read whole into memory.
+
+    Args:
+        repo_url (str): The GitHub repository URL.
+        github_username (str): GitHub username.
+        github_key (str): GitHub account password or Personal Access Token.
+        github_branch (str): The branch the commit is published to. It is created if it doesn't exist.
+    """
+    def __init__(self, repo_url, github_username, github_key, github_branch):
+        self.repo_url = repo_url
+        self.github_branch = github_branch
+        self.auth = (github_username, github_key)
+        repo = repo_url.split("https://github.com/")[1]
+        self.api_url = f"{GITHUB_API_URL}/repos/{repo}"
+        self.base_commit_sha = None
+        self._artifacts = {}
+        self._lock = threading.Lock()
+
+    def _request(self, method, url, error_message, **kwargs):
+        response = get_http_client().request(method, url, auth=self.auth, **kwargs)
+        if response.status_code not in (200, 201):
+            logging.error(f"{error_message}: {response.status_code}, {response.text}")
+            raise Exception(f"{error_message}: {response.text}")
+        return response.json()
+
+    def prepare(self):
+        """Look up the commit the branch starts from. Fails early if the repository can't be reached."""
+        repo_info = self._request("GET", self.api_url, "Error retrieving repository info")
+        default_branch = repo_info.get("default_branch", "main")
+        default_branch_ref = self._request("GET", f"{self.api_url}/git/ref/heads/{default_branch}",
+                                           f"Error retrieving default branch '{default_branch}'")
+        self.base_commit_sha = default_branch_ref["object"]["sha"]
+        return self.base_commit_sha
+
+    # Add a local file to the commit. Adding the same repository path again replaces the file.
+    def add(self, local_file_path, repo_file_path=None):
+        with self._lock:
+            self._artifacts[repo_file_path or local_file_path] = local_file_path
+
+    def _create_blob(self, local_file_path):
+        blob = self._request("POST", f"{self.api_url}/git/blobs", f"Failed to upload file '{local_file_path}'",
+                             data=iter_blob_payload(local_file_path), headers={'Content-Type': 'application/json'})
+        return blob["sha"]
+
+    def publish(self, commit_message):
+        """Commit every collected file to the branch in one commit. Returns the commit SHA."""
+        with self._lock:
+            artifacts = {path: local for path, local in self._artifacts.items() if os.path.exists(local)}
+        if not artifacts:
+            logging.info("There are no files to upload to GitHub")
+            return None
+        if self.base_commit_sha is None:
+            self.prepare()
+
+        base_commit = self._request("GET", f"{self.api_url}/git/commits/{self.base_commit_sha}", "Error retrieving the base commit")
+        tree = []
+        for repo_file_path, local_file_path in sorted(artifacts.items()):
+            tree.append({"path": repo_file_path, "mode": "100644", "type": "blob", "sha": self._create_blob(local_file_path)})
+        new_tree = self._request("POST", f"{self.api_url}/git/trees", "Failed to create the tree",
+                                 json={"base_tree": base_commit["tree"]["sha"], "tree": tree})
+        commit = self._request("POST", f"{self.api_url}/git/commits", "Failed to create the commit",
+                               json={"message": commit_message, "tree": new_tree["sha"], "parents": [self.base_commit_sha]})
+
+        # Point the branch at the new commit, creating the branch on the first publish
+        if get_http_client().get(f"{self.api_url}/git/ref/heads/{self.github_branch}", auth=self.auth).status_code == 200:
+            self._request("PATCH", f"{self.api_url}/git/refs/heads/{self.github_branch}", "Failed to update branch",
+                          json={"sha": commit["sha"]})
+        else:
+            self._request("POST", f"{self.api_url}/git/refs", "Failed to create branch",
+                          json={"ref": f"refs/heads/{self.github_branch}", "sha": commit["sha"]})
+        self.base_commit_sha = commit["sha"]
+        with self._lock:
+            # The next publish builds on this commit, so only files added from now on need to be uploaded
+            for repo_file_path in artifacts:
+                self._artifacts.pop(repo_file_path, None)
+        console(f"{len(tree)} files successfully uploaded to '{self.repo_url}' on branch '{self.github_branch}' in commit {commit['sha']}.")
+        return commit["sha"]
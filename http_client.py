@@ -0,0 +1,255 @@
+import logging
+import threading
+import time
+import types
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from http_metrics import HttpMetrics
+from request_controller import RequestController, DEFAULT_MAX_RETRIES
+
+
+# Number of keep-alive connections kept open per host
+DEFAULT_POOL_SIZE = 10
+
+# (connect, read) timeout in seconds. Exports of large spaces can take minutes to be sent back.
+DEFAULT_TIMEOUT = (10, 300)
+
+# Query parameters that set how much work a request is, e.g. the types, fields and page size of a _find page
+SHAPE_PARAMS = ("type", "fields", "per_page")
+
+
+# Set up headers for Kibana authentication
+def get_headers(api_key):
+    headers = {
+        'kbn-xsrf': 'true',
+        'Content-Type': 'application/json',
+        'Authorization': f'ApiKey {api_key}'
+    }
+    return headers
+
+
+class HttpClient:
+    """
+    HTTP client shared by every Kibana and GitHub call of a run.
+
+    One requests.Session is kept per host (scheme and port included), so TLS connections are reused
+    with keep-alive across all the calls to that host instead of a new handshake for every request.
+    Responses are requested gzip-compressed.
+
+    Each host also gets a RequestController, which retries throttled and failed requests with backoff and
+    lowers the number of requests sent to the host at the same time when it is overloaded.
+
+    Every attempt is recorded in metrics (an HttpMetrics): endpoint, status, latency, retries and the bytes
+    sent and received. A streamed response is recorded once the caller closes it, when it was fully read.
+
+    Args:
+        pool_size (int): Number of connections kept open per host. Should be at least the number of
+            requests sent at the same time. It is also the most requests sent to a host at the same time.
+        timeout (tuple): Default (connect, read) timeout in seconds for every request.
+        max_retries (int): Number of retries of a throttled or failed request.
+    """
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, max_retries=DEFAULT_MAX_RETRIES):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self._sessions = {}
+        self._controllers = {}
+        self._lock = threading.Lock()
+        self.metrics = HttpMetrics()
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive'
+        })
+        return session
+
+    # Get the pooled session of the url's host, creating it on first use
+    def session(self, url):
+        host = host_of(url)
+        with self._lock:
+            if host not in self._sessions:
+                self._sessions[host] = self._new_session()
+            return self._sessions[host]
+
+    # Get the request controller of the url's host, creating it on first use
+    def controller(self, url):
+        host = host_of(url)
+        with self._lock:
+            if host not in self._controllers:
+                self._controllers[host] = RequestController(self.pool_size, self.max_retries)
+            return self._controllers[host]
+
+    def request(self, method, url, idempotent=None, **kwargs):
+        """
+        Send a request, retrying it when it is throttled or fails (see RequestController).
+        idempotent overrides whether the request may be sent again after a connection error or a 502/504,
+        e.g. for a POST that only reads.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        # A streamed request body can only be sent once
+        replayable = not isinstance(kwargs.get("data"), types.GeneratorType)
+        return self.controller(url).send(method, url, lambda attempt: self._send(method, url, attempt, **kwargs),
+                                         idempotent, replayable, request_shape(kwargs))
+
+    def _send(self, method, url, attempt, **kwargs):
+        bytes_sent = [0]
+        if isinstance(kwargs.get("data"), types.GeneratorType):
+            # A streamed request body is counted as it is sent
+            kwargs["data"] = count_bytes(kwargs["data"], bytes_sent)
+        # Each attempt after the first one is one retry, so that the metrics add up to the number of retries
+        retry = 1 if attempt else 0
+        start = time.perf_counter()
+        try:
+            response = self.session(url).request(method, url, **kwargs)
+        except requests.RequestException as e:
+            self.metrics.record(method, url, type(e).__name__, time.perf_counter() - start, retry, bytes_sent=bytes_sent[0])
+            raise
+        if isinstance(response.request.body, (bytes, str)):
+            bytes_sent[0] = len(response.request.body)
+
+        def record():
+            self.metrics.record(method, url, response.status_code, time.perf_counter() - start, retry + retries_of(response),
+                                bytes_sent[0], received_bytes(response))
+
+        if kwargs.get("stream"):
+            close = response.close
+
+            def close_and_record():
+                close()
+                if not getattr(response, "_recorded", False):
+                    response._recorded = True
+                    record()
+            response.close = close_and_record
+        else:
+            record()
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    # Retries and concurrency limits of each host the client sent requests to
+    def controller_summary(self):
+        with self._lock:
+            controllers = dict(self._controllers)
+        return {host: {"retries": controller.retries, "concurrency_limit": int(controller.concurrency.limit),
+                       "lowest_concurrency_limit": int(controller.concurrency.lowest_limit)}
+                for host, controller in controllers.items()}
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+
+# Shape of a request, so that its latency is only compared with the requests of the same endpoint doing about as much work
+def request_shape(kwargs):
+    """
+    Returns:
+        tuple: The SHAPE_PARAMS of the query, and for a JSON list body (_bulk_update) or a list of objects (_export
+            by objects) the power of 2 of their number. None when the size of the request isn't known up front,
+            e.g. the export of every object of some types, or a streamed body.
+    """
+    if kwargs.get("data") is not None:
+        return None
+    params = kwargs.get("params") or ()
+    params = params.items() if isinstance(params, dict) else params
+    shape = tuple(sorted((key, str(value)) for key, value in params if key in SHAPE_PARAMS))
+    payload = kwargs.get("json")
+    if isinstance(payload, list):
+        return shape + (("items", len(payload).bit_length()),)
+    if isinstance(payload, dict):
+        if not isinstance(payload.get("objects"), list):
+            return None
+        return shape + (("objects", len(payload["objects"]).bit_length()),)
+    return shape
+
+
+# Scheme, host and port of a url
+def host_of(url):
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+# Pass chunks of a request body through, adding their size to counter[0]
+def count_bytes(chunks, counter):
+    for chunk in chunks:
+        counter[0] += len(chunk)
+        yield chunk
+
+
+# Number of times urllib3 retried the request, when the session's adapter retries
+def retries_of(response):
+    retries = getattr(response.raw, "retries", None)
+    return len(retries.history) if retries is not None else 0
+
+
+# Bytes of the response body read from the wire (compressed size when the response was compressed)
+def received_bytes(response):
+    try:
+        return response.raw.tell()
+    except (AttributeError, ValueError):
+        return len(response.content or b"")
+
+
+_http_client = None
+
+
+# Get the client shared by the whole process
+def get_http_client():
+    global _http_client
+    if _http_client is None:
+        _http_client = HttpClient()
+    return _http_client
+
+
+# Replace the shared client, e.g. to change the pool size or timeouts from the command line
+def configure_http_client(pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, max_retries=DEFAULT_MAX_RETRIES):
+    global _http_client
+    if _http_client is not None:
+        _http_client.close()
+    _http_client = HttpClient(pool_size=pool_size, timeout=timeout, max_retries=max_retries)
+    return _http_client
+
+
+# Add the Kibana connection parameters every script of the repo takes: URL, API key and HTTP client settings
+def add_connection_arguments(parser):
+    parser.add_argument('--kibana_url', default='None', required=False)
+    parser.add_argument('--api_key', default='None', required=False)
+    parser.add_argument('--pool_size', type=int, default=DEFAULT_POOL_SIZE, required=False)
+    parser.add_argument('--timeout', type=int, default=DEFAULT_TIMEOUT[1], required=False)
+    parser.add_argument('--max_retries', type=int, default=DEFAULT_MAX_RETRIES, required=False)
+
+
+# Configure the shared client from the connection parameters and return the headers of the Kibana requests
+def configure_connection(args, pool_size=None):
+    configure_http_client(pool_size=max(args.pool_size, pool_size or 0), timeout=(DEFAULT_TIMEOUT[0], args.timeout),
+                          max_retries=args.max_retries)
+    return get_headers(args.api_key)
+
+
+# Write the request metrics of the shared client as a JSON report and, optionally, a Prometheus textfile
+def write_http_metrics(json_file, prometheus_file=None, labels=None):
+    metrics = get_http_client().metrics
+    metrics.write_json(json_file)
+    if prometheus_file:
+        metrics.write_prometheus(prometheus_file, labels)
+    logging.info(f"HTTP request metrics written to '{json_file}'" + (f" and '{prometheus_file}'" if prometheus_file else ""))
+    for host, summary in get_http_client().controller_summary().items():
+        logging.info(f"{host}: {summary['retries']} retries, concurrency limit {summary['concurrency_limit']} "
+                     f"(lowest {summary['lowest_concurrency_limit']})")
@@ -0,0 +1,143 @@
+import json
+import os
+import re
+import threading
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+
+# Path segments that vary from call to call (ids, SHAs, branch names) are replaced to group calls by endpoint
+ENDPOINT_PATTERNS = [
+    (re.compile(r"^/s/[^/]+"), ""),
+    (re.compile(r"^(/api/saved_objects/)(?!_)[^/]+/[^/]+$"), r"\1{type}/{id}"),
+    (re.compile(r"^(/api/data_views/data_view/)[^/]+$"), r"\1{id}"),
+    (re.compile(r"^/repos/[^/]+/[^/]+"), "/repos/{owner}/{repo}"),
+    (re.compile(r"(/git/commits/)[^/]+$"), r"\1{sha}"),
+    (re.compile(r"(/git/refs?/heads/).+$"), r"\1{branch}"),
+]
+
+# Latency quantiles of the summaries
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+# Group a request under its endpoint: (method and path template, Kibana space or '' for non-Kibana calls)
+def endpoint_of(method, url):
+    path = urlsplit(url).path
+    space_match = re.match(r"^/s/([^/]+)", path)
+    space_id = space_match.group(1) if space_match else ("default" if path.startswith("/api/") else "")
+    for pattern, replacement in ENDPOINT_PATTERNS:
+        path = pattern.sub(replacement, path)
+    return f"{method} {path}", space_id
+
+
+def quantile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+
+class HttpMetrics:
+    """
+    Collects one record per HTTP call (endpoint, space, status, latency, retries, bytes sent and received)
+    and summarizes them per endpoint and space, as a JSON report and as a Prometheus textfile-collector file.
+    Safe to use from several threads.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = defaultdict(lambda: {"statuses": defaultdict(int), "latencies": [], "retries": 0,
+                                           "bytes_sent": 0, "bytes_received": 0})
+
+    def record(self, method, url, status, latency, retries=0, bytes_sent=0, bytes_received=0):
+        key = endpoint_of(method, url)
+        with self._lock:
+            calls = self._calls[key]
+            calls["statuses"][str(status)] += 1
+            calls["latencies"].append(latency)
+            calls["retries"] += retries
+            calls["bytes_sent"] += bytes_sent
+            calls["bytes_received"] += bytes_received
+
+    def reset(self):
+        with self._lock:
+            self._calls.clear()
+
+    def summary(self):
+        """List of per endpoint and space summaries, with the latency percentiles in seconds."""
+        with self._lock:
+            items = [(key, dict(calls, statuses=dict(calls["statuses"]), latencies=sorted(calls["latencies"])))
+                     for key, calls in self._calls.items()]
+        summary = []
+        for (endpoint, space_id), calls in sorted(items):
+            latencies = calls["latencies"]
+            summary.append({
+                "endpoint": endpoint,
+                "space_id": space_id,
+                "requests": len(latencies),
+                "statuses": calls["statuses"],
+                "errors": sum(count for status, count in calls["statuses"].items() if not status.isdigit() or int(status) >= 400),
+                "retries": calls["retries"],
+                "bytes_sent": calls["bytes_sent"],
+                "bytes_received": calls["bytes_received"],
+                "latency_seconds": dict({f"p{int(q * 100)}": round(quantile(latencies, q), 4) for q in QUANTILES},
+                                        max=round(latencies[-1], 4) if latencies else 0.0,
+                                        sum=round(sum(latencies), 4))
+            })
+        return summary
+
+    def write_json(self, file_name):
+        summary = self.summary()
+        report = {
+            "requests": sum(item["requests"] for item in summary),
+            "errors": sum(item["errors"] for item in summary),
+            "bytes_sent": sum(item["bytes_sent"] for item in summary),
+            "bytes_received": sum(item["bytes_received"] for item in summary),
+            "endpoints": summary
+        }
+        with open(file_name, "w") as file:
+            json.dump(report, file, indent=2)
+        return file_name
+
+    def write_prometheus(self, file_name, labels=None):
+        """
+        Write the summary in the Prometheus text format, for the node exporter's textfile collector.
+        The file is written under a temporary name and renamed, so the collector never reads half a file.
+        """
+        labels = labels or {}
+        lines = [
+            "# HELP kibana_cleanup_http_requests_total HTTP requests sent, by endpoint, space and status.",
+            "# TYPE kibana_cleanup_http_requests_total counter",
+        ]
+        summary = self.summary()
+
+        def label_string(item, **extra):
+            all_labels = dict(labels, endpoint=item["endpoint"], space=item["space_id"], **extra)
+            return ",".join(f'{name}="{escape_label(value)}"' for name, value in all_labels.items())
+
+        for item in summary:
+            for status, count in sorted(item["statuses"].items()):
+                lines.append(f"kibana_cleanup_http_requests_total{{{label_string(item, status=status)}}} {count}")
+        lines += ["# HELP kibana_cleanup_http_request_duration_seconds HTTP request latency, by endpoint and space.",
+                  "# TYPE kibana_cleanup_http_request_duration_seconds summary"]
+        for item in summary:
+            for q in QUANTILES:
+                value = item["latency_seconds"][f"p{int(q * 100)}"]
+                lines.append(f"kibana_cleanup_http_request_duration_seconds{{{label_string(item, quantile=str(q))}}} {value}")
+            lines.append(f"kibana_cleanup_http_request_duration_seconds_sum{{{label_string(item)}}} {item['latency_seconds']['sum']}")
+            lines.append(f"kibana_cleanup_http_request_duration_seconds_count{{{label_string(item)}}} {item['requests']}")
+        for metric, field, help_text in (("retries", "retries", "HTTP request retries"),
+                                         ("bytes_sent", "bytes_sent", "HTTP request body bytes sent"),
+                                         ("bytes_received", "bytes_received", "HTTP response body bytes received")):
+            lines += [f"# HELP kibana_cleanup_http_{metric}_total {help_text}, by endpoint and space.",
+                      f"# TYPE kibana_cleanup_http_{metric}_total counter"]
+            for item in summary:
+                lines.append(f"kibana_cleanup_http_{metric}_total{{{label_string(item)}}} {item[field]}")
+
+        temporary_file = f"{file_name}.tmp"
+        with open(temporary_file, "w") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(temporary_file, file_name)
+        return file_name
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
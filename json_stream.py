@@ -0,0 +1,123 @@
+import codecs
+import json
+
+
+# Size of the pieces a streamed HTTP response body is read in
+STREAM_CHUNK_SIZE = 64 * 1024
+
+JSON_WHITESPACE = " \t\n\r"
+
+# Characters that can follow a complete number, true, false or null
+JSON_DELIMITERS = ",]}:" + JSON_WHITESPACE
+
+_decoder = json.JSONDecoder()
+
+
+class JsonStreamReader:
+    """
+    Reads JSON values one at a time from a stream of byte chunks (e.g. response.iter_content()).
+
+    Only the part of the stream that was not read yet is kept in memory, so the memory used is about the size of
+    the largest single value read, whatever the size of the whole document. Values are decoded by the json module,
+    and the buffer is at least doubled each time a value doesn't fit in it yet, so large values are decoded in a
+    bounded number of tries.
+
+    Args:
+        chunks (iterable): Pieces of UTF-8 encoded JSON.
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.position = 0
+        self.eof = False
+
+    # Drop the part of the buffer already read, then read chunks until at least minimum more characters are buffered
+    def _read_more(self, minimum=1):
+        self.buffer = self.buffer[self.position:]
+        self.position = 0
+        target = len(self.buffer) + max(minimum, 1)
+        while len(self.buffer) < target and not self.eof:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self.buffer += self._text_decoder.decode(b"", final=True)
+                self.eof = True
+            else:
+                self.buffer += self._text_decoder.decode(chunk)
+
+    def peek(self):
+        """The next character that is not whitespace, without reading it."""
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in JSON_WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if self.eof:
+                raise json.JSONDecodeError("Unexpected end of the JSON stream", self.buffer, self.position)
+            self._read_more()
+
+    def expect(self, character):
+        if self.peek() != character:
+            raise json.JSONDecodeError(f"Expecting '{character}'", self.buffer, self.position)
+        self.position += 1
+
+    # Read the separator after a member or an item, if there is one
+    def skip_comma(self):
+        if self.peek() == ",":
+            self.position += 1
+
+    def value(self):
+        """Read and decode the next JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.position)
+                # A number, true, false or null is only complete when followed by a delimiter: '1.' or '1e' cut by the
+                # end of a chunk is decoded as 1, but may go on in the next chunk. Objects, arrays and strings end with
+                # their own closing character.
+                complete = self.buffer[self.position] in '{["' or (end < len(self.buffer) and self.buffer[end] in JSON_DELIMITERS)
+                if complete or self.eof:
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._read_more(len(self.buffer) - self.position)
+
+
+def iter_json_array(chunks, array_key, header=None):
+    """
+    Generator that yields the items of one array member of a JSON object, one at a time, as the object is streamed.
+
+    For a _find response, iter_json_array(chunks, "saved_objects", header) yields one saved object at a time
+    and never holds the whole page. The other members of the object (page, per_page, total...) are decoded and
+    put in header as they are read: Kibana sends them before the saved objects, so they are known by the time
+    the first object is yielded.
+
+    Args:
+        chunks (iterable): Pieces of the UTF-8 encoded JSON object.
+        array_key (str): Key of the array whose items are yielded.
+        header (dict): Optional dict the other members of the object are put in.
+    """
+    reader = JsonStreamReader(chunks)
+    header = {} if header is None else header
+    reader.expect("{")
+    while reader.peek() != "}":
+        key = reader.value()
+        reader.expect(":")
+        if key == array_key and reader.peek() == "[":
+            reader.expect("[")
+            while reader.peek() != "]":
+                yield reader.value()
+                reader.skip_comma()
+            reader.expect("]")
+        else:
+            header[key] = reader.value()
+        reader.skip_comma()
+    reader.expect("}")
+
+
+# Stream the items of one array member of a JSON response (requested with stream=True), closing the response at the end
+def iter_response_array(response, array_key, header=None):
+    with response:
+        yield from iter_json_array(response.iter_content(STREAM_CHUNK_SIZE), array_key, header)
@@ -0,0 +1,529 @@
+import gzip
+import itertools
+import json
+import logging
+import os
+import re
+import threading
+from collections import defaultdict
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from reference_index import ReferenceIndex
+from object_table import ObjectTable
+from http_client import get_http_client
+from json_stream import iter_response_array, STREAM_CHUNK_SIZE
+
+
+# Saved object types that are searched for data view references
+OBJECT_TYPES = ["config", "config-global", "url", "index-pattern", "action", "query", "tag", "graph-workspace",
+                "alert", "search", "visualization", "event-annotation-group", "dashboard", "lens", "cases",
+                "metrics-data-source", "links", "canvas-element", "canvas-workpad", "osquery-saved-query",
+                "osquery-pack", "csp-rule-template", "map", "infrastructure-monitoring-log-view",
+                "threshold-explorer-view", "uptime-dynamic-settings", "synthetics-privates-locations", "apm-indices",
+                "infrastructure-ui-source", "inventory-view", "infra-custom-dashboards", "metrics-explorer-view",
+                "apm-service-group", "apm-custom-dashboards"]
+
+
+# Number of objects requested per _find page
+DEFAULT_PAGE_SIZE = 1000
+
+# Number of saved object types sent in one _find request
+DEFAULT_TYPES_PER_REQUEST = 10
+
+# Number of objects sent in one _bulk_update request
+DEFAULT_BULK_SIZE = 100
+
+# Number of referenced ids sent in one has_reference _find query
+DEFAULT_IDS_PER_REQUEST = 50
+
+# Number of _find pages requested at the same time by iter_saved_object_pages
+DEFAULT_PAGE_CONCURRENCY = 4
+
+# Number of spaces processed at the same time with --all_spaces
+DEFAULT_SPACE_WORKERS = 4
+
+# Kibana refuses _find pages beyond the index's max_result_window (10,000 by default)
+MAX_RESULT_WINDOW = 10000
+
+# Fields of a saved object kept in the state file of an incremental snapshot
+SNAPSHOT_STATE_FIELDS = ("type", "id", "version", "updated_at", "namespaces", "references")
+
+
+# Query parameters of a _find request
+def find_params(object_types, page, page_size, fields=("references",), sort_field=None, has_reference=None, updated_since=None):
+    params = [('type', object_type) for object_type in object_types]
+    params += [('fields', field) for field in fields]
+    params += [('page', page), ('per_page', page_size)]
+    if sort_field:
+        params.append(('sort_field', sort_field))
+        params.append(('sort_order', 'asc'))
+    if updated_since:
+        # Only the objects changed since the given time are returned by Kibana
+        params.append(('filter', " or ".join(f'{object_type}.updated_at >= "{updated_since}"' for object_type in object_types)))
+    if has_reference:
+        # Only the objects referencing any of these objects are returned by Kibana
+        params.append(('has_reference', json.dumps(has_reference)))
+        params.append(('has_reference_operator', 'OR'))
+    return params
+
+
+# Request a single page of saved objects from the _find API
+def find_saved_objects_page(kibana_url, space_id, headers, object_types, page, page_size, fields=("references",), sort_field=None,
+                            has_reference=None, updated_since=None):
+    objects_endpoint = f"{kibana_url}/s/{space_id}/api/saved_objects/_find"
+    params = find_params(object_types, page, page_size, fields, sort_field, has_reference, updated_since)
+    response = get_http_client().get(objects_endpoint, headers=headers, params=params, verify=True)
+    response.raise_for_status()
+    return response.json()
+
+
+def iter_saved_objects_page(kibana_url, space_id, headers, object_types, page, page_size, fields=("references",), sort_field=None,
+                            has_reference=None, updated_since=None, header=None):
+    """
+    Generator that streams a single page of saved objects from the _find API and yields them one at a time,
+    as they are parsed from the response, so the page is never held in memory as a whole.
+    The page, per_page and total of the response are put in header.
+    """
+    objects_endpoint = f"{kibana_url}/s/{space_id}/api/saved_objects/_find"
+    params = find_params(object_types, page, page_size, fields, sort_field, has_reference, updated_since)
+    response = get_http_client().get(objects_endpoint, headers=headers, params=params, verify=True, stream=True)
+    if not response.ok:
+        response.close()
+        response.raise_for_status()
+    yield from iter_response_array(response, "saved_objects", header)
+
+
+# Stream saved objects of the given types from the _export API, which pages through them on the Kibana side
+def iter_exported_objects(kibana_url, space_id, headers, object_types, fields=("references",)):
+    export_objects_endpoint = f"{kibana_url}/s/{space_id}/api/saved_objects/_export"
+    payload = {
+        "type": list(object_types),
+        "includeReferencesDeep": False,
+        "excludeExportDetails": False
+    }
+    with get_http_client().post(export_objects_endpoint, headers=headers, json=payload, stream=True,
+                                  idempotent=True) as response:
+        response.raise_for_status()
+        for line in response.iter_lines(STREAM_CHUNK_SIZE):
+            if not line:
+                continue
+            object = json.loads(line)
+            if "exportedCount" in object:
+                # The last line of an export is a summary of the export, not a saved object
+                if object.get("missingRefCount"):
+                    logging.warning(f"Export of {object_types} reported {object['missingRefCount']} missing references")
+                continue
+            if fields:
+                attributes = object.get("attributes", {})
+                object["attributes"] = {field: attributes[field] for field in fields if field in attributes}
+            yield object
+
+
+# Yield the saved objects of one group of types, splitting the group when it exceeds the _find result window
+def iter_type_group(kibana_url, space_id, headers, type_group, page_size, fields=("references",), sort_field=None,
+                    has_reference=None, updated_since=None):
+    page_size = min(page_size, MAX_RESULT_WINDOW)
+    header = {}
+    objects = iter_saved_objects_page(kibana_url, space_id, headers, type_group, 1, page_size, fields, sort_field, has_reference,
+                                      updated_since, header)
+    # Reading the first object reads the total, which Kibana sends before the objects
+    first_objects = list(itertools.islice(objects, 1))
+    if "total" not in header:
+        first_objects += list(objects)
+    total = header.get("total", 0)
+    if total > MAX_RESULT_WINDOW:
+        # The rest of the page is not needed
+        objects.close()
+        if len(type_group) > 1:
+            logging.info(f"{total} objects of types {type_group} exceed the _find result window. Fetching them one type at a time...")
+            for object_type in type_group:
+                yield from iter_type_group(kibana_url, space_id, headers, [object_type], page_size, fields, sort_field,
+                                           has_reference, updated_since)
+            return
+        logging.info(f"{total} objects of type '{type_group[0]}' exceed the _find result window. Streaming them from the _export API...")
+        exported_count = 0
+        referenced = {(ref["type"], ref["id"]) for ref in has_reference or []}
+        for object in iter_exported_objects(kibana_url, space_id, headers, type_group, fields):
+            exported_count += 1
+            # _export has no has_reference or updated_at filter, so they are applied here
+            if updated_since and object.get("updated_at", "") < updated_since:
+                continue
+            if not referenced or any((ref["type"], ref["id"]) in referenced for ref in object.get("references", [])):
+                yield object
+        if exported_count < total:
+            logging.warning(f"Only {exported_count} of {total} objects of type '{type_group[0]}' could be exported. "
+                            f"Raise 'savedObjects.maxImportExportSize' in kibana.yml to retrieve all of them")
+        return
+
+    page = 1
+    objects = itertools.chain(first_objects, objects)
+    while True:
+        page_count = 0
+        for object in objects:
+            page_count += 1
+            yield object
+        if not page_count or page * page_size >= total:
+            break
+        page += 1
+        objects = iter_saved_objects_page(kibana_url, space_id, headers, type_group, page, page_size, fields, sort_field,
+                                          has_reference, updated_since)
+
+
+def iter_saved_objects(kibana_url, space_id, headers, object_types=None, page_size=DEFAULT_PAGE_SIZE,
+                       types_per_request=DEFAULT_TYPES_PER_REQUEST, fields=("references",), sort_field=None,
+                       concurrency=1, has_reference=None, updated_since=None):
+    """
+    Generator that pages through the _find API and yields saved objects as each page arrives.
+
+    Several types are requested together to save round trips. When a group of types holds more objects than
+    Kibana lets _find page through (MAX_RESULT_WINDOW), the group is split into single types, and a single
+    type that is still too large is streamed from the _export API instead, so nothing is silently truncated.
+    Only one page is held in memory at a time.
+
+    With a concurrency above 1, every type is fetched as its own task in a pool of that many threads, so the
+    wall-clock time is close to that of the slowest type. The objects are still yielded in the order of
+    object_types, but each type's objects are held in memory until it is its turn to be yielded.
+
+    Args:
+        kibana_url (str): The Kibana URL.
+        space_id (str): The Kibana space to read from.
+        headers (dict): Headers used to authenticate to Kibana.
+        object_types (list): Saved object types to fetch. Defaults to OBJECT_TYPES.
+        page_size (int): Number of objects per _find page.
+        types_per_request (int): Number of types sent in one _find request.
+        fields (tuple): Attributes to return for each object. References are always returned.
+        sort_field (str): Optional field to sort the objects by.
+        concurrency (int): Number of types fetched at the same time.
+        has_reference (list): Optional {"type", "id"} objects. Only the objects referencing any of them are returned.
+        updated_since (str): Optional ISO timestamp. Only the objects updated at or after that time are returned.
+    """
+    object_types = list(object_types or OBJECT_TYPES)
+    if concurrency > 1:
+        def fetch_type(object_type):
+            return list(iter_type_group(kibana_url, space_id, headers, [object_type], page_size, fields, sort_field,
+                                        has_reference, updated_since))
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            # executor.map returns the results in the order of object_types, whichever type finishes first
+            for objects in executor.map(fetch_type, object_types):
+                yield from objects
+        return
+
+    for i in range(0, len(object_types), types_per_request):
+        yield from iter_type_group(kibana_url, space_id, headers, object_types[i:i + types_per_request],
+                                   page_size, fields, sort_field, has_reference, updated_since)
+
+
+def iter_saved_object_pages(kibana_url, space_id, headers, object_types=None, page_size=DEFAULT_PAGE_SIZE, fields=("references",),
+                            concurrency=DEFAULT_PAGE_CONCURRENCY):
+    """
+    Generator that yields the saved objects of every type a page at a time, with up to concurrency _find pages
+    requested at the same time across all the types.
+
+    The objects of each type are counted first, then every page of every type is a task of a pool of concurrency
+    threads. Pages are yielded as they arrive, so the objects come in no particular order, and at most
+    2 x concurrency pages are held in memory whatever the size of the space. A type holding more objects than the
+    _find result window is streamed on its own afterwards by iter_type_group (from the _export API).
+
+    Yields:
+        list: The saved objects of one page.
+    """
+    object_types = list(object_types or OBJECT_TYPES)
+    page_size = min(page_size, MAX_RESULT_WINDOW)
+
+    def fetch_page(object_type, page):
+        return list(iter_saved_objects_page(kibana_url, space_id, headers, [object_type], page, page_size, fields))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        totals = dict(zip(object_types, executor.map(
+            lambda object_type: count_saved_objects(kibana_url, space_id, headers, [object_type]), object_types)))
+        pages = ((object_type, page) for object_type, total in totals.items() if total <= MAX_RESULT_WINDOW
+                 for page in range(1, -(-total // page_size) + 1))
+        in_flight = set()
+        while True:
+            # The next pages are requested while the ones that arrived are processed, but no further ahead
+            for object_type, page in itertools.islice(pages, 2 * concurrency - len(in_flight)):
+                in_flight.add(executor.submit(fetch_page, object_type, page))
+            if not in_flight:
+                break
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+    for object_type in (object_type for object_type, total in totals.items() if total > MAX_RESULT_WINDOW):
+        objects = iter_type_group(kibana_url, space_id, headers, [object_type], page_size, fields)
+        while True:
+            page = list(itertools.islice(objects, page_size))
+            if not page:
+                break
+            yield page
+
+
+# Count the saved objects of the given types without fetching them
+def count_saved_objects(kibana_url, space_id, headers, object_types):
+    return find_saved_objects_page(kibana_url, space_id, headers, object_types, 1, 0).get("total", 0)
+
+
+# Count the saved objects referencing an object (e.g. a data view), straight from Kibana
+def count_objects_referencing(kibana_url, space_id, headers, referenced_id, ref_type="index-pattern", object_types=None,
+                              types_per_request=DEFAULT_TYPES_PER_REQUEST):
+    object_types = list(object_types or OBJECT_TYPES)
+    has_reference = [{"type": ref_type, "id": referenced_id}]
+    return sum(find_saved_objects_page(kibana_url, space_id, headers, object_types[i:i + types_per_request], 1, 0,
+                                       has_reference=has_reference).get("total", 0)
+               for i in range(0, len(object_types), types_per_request))
+
+
+def iter_objects_referencing(kibana_url, space_id, headers, referenced_ids, ref_type="index-pattern", object_types=None,
+                             ids_per_request=DEFAULT_IDS_PER_REQUEST, **kwargs):
+    """
+    Generator that yields only the saved objects referencing any of the given ids (e.g. duplicate data view ids).
+
+    The filtering is pushed down to Kibana with the _find has_reference query, so the transfer size scales with the
+    number of referencing objects rather than the size of the space. The ids are sent in chunks of ids_per_request,
+    and an object referencing ids of several chunks is yielded once.
+
+    Args:
+        kibana_url (str): The Kibana URL.
+        space_id (str): The Kibana space to read from.
+        headers (dict): Headers used to authenticate to Kibana.
+        referenced_ids (list): Ids of the referenced objects.
+        ref_type (str): Saved object type of the referenced objects.
+        object_types (list): Saved object types to search. Defaults to OBJECT_TYPES.
+        ids_per_request (int): Number of referenced ids sent in one query.
+        **kwargs: Passed on to iter_saved_objects (page_size, concurrency...).
+    """
+    referenced_ids = list(referenced_ids)
+    seen_objects = set()
+    for i in range(0, len(referenced_ids), ids_per_request):
+        has_reference = [{"type": ref_type, "id": referenced_id} for referenced_id in referenced_ids[i:i + ids_per_request]]
+        for object in iter_saved_objects(kibana_url, space_id, headers, object_types, has_reference=has_reference, **kwargs):
+            if (object["type"], object["id"]) not in seen_objects:
+                seen_objects.add((object["type"], object["id"]))
+                yield object
+
+
+# Entry of a _bulk_update request replacing the references of an object and, optionally, some of its top-level attributes
+def bulk_update_entry(object, references, attributes=None):
+    update = {"type": object["type"], "id": object["id"], "attributes": attributes or {}, "references": references}
+    if object.get("version"):
+        # Kibana rejects the update if the object was changed since it was read
+        update["version"] = object["version"]
+    return update
+
+
+def bulk_update_saved_objects(kibana_url, space_id, headers, updates, batch_size=DEFAULT_BULK_SIZE):
+    """
+    Generator that sends saved object updates to the _bulk_update API in batches and yields the outcome of each object.
+
+    Args:
+        kibana_url (str): The Kibana URL.
+        space_id (str): The Kibana space of the objects.
+        headers (dict): Headers used to authenticate to Kibana.
+        updates (list): Updates as accepted by _bulk_update, e.g. {"type", "id", "attributes", "references", "version"}.
+        batch_size (int): Number of objects sent per request.
+
+    Yields:
+        dict: {"type", "id", "success", "error"} for every update, in the order of updates.
+    """
+    bulk_update_endpoint = f"{kibana_url}/s/{space_id}/api/saved_objects/_bulk_update"
+    for i in range(0, len(updates), batch_size):
+        batch = updates[i:i + batch_size]
+        response = get_http_client().put(bulk_update_endpoint, headers=headers, json=batch, stream=True)
+        if response.status_code != 200:
+            # The whole batch was rejected, so every object of the batch failed
+            error = f"Status code: {response.status_code}, Response: {response.text}"
+            response.close()
+            for update in batch:
+                yield {"type": update["type"], "id": update["id"], "success": False, "error": error}
+            continue
+        # The updated objects are parsed one at a time from the response
+        saved_objects = iter_response_array(response, "saved_objects")
+        for update, saved_object in zip(batch, saved_objects):
+            error = saved_object.get("error")
+            yield {"type": update["type"], "id": update["id"], "success": error is None,
+                   "error": error.get("message") if error else None}
+        saved_objects.close()
+
+
+# Path of the incremental snapshot state of a space. Every cluster has a 'default' space, so the Kibana host is part of the name.
+def snapshot_state_file(state_dir, kibana_url, space_id):
+    parts = urlsplit(kibana_url)
+    host = re.sub(r"[^\w.-]", "_", f"{parts.netloc}{parts.path}".rstrip("/"))
+    return os.path.join(state_dir, f"snapshot_{host}_{space_id}.json.gz")
+
+
+class SavedObjectSnapshot:
+    """
+    Run-scoped snapshot of the saved objects in a Kibana space.
+
+    Every object type is fetched from the _find API once, the first time the snapshot is used,
+    and the same objects are then shared by every stage of the run (counting, updating, reviewing
+    and the delete checks). Call refresh() after writing to Kibana to pick up the changes. The objects
+    are kept in a compact ObjectTable as the pages arrive, and the rest of each _find object is dropped.
+
+    When referenced_ids is given, only the objects referencing those data views are fetched (see
+    iter_objects_referencing), which is all the counting, updating and delete checks need.
+
+    When state_file is given, the snapshot is incremental: the type, id, version, updated_at and references
+    of every object are saved to the file after each load, and the next load only fetches the objects
+    updated since the newest updated_at of the saved state, sorted by updated_at. Deleted objects are found
+    by comparing the object count of each type with the state, and only the types whose count differs are
+    listed again. A run where few objects changed moves kilobytes instead of the whole space.
+
+    Args:
+        kibana_url (str): The Kibana URL.
+        space_id (str): The Kibana space the objects belong to.
+        headers (dict): Headers used to authenticate to Kibana.
+        object_types (list): Saved object types to fetch. Defaults to OBJECT_TYPES.
+        page_size (int): Number of objects per _find page.
+        concurrency (int): Number of object types fetched at the same time.
+        referenced_ids (list): Optional data view ids. Only the objects referencing them are fetched.
+        state_file (str): Optional path of the incremental state (gzip compressed JSON). Ignored with referenced_ids.
+    """
+    def __init__(self, kibana_url, space_id, headers, object_types=None, page_size=DEFAULT_PAGE_SIZE, concurrency=1,
+                 referenced_ids=None, state_file=None):
+        self.kibana_url = kibana_url
+        self.space_id = space_id
+        self.headers = headers
+        self.object_types = object_types or OBJECT_TYPES
+        self.page_size = page_size
+        self.concurrency = concurrency
+        self.referenced_ids = referenced_ids
+        self.state_file = state_file if referenced_ids is None else None
+        self._objects = None
+        self._reference_index = None
+
+    def load(self):
+        if self.referenced_ids is not None:
+            logging.info(f"Fetching saved objects referencing {len(self.referenced_ids)} data views in space: '{self.space_id}'...")
+            all_objects = ObjectTable(iter_objects_referencing(self.kibana_url, self.space_id, self.headers, self.referenced_ids,
+                                                        object_types=self.object_types, page_size=self.page_size,
+                                                        concurrency=self.concurrency))
+        elif self.state_file and os.path.exists(self.state_file):
+            all_objects = ObjectTable(self._load_changes(self._read_state()))
+        else:
+            logging.info(f"Fetching saved objects of {len(self.object_types)} types in space: '{self.space_id}'...")
+            all_objects = ObjectTable(iter_saved_objects(self.kibana_url, self.space_id, self.headers, self.object_types,
+                                                         page_size=self.page_size, concurrency=self.concurrency))
+        if self.state_file:
+            self._write_state(all_objects)
+        self._objects = all_objects
+        self._reference_index = None
+        logging.info(f"{len(all_objects)} saved objects fetched in space: '{self.space_id}'")
+        return self._objects
+
+    def _read_state(self):
+        with gzip.open(self.state_file, "rt", encoding="utf-8") as file:
+            state = json.load(file)
+        if state.get("kibana_url") != self.kibana_url.rstrip("/") or state.get("space_id") != self.space_id or \
+                set(state.get("object_types", [])) != set(self.object_types):
+            # The state was written for another cluster, space or other types, so it can't be used as a base
+            logging.warning(f"Ignoring the snapshot state '{self.state_file}' written for other objects")
+            return None
+        return state
+
+    def _write_state(self, objects):
+        state = {
+            "kibana_url": self.kibana_url.rstrip("/"),
+            "space_id": self.space_id,
+            "object_types": list(self.object_types),
+            "objects": [{field: object[field] for field in SNAPSHOT_STATE_FIELDS if field in object} for object in objects]
+        }
+        temporary_file = f"{self.state_file}.tmp"
+        with gzip.open(temporary_file, "wt", encoding="utf-8") as file:
+            json.dump(state, file, separators=(",", ":"))
+        # Replace the previous state only once the new one is complete
+        os.replace(temporary_file, self.state_file)
+
+    # Bring the objects of the saved state up to date with the changes made in Kibana since it was written
+    def _load_changes(self, state):
+        if state is None:
+            return list(iter_saved_objects(self.kibana_url, self.space_id, self.headers, self.object_types,
+                                           page_size=self.page_size, concurrency=self.concurrency))
+        objects = {(object["type"], object["id"]): object for object in state["objects"]}
+        # The newest updated_at comes from the Kibana clock, so the local clock doesn't need to be in sync.
+        # Objects updated at that exact time are fetched again, which is harmless.
+        updated_since = max((object.get("updated_at", "") for object in objects.values()), default="") or None
+        logging.info(f"Fetching saved objects updated since {updated_since} in space: '{self.space_id}'...")
+        changed_count = 0
+        for object in iter_saved_objects(self.kibana_url, self.space_id, self.headers, self.object_types,
+                                         page_size=self.page_size, sort_field="updated_at", concurrency=self.concurrency,
+                                         updated_since=updated_since):
+            objects[(object["type"], object["id"])] = object
+            changed_count += 1
+        logging.info(f"{changed_count} saved objects changed since the last snapshot of space: '{self.space_id}'")
+
+        # Every object still in Kibana is now known, so a type with fewer objects in Kibana had objects deleted
+        known_counts = defaultdict(int)
+        for object_type, _ in objects:
+            known_counts[object_type] += 1
+        for object_type in self._types_with_deletions(known_counts):
+            existing_ids = {object["id"] for object in iter_type_group(self.kibana_url, self.space_id, self.headers, [object_type],
+                                                                      self.page_size, fields=("id",))}
+            deleted = [key for key in objects if key[0] == object_type and key[1] not in existing_ids]
+            for key in deleted:
+                del objects[key]
+            logging.info(f"{len(deleted)} saved objects of type '{object_type}' deleted since the last snapshot of space: '{self.space_id}'")
+        return list(objects.values())
+
+    # Types whose object count in Kibana differs from the known count. Types are counted in groups first.
+    def _types_with_deletions(self, known_counts):
+        types_with_deletions = []
+        for i in range(0, len(self.object_types), DEFAULT_TYPES_PER_REQUEST):
+            type_group = self.object_types[i:i + DEFAULT_TYPES_PER_REQUEST]
+            if count_saved_objects(self.kibana_url, self.space_id, self.headers, type_group) == \
+                    sum(known_counts[object_type] for object_type in type_group):
+                continue
+            types_with_deletions += [object_type for object_type in type_group
+                                     if count_saved_objects(self.kibana_url, self.space_id, self.headers, [object_type])
+                                     != known_counts[object_type]]
+        return types_with_deletions
+
+    def refresh(self):
+        """Re-fetch the snapshot, e.g. after references were rewritten in Kibana."""
+        self._objects = None
+        return self.load()
+
+    @property
+    def objects(self):
+        if self._objects is None:
+            self.load()
+        return self._objects
+
+    # Inverted index of the data view references, built once per snapshot
+    @property
+    def reference_index(self):
+        if self._reference_index is None:
+            self._reference_index = ReferenceIndex(self.objects)
+        return self._reference_index
+
+    # Count the references from the snapshot's objects to each of the given data views
+    def reference_counts(self, data_view_ids):
+        return defaultdict(int, self.reference_index.reference_counts(data_view_ids))
+
+
+class SharedObjectRegistry:
+    """
+    Keeps track of the saved objects shared by several spaces (see the object's 'namespaces' field),
+    so that a sweep over many spaces processes each shared object in one space only.
+    """
+    def __init__(self):
+        self._claimed = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_shared(object):
+        namespaces = object.get("namespaces", [])
+        return len(namespaces) > 1 or "*" in namespaces
+
+    # Returns True if the object is not shared or if this is the first space to claim it
+    def claim(self, object):
+        if not self.is_shared(object):
+            return True
+        key = (object["type"], object["id"])
+        with self._lock:
+            if key in self._claimed:
+                return False
+            self._claimed.add(key)
+            return True
@@ -0,0 +1,197 @@
+import gzip
+import hashlib
+import io
+import json
+import logging
+from collections import defaultdict
+from reference_index import ReferenceIndex
+from object_table import ObjectTable
+
+
+# File name suffix of each supported compression
+COMPRESSION_SUFFIXES = {
+    "gzip": ".gz",
+    "zstd": ".zst"
+}
+
+
+# Add the compression's suffix to an export file name
+def export_file_name(file_name, compression=None):
+    suffix = COMPRESSION_SUFFIXES.get(compression, "")
+    if suffix and not file_name.endswith(suffix):
+        return f"{file_name}{suffix}"
+    return file_name
+
+
+# Open an NDJSON export file, compressed or not (chosen by the file name's suffix), in text or binary mode
+def open_ndjson(file_name, mode="r"):
+    binary_mode = mode.replace("t", "").rstrip("b") + "b"
+    if file_name.endswith(COMPRESSION_SUFFIXES["gzip"]):
+        raw = gzip.open(file_name, binary_mode)
+    elif file_name.endswith(COMPRESSION_SUFFIXES["zstd"]):
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("The 'zstandard' module is needed for zstd compressed exports. Install it with: pip install zstandard")
+        if "r" in binary_mode:
+            raw = zstandard.ZstdDecompressor().stream_reader(open(file_name, "rb"), closefd=True)
+        else:
+            raw = zstandard.ZstdCompressor().stream_writer(open(file_name, "wb"), closefd=True)
+    else:
+        raw = open(file_name, binary_mode)
+    if "b" in mode:
+        return raw
+    return io.TextIOWrapper(raw, encoding="utf-8")
+
+
+class ExportWriter:
+    """
+    Writes the NDJSON stream of one or several _export responses to a file, optionally compressed.
+
+    Objects exported by more than one request (e.g. objects referenced from several chunks of an export
+    with includeReferencesDeep) are written once. The export summary line of each response is dropped and
+    a single summary of the whole file is written when the writer is closed. The number of records and
+    a SHA-256 checksum of the uncompressed content are kept, so the backup can be checked for completeness.
+
+    Args:
+        file_name (str): Path of the export file.
+        compression (str): None, 'gzip' or 'zstd'.
+    """
+    def __init__(self, file_name, compression=None):
+        self.file_name = file_name
+        self.compression = compression
+        self.record_count = 0
+        self._checksum = hashlib.sha256()
+        self._exported_objects = set()
+        self._summary = {"excludedObjects": [], "excludedObjectsCount": 0, "missingRefCount": 0, "missingReferences": []}
+        self._file = None
+
+    def __enter__(self):
+        self._file = open_ndjson(self.file_name, "wb")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write(self, data):
+        self._checksum.update(data)
+        self._file.write(data)
+
+    def write_line(self, line):
+        if isinstance(line, str):
+            line = line.encode("utf-8")
+        line = line.strip()
+        if not line:
+            return
+        object = json.loads(line)
+        if "exportedCount" in object:
+            # Summary line of one response: merged into the summary of the whole file
+            self._summary["excludedObjects"].extend(object.get("excludedObjects", []))
+            self._summary["excludedObjectsCount"] += object.get("excludedObjectsCount", 0)
+            self._summary["missingRefCount"] += object.get("missingRefCount", 0)
+            self._summary["missingReferences"].extend(object.get("missingReferences", []))
+            return
+        key = (object.get("type"), object.get("id"))
+        if key in self._exported_objects:
+            return
+        self._exported_objects.add(key)
+        self._write(line + b"\n")
+        self.record_count += 1
+
+    @property
+    def checksum(self):
+        return self._checksum.hexdigest()
+
+    def close(self):
+        if self._file is None:
+            return
+        summary = dict(self._summary, exportedCount=self.record_count)
+        self._write(json.dumps(summary).encode("utf-8") + b"\n")
+        self._file.close()
+        self._file = None
+
+    # Write '<file>.manifest.json' with the record count and checksum of the export
+    def write_manifest(self, expected_count=None):
+        manifest = {
+            "file": self.file_name,
+            "compression": self.compression or "none",
+            "records": self.record_count,
+            "expected_records": expected_count,
+            "missing_references": self._summary["missingRefCount"],
+            "sha256": self.checksum
+        }
+        manifest_file = f"{self.file_name}.manifest.json"
+        with open(manifest_file, "w") as file:
+            json.dump(manifest, file, indent=2)
+        if expected_count is not None and self.record_count < expected_count:
+            logging.warning(f"The export '{self.file_name}' holds {self.record_count} records but {expected_count} objects were expected")
+        return manifest_file
+
+
+# Stream the saved objects of an NDJSON export file one line at a time, skipping the export summary lines
+def iter_export_objects(file_name):
+    with open_ndjson(file_name) as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            object = json.loads(line)
+            if "exportedCount" in object:
+                continue
+            yield object
+
+
+class ExportSnapshot:
+    """
+    Snapshot of a space read from an NDJSON export file (e.g. kibana_objects.ndjson) instead of Kibana.
+
+    The file is streamed once, the first time the snapshot is used. Only the data views (id and title) and the
+    metadata and references of each object are kept, so large exports are analyzed without holding their
+    attributes in memory. It can be used wherever a SavedObjectSnapshot is, and no request is sent to Kibana.
+
+    Args:
+        file_name (str): Path of the export file, plain, gzip or zstd compressed.
+        space_id (str): The space the export was taken from. Only used in messages and plans.
+    """
+    def __init__(self, file_name, space_id=None):
+        self.file_name = file_name
+        self.space_id = space_id
+        self._objects = None
+        self._data_views = None
+        self._reference_index = None
+
+    def load(self):
+        logging.info(f"Reading saved objects from the export file: '{self.file_name}'...")
+        objects = ObjectTable()
+        data_views = []
+        for object in iter_export_objects(self.file_name):
+            if object["type"] == "index-pattern":
+                data_views.append({"id": object["id"], "title": object.get("attributes", {}).get("title")})
+            # Only the metadata and references of the object are kept, the attributes are dropped
+            objects.append(object)
+        self._objects = objects
+        self._data_views = data_views
+        self._reference_index = None
+        logging.info(f"{len(objects)} saved objects and {len(data_views)} data views read from '{self.file_name}'")
+        return self._objects
+
+    @property
+    def objects(self):
+        if self._objects is None:
+            self.load()
+        return self._objects
+
+    @property
+    def data_views(self):
+        if self._data_views is None:
+            self.load()
+        return self._data_views
+
+    @property
+    def reference_index(self):
+        if self._reference_index is None:
+            self._reference_index = ReferenceIndex(self.objects)
+        return self._reference_index
+
+    def reference_counts(self, data_view_ids):
+        return defaultdict(int, self.reference_index.reference_counts(data_view_ids))
@@ -0,0 +1,181 @@
+from array import array
+from bisect import bisect_right
+
+try:
+    import numpy
+except ImportError:
+    # The reference counts are then computed with a pure Python loop over the same columns
+    numpy = None
+
+
+class StringTable:
+    """Interns strings: each distinct string (type, id, reference name...) is stored once and referred to by its index."""
+    def __init__(self):
+        self._indexes = {}
+        self.strings = []
+
+    def intern(self, string):
+        index = self._indexes.get(string)
+        if index is None:
+            index = self._indexes[string] = len(self.strings)
+            self.strings.append(string)
+        return index
+
+    # Index of a string, or None if it was never interned
+    def index(self, string):
+        return self._indexes.get(string)
+
+    def __getitem__(self, index):
+        return self.strings[index]
+
+    def __len__(self):
+        return len(self.strings)
+
+
+class ObjectTable:
+    """
+    Compact in-memory set of saved objects and their references.
+
+    Only the fields the cleanup uses are kept: type, id, version, updated_at, namespaces and references. Every
+    type, id and reference name is interned once in a StringTable, and the objects and references are stored
+    in columns of integers (array.array) instead of one dict per object and per reference:
+
+    - object_types, object_ids: string index of the type and id of each object (row).
+    - reference_offsets: the references of row r are reference_offsets[r] to reference_offsets[r + 1].
+    - reference_types, reference_ids, reference_names: string index of each reference's type, id and name.
+
+    A table behaves like a list of saved objects: iterating it or indexing it builds the dict of an object on
+    the fly, so it can be passed wherever the _find objects were. The dicts are not kept.
+
+    Args:
+        objects (iterable): Saved objects as returned by the _find or _export API. Other fields are dropped.
+    """
+    def __init__(self, objects=()):
+        self.strings = StringTable()
+        self.object_types = array("i")
+        self.object_ids = array("i")
+        self.versions = []
+        self.updated_ats = []
+        self.namespaces = array("i")
+        self._namespace_lists = StringTable()
+        self.reference_offsets = array("i", [0])
+        self.reference_types = array("i")
+        self.reference_ids = array("i")
+        self.reference_names = array("i")
+        self._rows = None
+        for object in objects:
+            self.append(object)
+
+    # Wrap saved objects in a table, unless they already are one
+    @classmethod
+    def of(cls, objects):
+        return objects if isinstance(objects, cls) else cls(objects)
+
+    def append(self, object):
+        intern = self.strings.intern
+        self.object_types.append(intern(object["type"]))
+        self.object_ids.append(intern(object["id"]))
+        self.versions.append(object.get("version"))
+        self.updated_ats.append(object.get("updated_at"))
+        namespaces = object.get("namespaces")
+        # Namespace lists are interned as a whole, most objects of a space share the same one
+        self.namespaces.append(-1 if namespaces is None else self._namespace_lists.intern(tuple(namespaces)))
+        for ref in object.get("references", []):
+            self.reference_types.append(intern(ref["type"]))
+            self.reference_ids.append(intern(ref["id"]))
+            self.reference_names.append(intern(ref.get("name", "")))
+        self.reference_offsets.append(len(self.reference_ids))
+        self._rows = None
+
+    def __len__(self):
+        return len(self.object_ids)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self.object(row)
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self.object(index) for index in range(*row.indices(len(self)))]
+        if row < 0:
+            row += len(self)
+        return self.object(row)
+
+    def type_of(self, row):
+        return self.strings[self.object_types[row]]
+
+    def id_of(self, row):
+        return self.strings[self.object_ids[row]]
+
+    def references(self, row):
+        strings = self.strings
+        return [{"type": strings[self.reference_types[position]], "id": strings[self.reference_ids[position]],
+                 "name": strings[self.reference_names[position]]}
+                for position in range(self.reference_offsets[row], self.reference_offsets[row + 1])]
+
+    # The saved object of a row, as a dict
+    def object(self, row):
+        object = {"type": self.type_of(row), "id": self.id_of(row), "references": self.references(row)}
+        if self.versions[row] is not None:
+            object["version"] = self.versions[row]
+        if self.updated_ats[row] is not None:
+            object["updated_at"] = self.updated_ats[row]
+        if self.namespaces[row] >= 0:
+            object["namespaces"] = list(self._namespace_lists[self.namespaces[row]])
+        return object
+
+    # Row of an object, or None. The lookup table is built on first use.
+    def row_of(self, object_type, object_id):
+        if self._rows is None:
+            self._rows = {key: row for row, key in enumerate(zip(self.object_types, self.object_ids))}
+        type_index, id_index = self.strings.index(object_type), self.strings.index(object_id)
+        if type_index is None or id_index is None:
+            return None
+        return self._rows.get((type_index, id_index))
+
+    # Row of the object a reference (by its position in the reference columns) belongs to
+    def row_of_reference(self, position):
+        return bisect_right(self.reference_offsets, position) - 1
+
+    def reference_groups(self, ref_type):
+        """
+        Group the positions of the references of ref_type by referenced id.
+
+        Returns:
+            dict: String index of the referenced id -> positions (in the reference columns) of its references,
+                in the order of the objects.
+        """
+        type_index = self.strings.index(ref_type)
+        if type_index is None:
+            return {}
+        if numpy is not None:
+            # Vectorized: select the references of the type, sort them by referenced id and cut the sorted array in groups
+            types = numpy.frombuffer(self.reference_types, dtype=numpy.intc)
+            ids = numpy.frombuffer(self.reference_ids, dtype=numpy.intc)
+            positions = numpy.flatnonzero(types == type_index)
+            positions = positions[numpy.argsort(ids[positions], kind="stable")]
+            referenced_ids, starts = numpy.unique(ids[positions], return_index=True)
+            return {int(referenced_id): group
+                    for referenced_id, group in zip(referenced_ids, numpy.split(positions, starts[1:]))}
+        groups = {}
+        for position, (reference_type, reference_id) in enumerate(zip(self.reference_types, self.reference_ids)):
+            if reference_type == type_index:
+                groups.setdefault(reference_id, array("i")).append(position)
+        return groups
+
+
+class ObjectKeys:
+    """
+    The {"type", "id"} of each object of an ObjectTable, as a read-only list whose items are built when they are
+    read, e.g. a slice at a time for the payloads of _export requests.
+    """
+    def __init__(self, table):
+        self.table = table
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self[index] for index in range(*row.indices(len(self)))]
+        return {"id": self.table.id_of(row), "type": self.table.type_of(row)}
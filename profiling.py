@@ -0,0 +1,147 @@
+import cProfile
+import itertools
+import json
+import logging
+import os
+import re
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class PhaseSpan:
+    """Measurements of one run of a phase. The phase can set items to the number of objects it processed."""
+    def __init__(self, phase, space_id):
+        self.phase = phase
+        self.space_id = space_id
+        self.items = None
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.peak_allocated_bytes = None
+        self.profile_file = None
+
+    def to_dict(self):
+        return {"phase": self.phase, "space_id": self.space_id, "wall_seconds": round(self.wall_seconds, 4),
+                "cpu_seconds": round(self.cpu_seconds, 4), "peak_allocated_bytes": self.peak_allocated_bytes,
+                "items": self.items, "profile_file": self.profile_file}
+
+
+class PhaseProfiler:
+    """
+    Times the phases of a run (inventory, export, data view fetch, duplicate detection, reference count, attribute
+    scan, reference rewrite, post-rewrite refresh, backup, delete, GitHub upload) and writes a per-phase breakdown.
+
+    Each phase records its wall time and the process CPU time. With trace_memory, the peak memory allocated
+    during the phase is recorded with tracemalloc, and with cprofile, a cProfile of the phase is written to
+    '<output_prefix>_<sequence>_<space>_<phase>.prof' (open it with pstats or snakeviz). When the profiler is disabled
+    a phase costs nothing.
+
+    In a multi-space sweep phases of different spaces overlap: their CPU time and peak memory are those of
+    the whole process during the phase, and only one phase at a time is profiled with cProfile.
+
+    Args:
+        enabled (bool): Record the phases.
+        cprofile (bool): Write a cProfile of each phase.
+        trace_memory (bool): Record the peak allocated memory of each phase.
+        output_prefix (str): Prefix of the report and cProfile files.
+    """
+    def __init__(self, enabled=False, cprofile=False, trace_memory=False, output_prefix="profile"):
+        self.enabled = enabled
+        self.cprofile = cprofile
+        self.trace_memory = trace_memory
+        self.output_prefix = output_prefix
+        self.spans = []
+        self._sequence = itertools.count(1)
+        self._lock = threading.Lock()
+        self._cprofile_lock = threading.Lock()
+        if enabled and trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def phase(self, name, space_id=None):
+        span = PhaseSpan(name, space_id)
+        if not self.enabled:
+            yield span
+            return
+        with self._lock:
+            sequence = next(self._sequence)
+        profile = None
+        if self.cprofile and self._cprofile_lock.acquire(blocking=False):
+            profile = cProfile.Profile()
+            profile.enable()
+        start_memory = 0
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield span
+        finally:
+            span.wall_seconds = time.perf_counter() - start_wall
+            span.cpu_seconds = time.process_time() - start_cpu
+            if self.trace_memory:
+                # Peak of the memory allocated on top of what was already allocated when the phase started
+                span.peak_allocated_bytes = max(tracemalloc.get_traced_memory()[1] - start_memory, 0)
+            if profile is not None:
+                profile.disable()
+                self._cprofile_lock.release()
+                space_name = re.sub(r'[^A-Za-z0-9_.-]', '_', space_id or 'run')
+                span.profile_file = f"{self.output_prefix}_{sequence:03d}_{space_name}_{name}.prof"
+                profile.dump_stats(span.profile_file)
+            with self._lock:
+                self.spans.append(span)
+
+    # Totals of each phase over every space, in the order the phases first ran
+    def summary(self):
+        totals = {}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            total = totals.setdefault(span.phase, defaultdict(float, phase=span.phase, runs=0, items=0))
+            total["runs"] += 1
+            total["wall_seconds"] += span.wall_seconds
+            total["cpu_seconds"] += span.cpu_seconds
+            total["items"] += span.items or 0
+            if span.peak_allocated_bytes is not None:
+                total["peak_allocated_bytes"] = max(total["peak_allocated_bytes"], span.peak_allocated_bytes)
+        return [dict(total) for total in totals.values()]
+
+    def write_report(self, file_name=None):
+        """Write the phase breakdown to '<output_prefix>.json' and log it. Returns the file name."""
+        if not self.enabled:
+            return None
+        file_name = file_name or f"{self.output_prefix}.json"
+        summary = self.summary()
+        with self._lock:
+            spans = [span.to_dict() for span in self.spans]
+        with open(file_name, "w") as file:
+            json.dump({"phases": summary, "spans": spans}, file, indent=2)
+        total_wall = sum(total["wall_seconds"] for total in summary) or 1.0
+        logging.info("PHASE BREAKDOWN")
+        for total in summary:
+            peak = f"  peak: {total['peak_allocated_bytes'] / 1e6:.1f} MB" if "peak_allocated_bytes" in total else ""
+            logging.info(f"  {total['phase']:<20} wall: {total['wall_seconds']:9.3f}s ({100 * total['wall_seconds'] / total_wall:5.1f}%)  "
+                         f"cpu: {total['cpu_seconds']:9.3f}s  items: {int(total['items'])}{peak}")
+        logging.info(f"Phase breakdown written to '{os.path.abspath(file_name)}'")
+        return file_name
+
+
+_profiler = PhaseProfiler()
+
+
+def get_profiler():
+    return _profiler
+
+
+# Replace the process-wide profiler, e.g. to enable it from the command line
+def configure_profiler(enabled=False, cprofile=False, trace_memory=False, output_prefix="profile"):
+    global _profiler
+    _profiler = PhaseProfiler(enabled, cprofile, trace_memory, output_prefix)
+    return _profiler
+
+
+# Time a phase of the run with the process-wide profiler
+def profile_phase(name, space_id=None):
+    return get_profiler().phase(name, space_id)
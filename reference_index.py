@@ -0,0 +1,81 @@
+from object_table import ObjectTable
+
+
+class ReferenceIndex:
+    """
+    Inverted index from a referenced object id (e.g. a data view id) to the saved objects referencing it.
+
+    The index is built once over the reference columns of an ObjectTable: the references of ref_type are grouped
+    by referenced id (vectorized with NumPy when it is installed), so reference counts, the choice of the
+    canonical data view, the list of objects to update and the delete safety check are all dictionary lookups
+    instead of scans over every object and reference.
+
+    Args:
+        objects (ObjectTable or list): Saved objects as returned by the _find API.
+        ref_type (str): Only references of this type are indexed. Defaults to 'index-pattern'.
+    """
+    def __init__(self, objects, ref_type="index-pattern"):
+        self.ref_type = ref_type
+        self.table = ObjectTable.of(objects)
+        self._groups = self.table.reference_groups(ref_type)
+
+    # Positions of the references to the given id in the table's reference columns
+    def _group(self, referenced_id):
+        index = self.table.strings.index(referenced_id)
+        return self._groups.get(index, ()) if index is not None else ()
+
+    # List of (object type, object id, reference name) referencing the given id
+    def references_to(self, referenced_id):
+        table = self.table
+        references = []
+        for position in self._group(referenced_id):
+            row = table.row_of_reference(position)
+            references.append((table.type_of(row), table.id_of(row), table.strings[table.reference_names[position]]))
+        return references
+
+    def count(self, referenced_id):
+        return len(self._group(referenced_id))
+
+    def reference_counts(self, referenced_ids):
+        return {referenced_id: self.count(referenced_id) for referenced_id in referenced_ids}
+
+    def has_references(self, referenced_id):
+        return self.count(referenced_id) > 0
+
+    # The most referenced id of the group. Ties go to the id listed first.
+    def most_referenced(self, referenced_ids):
+        return max(referenced_ids, key=self.count)
+
+    def get_object(self, object_type, object_id):
+        row = self.table.row_of(object_type, object_id)
+        return self.table.object(row) if row is not None else None
+
+
+# Reference changes of an object, as returned by remap_references, as recorded in the plan and the audit file
+def change_list(changes):
+    return [{"name": ref_name, "from": old_id, "to": new_id} for ref_name, old_id, new_id in changes]
+
+
+# Rewrite the references of one object according to an old id -> new id mapping
+def remap_references(references, id_mapping, ref_type="index-pattern"):
+    """
+    Build the new references array of an object, keeping every reference that is not being changed.
+
+    Args:
+        references (list): The object's current references.
+        id_mapping (dict): Old referenced id -> new referenced id.
+        ref_type (str): Only references of this type are rewritten.
+
+    Returns:
+        tuple: (changes, new_references), where changes is a list of (reference name, old id, new id).
+    """
+    changes = []
+    new_references = []
+    for ref in references:
+        if ref["type"] == ref_type and ref["id"] in id_mapping:
+            new_ref = dict(ref, id=id_mapping[ref["id"]])
+            changes.append((ref["name"], ref["id"], new_ref["id"]))
+            new_references.append(new_ref)
+        else:
+            new_references.append(ref)
+    return changes, new_references
@@ -0,0 +1,212 @@
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+import requests
+from http_metrics import endpoint_of
+
+
+# Kibana didn't process the request and asks to come back later, so it is retried whatever the method
+THROTTLE_STATUSES = {429, 503}
+
+# Transient proxy errors. The request may have been processed, so only idempotent requests are retried.
+TRANSIENT_STATUSES = {502, 504}
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+# Number of times a request is retried before its last response (or error) is returned to the caller
+DEFAULT_MAX_RETRIES = 5
+
+# Exponential backoff: the n-th retry waits a random time between 0 and min(BACKOFF_CAP, BACKOFF_BASE * 2 ** n) seconds
+DEFAULT_BACKOFF_BASE = 0.5
+DEFAULT_BACKOFF_CAP = 60.0
+
+# A response is a sign of an overloaded Kibana when it is this many times slower than the usual latency of its requests
+DEFAULT_LATENCY_FACTOR = 4.0
+
+# Responses faster than this are never considered slow
+MIN_SLOW_LATENCY = 1.0
+
+# Weight of each new response in the moving average of the latency of a kind of request
+LATENCY_EWMA_WEIGHT = 0.2
+
+# Number of responses of a kind of request averaged before its latency is compared with the average
+LATENCY_WARMUP = 5
+
+
+class AdaptiveConcurrencyLimit:
+    """
+    Limits the number of requests in flight with AIMD (additive increase, multiplicative decrease): the limit grows
+    by about one for every limit successful requests, and is multiplied by decrease_factor on every sign of
+    overload, at most once per cooldown seconds, so that one burst of errors only counts once.
+
+    Args:
+        max_limit (int): The limit the run starts with, and never goes above.
+        min_limit (int): The limit never goes below.
+        decrease_factor (float): The limit is multiplied by it on overload.
+        cooldown (float): Minimum number of seconds between two decreases.
+    """
+    def __init__(self, max_limit, min_limit=1, decrease_factor=0.5, cooldown=1.0):
+        self.max_limit = max(max_limit, min_limit)
+        self.min_limit = min_limit
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.limit = float(self.max_limit)
+        self.lowest_limit = self.limit
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def increase(self):
+        with self._condition:
+            if self.limit < self.max_limit:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self._condition.notify_all()
+
+    # Returns True if the limit was lowered
+    def decrease(self):
+        with self._condition:
+            now = time.monotonic()
+            if now - self._last_decrease < self.cooldown or self.limit <= self.min_limit:
+                return False
+            self._last_decrease = now
+            self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+            self.lowest_limit = min(self.lowest_limit, self.limit)
+            return True
+
+
+class RequestController:
+    """
+    Sends the requests of one host: retries the failed ones with jittered exponential backoff, honoring
+    Retry-After, and adapts the number of requests in flight to how loaded the host is.
+
+    - 429 and 503 responses are retried for every method, since the host didn't process the request.
+    - 502 and 504 responses and connection errors and timeouts are retried for idempotent requests only
+      (GET, HEAD, OPTIONS, PUT and DELETE, or requests sent with idempotent=True).
+    - A request with a streamed body can't be sent again, so it is never retried.
+
+    The signs of an overloaded host lower the concurrency limit (see AdaptiveConcurrencyLimit): 429 and 5xx
+    responses, timeouts, and responses more than latency_factor times slower than the moving average of the
+    requests of the same shape. The shape is given by the caller, e.g. the endpoint's page size or the number of
+    objects sent, since one endpoint serves anything from a count to a page of thousands of objects. Requests sent
+    without a shape, whose size isn't known up front, are not compared. Other responses raise the limit back up to
+    max_concurrency.
+    A request holds its slot until its response headers arrive, not while a streamed body is read.
+
+    Args:
+        max_concurrency (int): Number of requests sent to the host at the same time when it keeps up.
+        max_retries (int): Number of retries of a request before giving up.
+        backoff_base (float): Backoff of the first retry, in seconds.
+        backoff_cap (float): Longest wait between two attempts, in seconds, Retry-After included.
+        latency_factor (float): Slow-down of a request's latency, compared with its moving average, that counts as overload.
+    """
+    def __init__(self, max_concurrency, max_retries=DEFAULT_MAX_RETRIES, backoff_base=DEFAULT_BACKOFF_BASE,
+                 backoff_cap=DEFAULT_BACKOFF_CAP, latency_factor=DEFAULT_LATENCY_FACTOR):
+        self.concurrency = AdaptiveConcurrencyLimit(max_concurrency)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.latency_factor = latency_factor
+        self.retries = 0
+        # (endpoint, shape) -> [moving average of the latency, number of responses]
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    def send(self, method, url, send_once, idempotent=None, replayable=True, shape=None):
+        """
+        Send a request with send_once(attempt), which sends it once and returns the response, retrying it as needed.
+        Returns the last response, or raises the last connection error or timeout.
+        shape (hashable) identifies the requests of the endpoint whose latencies are comparable, e.g. the page size.
+        """
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        endpoint = endpoint_of(method, url)[0]
+        attempt = 0
+        while True:
+            response, error = None, None
+            self.concurrency.acquire()
+            start = time.perf_counter()
+            try:
+                response = send_once(attempt)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            finally:
+                self.concurrency.release()
+            latency = time.perf_counter() - start
+
+            if error is not None:
+                # A timeout is a sign of overload, a refused or reset connection is not
+                if isinstance(error, requests.Timeout):
+                    self._overloaded(f"{type(error).__name__} from {endpoint}")
+                retry = idempotent
+            elif response.status_code in THROTTLE_STATUSES:
+                self._overloaded(f"Status {response.status_code} from {endpoint}")
+                retry = True
+            elif response.status_code >= 500:
+                self._overloaded(f"Status {response.status_code} from {endpoint}")
+                retry = idempotent and response.status_code in TRANSIENT_STATUSES
+            else:
+                if shape is not None and self._is_slow((endpoint, shape), latency):
+                    self._overloaded(f"{endpoint} took {latency:.1f}s")
+                else:
+                    self.concurrency.increase()
+                return response
+
+            if not retry or not replayable or attempt >= self.max_retries:
+                if error is not None:
+                    raise error
+                return response
+            delay = self.backoff(attempt, response)
+            logging.info(f"Retrying {method} {url} in {delay:.1f}s (attempt {attempt + 2} of {self.max_retries + 1}): "
+                         f"{error or f'status {response.status_code}'}")
+            if response is not None:
+                response.close()
+            with self._lock:
+                self.retries += 1
+            time.sleep(delay)
+            attempt += 1
+
+    # Seconds to wait before the next attempt: the host's Retry-After if it sent one, jittered exponential backoff otherwise
+    def backoff(self, attempt, response=None):
+        retry_after = parse_retry_after(response.headers.get("Retry-After")) if response is not None else None
+        if retry_after is not None:
+            # A little jitter, so that the requests told to wait the same time don't all come back at once
+            return min(self.backoff_cap, retry_after + random.uniform(0, self.backoff_base))
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    # Compare the latency with the moving average of the requests of the same endpoint and shape, then add it to the average
+    def _is_slow(self, key, latency):
+        with self._lock:
+            average, count = self._latencies.get(key, (latency, 0))
+            self._latencies[key] = (average + LATENCY_EWMA_WEIGHT * (latency - average), count + 1)
+        return count >= LATENCY_WARMUP and latency > MIN_SLOW_LATENCY and latency > self.latency_factor * average
+
+    def _overloaded(self, reason):
+        if self.concurrency.decrease():
+            logging.info(f"{reason}. Lowering the number of concurrent requests to {int(self.concurrency.limit)}")
+
+
+# Seconds to wait from a Retry-After header, given in seconds or as an HTTP date
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
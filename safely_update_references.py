@@ -1,93 +1,186 @@
-import requests
+import sys
 import json
+import logging
+import threading
+from collections import defaultdict
+from argparse import ArgumentParser
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from kibana_saved_objects import iter_saved_objects, iter_objects_referencing, bulk_update_entry, bulk_update_saved_objects, \
+    SharedObjectRegistry, DEFAULT_PAGE_SIZE, DEFAULT_BULK_SIZE, DEFAULT_SPACE_WORKERS
+from reference_index import remap_references, change_list
+from attribute_scanner import AttributeScan
+from get_spaces import list_kibana_space_ids
+from http_client import add_connection_arguments, configure_connection, write_http_metrics
+from structured_logging import setup_logging, flush_logging, console, audit
 
-# Configuration: Update these to match your environment.
-KIBANA_HOST = "http://localhost:5601"
-USERNAME = "your_username"
-PASSWORD = "your_password"
-OBJECT_TYPE = "search"         # Change this if you want to target a different object type.
-PAGE_SIZE = 100                # Number of objects per API page
 
-# The old and new data view IDs.
-old_data_view_id = "d1e912b0-958c-4307-ae6e-9d9da63b00ea"
-new_data_view_id = "ABC1234"
+# Read the old ID -> new ID mapping of the data views to replace
+def load_mapping(mapping_file):
+    """
+    Reads the mapping file: a JSON object of old data view ID -> new data view ID, or a cleanup plan written by
+    cleanup_duplicate_dataviews.py, whose planned deletions give the data view each old one is replaced by.
+
+    Chains (a -> b and b -> c) are followed, so every old ID is mapped to the ID it ends up as, and all the
+    references are rewritten in one pass.
 
-def update_references(saved_object, old_id, new_id):
+    Returns:
+        dict: Old data view ID -> new data view ID.
     """
-    Scans the references list in the saved object and updates the id
-    for any reference where:
-      - reference.type is "index-pattern"
-      - reference.id equals old_id
-    Returns a tuple (updated, new_references) where:
-      - updated is True if any reference was modified.
-      - new_references is the updated list of references.
+    with open(mapping_file) as file:
+        mapping = json.load(file)
+    if "spaces" in mapping:
+        mapping = {deletion["id"]: deletion["replaced_by"] for space_plan in mapping["spaces"] for deletion in space_plan["deletions"]}
+    id_mapping = {}
+    for old_id, new_id in mapping.items():
+        seen = {old_id}
+        while new_id in mapping:
+            if new_id in seen:
+                logging.error(f"The mapping in '{mapping_file}' goes round in a circle through the ID: '{new_id}'")
+                sys.exit(1)
+            seen.add(new_id)
+            new_id = mapping[new_id]
+        id_mapping[old_id] = new_id
+    return id_mapping
+
+
+# Generator of the (object, changes, update) of every object that references an old ID of the mapping
+def iter_reference_rewrites(objects, id_mapping, ref_type="index-pattern", shared_objects=None, attribute_scan=None):
+    for object in objects:
+        # One dict lookup per reference, whatever the number of IDs in the mapping
+        changes, new_references = remap_references(object.get("references", []), id_mapping, ref_type)
+        new_attributes = {}
+        if attribute_scan:
+            attribute_scan.scan_object(object)
+            attribute_changes, new_attributes = attribute_scan.rewrite(object["type"], object["id"], id_mapping)
+            # The objects are only looked at once, so their hits are not kept
+            attribute_scan.hits.pop((object["type"], object["id"]), None)
+            changes += attribute_changes
+        if not changes:
+            continue
+        if shared_objects is not None and not shared_objects.claim(object):
+            logging.info(f"Skipping {object['type']} with ID: {object['id']}. It is shared with another space that already processed it")
+            continue
+        yield object, changes, bulk_update_entry(object, new_references, new_attributes)
+
+
+# Rewrite the references to the old IDs of the mapping in every saved object of a space
+def rewrite_space(kibana_url, headers, space_id, id_mapping, dry_run, page_size=DEFAULT_PAGE_SIZE, concurrency=1,
+                  bulk_size=DEFAULT_BULK_SIZE, ref_type="index-pattern", shared_objects=None, scan=False):
     """
-    updated = False
-    new_refs = []
-    for ref in saved_object.get("references", []):
-        if ref.get("type") == "index-pattern" and ref.get("id") == old_id:
-            new_ref = ref.copy()  # Copy to preserve the original structure.
-            new_ref["id"] = new_id
-            updated = True
-            new_refs.append(new_ref)
-        else:
-            new_refs.append(ref)
-    return updated, new_refs
-
-def get_saved_objects(object_type, page=1, per_page=PAGE_SIZE):
-    url = f"{KIBANA_HOST}/api/saved_objects/_find"
-    params = {
-        "type": object_type,
-        "page": page,
-        "per_page": per_page
-    }
-    headers = {
-        "kbn-xsrf": "true",
-        "Content-Type": "application/json"
-    }
-    response = requests.get(url, params=params, headers=headers, auth=(USERNAME, PASSWORD))
-    response.raise_for_status()
-    return response.json()
-
-def update_saved_object(obj_type, obj_id, updated_references):
-    url = f"{KIBANA_HOST}/api/saved_objects/{obj_type}/{obj_id}"
-    headers = {
-        "kbn-xsrf": "true",
-        "Content-Type": "application/json"
-    }
-    payload = {
-        "references": updated_references
-    }
-    response = requests.put(url, headers=headers, auth=(USERNAME, PASSWORD), data=json.dumps(payload))
-    response.raise_for_status()
-    return response.json()
-
-def scan_and_update_saved_objects():
-    page = 1
-    total = None
-    updated_count = 0
-
-    while True:
-        data = get_saved_objects(OBJECT_TYPE, page)
-        saved_objects = data.get("saved_objects", [])
-        if total is None:
-            total = data.get("total", 0)
-            print(f"Found {total} objects of type '{OBJECT_TYPE}'.")
-
-        for obj in saved_objects:
-            obj_id = obj.get("id")
-            updated, new_refs = update_references(obj, old_data_view_id, new_data_view_id)
-            if updated:
-                print(f"Updating object {obj_id} with new data view id...")
-                update_resp = update_saved_object(OBJECT_TYPE, obj_id, new_refs)
-                print(f"Updated object {obj_id}: {update_resp}")
-                updated_count += 1
-
-        if page * PAGE_SIZE >= total:
-            break
-        page += 1
-
-    print(f"Finished. Updated {updated_count} objects.")
+    Streams the saved objects of every type of the space once, looks up every reference in the mapping, and
+    rewrites the objects referencing an old ID, bulk_size objects per _bulk_update request.
+
+    Without scan, only the objects referencing an old ID are requested from Kibana (has_reference query) and only
+    their references are returned. With scan, every object is requested with all its attributes, and the old IDs
+    embedded in the attributes (searchSourceJSON, panelsJSON...) are rewritten as well.
+
+    The pages are read to the end before the first update is sent: _find pages by offset, and objects rewritten
+    while paging would leave the has_reference results (or move in the sort order), so others would be skipped.
+    Only the updates are kept meanwhile, not the objects.
+
+    Returns:
+        dict: Number of objects per outcome: 'done', 'failed' or 'dry_run'.
+    """
+    console(f"Rewriting the references to {len(id_mapping)} data views in space: '{space_id}'")
+    if scan:
+        objects = iter_saved_objects(kibana_url, space_id, headers, page_size=page_size, fields=(), concurrency=concurrency)
+    else:
+        objects = iter_objects_referencing(kibana_url, space_id, headers, id_mapping, ref_type, page_size=page_size,
+                                           concurrency=concurrency)
+    attribute_scan = AttributeScan(id_mapping) if scan else None
+    rewrites = [(changes, update) for object, changes, update
+                in iter_reference_rewrites(objects, id_mapping, ref_type, shared_objects, attribute_scan)]
+    counts = defaultdict(int)
+    if dry_run:
+        for changes, update in rewrites:
+            audit("rewrite", space_id, update["type"], update["id"], "dry_run", changes=change_list(changes))
+        counts["dry_run"] = len(rewrites)
+    else:
+        results = bulk_update_saved_objects(kibana_url, space_id, headers, [update for changes, update in rewrites], bulk_size)
+        for (changes, update), result in zip(rewrites, results):
+            if result["success"]:
+                audit("rewrite", space_id, update["type"], update["id"], "done", changes=change_list(changes))
+                counts["done"] += 1
+            else:
+                audit("rewrite", space_id, update["type"], update["id"], "failed", changes=change_list(changes), error=result["error"])
+                logging.error(f"Failed to update {update['type']} with ID: {update['id']}. Error: {result['error']}")
+                counts["failed"] += 1
+    if dry_run:
+        console(f"[DRY-RUN] {counts['dry_run']} objects would have been UPDATED in space: '{space_id}'")
+    else:
+        console(f"Successfully updated {counts['done']} of {counts['done'] + counts['failed']} objects in space: '{space_id}'")
+    return counts
+
+
+# Run rewrite_space for one space of a multi-space sweep, turning failures into a failed outcome
+def rewrite_space_in_sweep(kibana_url, headers, space_id, id_mapping, dry_run, page_size, concurrency, bulk_size, ref_type,
+                           shared_objects, scan):
+    # The thread is named after the space so that each log line shows the space it belongs to
+    threading.current_thread().name = space_id
+    try:
+        return rewrite_space(kibana_url, headers, space_id, id_mapping, dry_run, page_size, concurrency, bulk_size, ref_type,
+                             shared_objects, scan)
+    except Exception as e:
+        logging.error(f"Failed to rewrite the references in space: '{space_id}'. Error: {e}")
+        return {"failed_spaces": 1}
+
+
+def main(kibana_url, headers, space_id, mapping_file, dry_run, page_size=DEFAULT_PAGE_SIZE, concurrency=1, bulk_size=DEFAULT_BULK_SIZE,
+         ref_type="index-pattern", all_spaces=False, space_workers=DEFAULT_SPACE_WORKERS, scan=False):
+    timestamp = datetime.now().strftime("%Y_%m_%d-%H_%M_%S")
+    setup_logging(f"rewrite_references_{timestamp}.ndjson", show_thread=all_spaces, audit_file=f"rewrite_audit_{timestamp}.ndjson")
+    id_mapping = load_mapping(mapping_file)
+    console(f"{len(id_mapping)} data view IDs to replace, read from '{mapping_file}'")
+    if not id_mapping:
+        return {}
+    if not all_spaces:
+        counts = rewrite_space(kibana_url, headers, space_id, id_mapping, dry_run, page_size, concurrency, bulk_size, ref_type, scan=scan)
+    else:
+        space_ids = list_kibana_space_ids(headers, kibana_url)
+        # Objects shared by several spaces are only rewritten by the first space that reaches them
+        shared_objects = SharedObjectRegistry()
+        counts = defaultdict(int)
+        with ThreadPoolExecutor(max_workers=space_workers) as executor:
+            for space_counts in executor.map(
+                    lambda sweep_space_id: rewrite_space_in_sweep(kibana_url, headers, sweep_space_id, id_mapping, dry_run, page_size,
+                                                                  concurrency, bulk_size, ref_type, shared_objects, scan),
+                    space_ids):
+                for status, count in space_counts.items():
+                    counts[status] += count
+        console(f"{len(space_ids)} spaces processed: " + ", ".join(f"{count} {status}" for status, count in sorted(counts.items())))
+    flush_logging()
+    return counts
+
 
 if __name__ == "__main__":
-    scan_and_update_saved_objects()
+    parser = ArgumentParser(description='Rewrite the references to old data views in every saved object, from an old ID -> new ID mapping file')
+    add_connection_arguments(parser)
+    parser.add_argument('--space_id', default='None', required=False)
+    parser.add_argument('--all_spaces', '--all-spaces', action='store_true', help='Rewrite every space of the cluster instead of --space_id')
+    parser.add_argument('--space_workers', type=int, default=DEFAULT_SPACE_WORKERS, required=False)
+    parser.add_argument('--mapping_file', required=True,
+                        help='JSON object of old data view ID -> new data view ID, or a cleanup plan of cleanup_duplicate_dataviews.py')
+    parser.add_argument('--ref_type', default='index-pattern', required=False, help='Type of the referenced objects to replace')
+    parser.add_argument('--dry_run', choices=['True', 'False', 'false'], default='True')
+    parser.add_argument('--page_size', type=int, default=DEFAULT_PAGE_SIZE, required=False)
+    parser.add_argument('--concurrency', type=int, default=1, required=False)
+    parser.add_argument('--bulk_size', type=int, default=DEFAULT_BULK_SIZE, required=False)
+    parser.add_argument('--scan_attributes', action='store_true',
+                        help='Also rewrite the old IDs embedded in attributes (searchSourceJSON, panelsJSON...). Every object is downloaded')
+    parser.add_argument('--metrics_file', default=None, required=False, help='Write the per-endpoint request metrics to this JSON file')
+
+    args = parser.parse_args()
+    if not args.all_spaces and args.space_id == 'None':
+        parser.error("one of the arguments --space_id or --all_spaces is required")
+    if 'None' in (args.kibana_url, args.api_key):
+        parser.error("the arguments --kibana_url and --api_key are required")
+
+    # Same pooled client, retries and authentication as cleanup_duplicate_dataviews.py
+    headers = configure_connection(args, args.concurrency * args.space_workers if args.all_spaces else args.concurrency)
+    try:
+        main(args.kibana_url, headers, args.space_id, args.mapping_file, args.dry_run.lower() == 'true', args.page_size, args.concurrency,
+             args.bulk_size, args.ref_type, args.all_spaces, args.space_workers, args.scan_attributes)
+    finally:
+        if args.metrics_file:
+            write_http_metrics(args.metrics_file)
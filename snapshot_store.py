@@ -0,0 +1,190 @@
+import json
+import sqlite3
+import threading
+from collections import defaultdict
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    cluster TEXT NOT NULL,
+    space_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    id TEXT NOT NULL,
+    version TEXT,
+    updated_at TEXT,
+    namespaces TEXT,
+    PRIMARY KEY (cluster, space_id, type, id)
+);
+CREATE TABLE IF NOT EXISTS object_references (
+    cluster TEXT NOT NULL,
+    space_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    id TEXT NOT NULL,
+    ref_type TEXT NOT NULL,
+    ref_id TEXT NOT NULL,
+    ref_name TEXT
+);
+CREATE INDEX IF NOT EXISTS object_references_by_referenced_id ON object_references (cluster, space_id, ref_type, ref_id);
+CREATE INDEX IF NOT EXISTS object_references_by_object ON object_references (cluster, space_id, type, id);
+CREATE TABLE IF NOT EXISTS data_views (
+    cluster TEXT NOT NULL,
+    space_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    title TEXT,
+    PRIMARY KEY (cluster, space_id, id)
+);
+CREATE INDEX IF NOT EXISTS data_views_by_title ON data_views (cluster, space_id, title);
+"""
+
+
+class SnapshotStore:
+    """
+    Local SQLite store of the saved objects, references and data views fetched from Kibana.
+
+    Each space of each cluster is stored as a whole: saving a space replaces what was stored for it,
+    in a single transaction with bulk inserts. The duplicate data views, the reference counts and the
+    delete safety check are then indexed queries, which can be repeated as often as needed without
+    sending a request to Kibana.
+
+    Args:
+        path (str): Path of the SQLite database file. It is created if it doesn't exist.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._write_lock = threading.Lock()
+        connection = self._connect()
+        try:
+            connection.executescript(SCHEMA)
+        finally:
+            connection.close()
+
+    def _connect(self):
+        # A connection per call, so that the store can be used from the threads of a multi-space sweep
+        connection = sqlite3.connect(self.path, timeout=60)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _query(self, sql, params=()):
+        connection = self._connect()
+        try:
+            return connection.execute(sql, params).fetchall()
+        finally:
+            connection.close()
+
+    def save_space(self, cluster_name, space_id, objects, data_views):
+        """
+        Replace the stored saved objects and data views of a space.
+
+        Args:
+            cluster_name (str): Name of the cluster the space belongs to.
+            space_id (str): The Kibana space.
+            objects (list): Saved objects as returned by the _find API (type, id, version, updated_at, references...).
+            data_views (list): Data views as returned by the data views API (id, title).
+        """
+        key = (cluster_name, space_id)
+        with self._write_lock:
+            connection = self._connect()
+            try:
+                with connection:
+                    for table in ("objects", "object_references", "data_views"):
+                        connection.execute(f"DELETE FROM {table} WHERE cluster = ? AND space_id = ?", key)
+                    connection.executemany(
+                        "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (key + (object["type"], object["id"], object.get("version"), object.get("updated_at"),
+                                json.dumps(object.get("namespaces", []))) for object in objects))
+                    connection.executemany(
+                        "INSERT INTO object_references VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (key + (object["type"], object["id"], ref["type"], ref["id"], ref.get("name"))
+                         for object in objects for ref in object.get("references", [])))
+                    connection.executemany(
+                        "INSERT OR REPLACE INTO data_views VALUES (?, ?, ?, ?)",
+                        (key + (data_view["id"], data_view["title"]) for data_view in data_views))
+            finally:
+                connection.close()
+
+    # List of the stored (cluster, space ID), optionally of one cluster only
+    def spaces(self, cluster_name=None):
+        if cluster_name is None:
+            rows = self._query("SELECT DISTINCT cluster, space_id FROM data_views UNION SELECT DISTINCT cluster, space_id FROM objects")
+        else:
+            rows = self._query("SELECT DISTINCT cluster, space_id FROM data_views WHERE cluster = ? "
+                               "UNION SELECT DISTINCT cluster, space_id FROM objects WHERE cluster = ?", (cluster_name, cluster_name))
+        return sorted(rows)
+
+    def space(self, cluster_name, space_id):
+        return StoredSpace(self, cluster_name, space_id)
+
+
+class StoredSpace:
+    """
+    The stored snapshot of one space. It can be used in place of a SavedObjectSnapshot (objects,
+    reference_counts) and of a ReferenceIndex (count, has_references, references_to, most_referenced).
+    """
+    def __init__(self, store, cluster_name, space_id, ref_type="index-pattern"):
+        self.store = store
+        self.cluster_name = cluster_name
+        self.space_id = space_id
+        self.ref_type = ref_type
+
+    @property
+    def objects(self):
+        references = defaultdict(list)
+        for object_type, object_id, ref_type, ref_id, ref_name in self.store._query(
+                "SELECT type, id, ref_type, ref_id, ref_name FROM object_references WHERE cluster = ? AND space_id = ? ORDER BY rowid",
+                (self.cluster_name, self.space_id)):
+            references[(object_type, object_id)].append({"type": ref_type, "id": ref_id, "name": ref_name})
+        return [{"type": object_type, "id": object_id, "version": version, "updated_at": updated_at,
+                 "namespaces": json.loads(namespaces), "references": references[(object_type, object_id)]}
+                for object_type, object_id, version, updated_at, namespaces in self.store._query(
+                    "SELECT type, id, version, updated_at, namespaces FROM objects WHERE cluster = ? AND space_id = ? ORDER BY rowid",
+                    (self.cluster_name, self.space_id))]
+
+    # The space is already indexed by referenced id, so it is its own reference index
+    @property
+    def reference_index(self):
+        return self
+
+    def data_views(self):
+        return [{"id": data_view_id, "title": title} for data_view_id, title in self.store._query(
+            "SELECT id, title FROM data_views WHERE cluster = ? AND space_id = ? ORDER BY rowid", (self.cluster_name, self.space_id))]
+
+    # Title -> IDs of the data views sharing their title with another data view, in the order they were stored
+    def duplicate_data_views(self):
+        duplicates = defaultdict(list)
+        for title, data_view_id in self.store._query(
+                "SELECT title, id FROM data_views WHERE cluster = ? AND space_id = ? AND title IN "
+                "(SELECT title FROM data_views WHERE cluster = ? AND space_id = ? GROUP BY title HAVING COUNT(*) > 1) ORDER BY rowid",
+                (self.cluster_name, self.space_id, self.cluster_name, self.space_id)):
+            duplicates[title].append(data_view_id)
+        return dict(duplicates)
+
+    # List of (object type, object id, reference name) referencing the given id
+    def references_to(self, referenced_id):
+        return self.store._query(
+            "SELECT type, id, ref_name FROM object_references WHERE cluster = ? AND space_id = ? AND ref_type = ? AND ref_id = ?",
+            (self.cluster_name, self.space_id, self.ref_type, referenced_id))
+
+    def count(self, referenced_id):
+        return self.reference_counts([referenced_id])[referenced_id]
+
+    def reference_counts(self, referenced_ids):
+        referenced_ids = list(referenced_ids)
+        placeholders = ", ".join("?" * len(referenced_ids))
+        reference_counts = defaultdict(int)
+        for referenced_id, count in self.store._query(
+                f"SELECT ref_id, COUNT(*) FROM object_references WHERE cluster = ? AND space_id = ? AND ref_type = ? "
+                f"AND ref_id IN ({placeholders}) GROUP BY ref_id",
+                (self.cluster_name, self.space_id, self.ref_type, *referenced_ids)):
+            reference_counts[referenced_id] = count
+        return reference_counts
+
+    def has_references(self, referenced_id):
+        return bool(self.store._query(
+            "SELECT 1 FROM object_references WHERE cluster = ? AND space_id = ? AND ref_type = ? AND ref_id = ? LIMIT 1",
+            (self.cluster_name, self.space_id, self.ref_type, referenced_id)))
+
+    # The most referenced id of the group. Ties go to the id listed first.
+    def most_referenced(self, referenced_ids):
+        reference_counts = self.reference_counts(referenced_ids)
+        return max(referenced_ids, key=lambda referenced_id: reference_counts[referenced_id])
@@ -0,0 +1,172 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import sys
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+
+# Logger of the per-object audit records. They only go to the audit file.
+AUDIT_LOGGER = "audit"
+
+# Extra of the log records that are shown on the console as well as written to the log file
+CONSOLE = {"console": True}
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Formats a log record as one JSON object per line: time, level, thread and message, and the traceback if any."""
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).astimezone().isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "message": record.getMessage()
+        }
+        if record.name != "root":
+            entry["logger"] = record.name
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class AuditFormatter(logging.Formatter):
+    """Formats an audit record (a dict) as one compact JSON object per line."""
+    def format(self, record):
+        return json.dumps(dict(time=round(record.created, 3), **record.msg), separators=(",", ":"))
+
+
+class DeferredFormatQueueHandler(QueueHandler):
+    """
+    Puts log records on the queue without formatting them, so that the formatting is done by the listener thread.
+    Only the message arguments are merged into the message, so that later changes to them don't change the message.
+    """
+    def prepare(self, record):
+        if record.args:
+            record = copy.copy(record)
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+def is_audit(record):
+    return record.name == AUDIT_LOGGER
+
+
+def is_not_audit(record):
+    return record.name != AUDIT_LOGGER
+
+
+# Warnings, errors and the messages logged with console() are shown on the console
+def is_console(record):
+    return record.levelno >= logging.WARNING or getattr(record, "console", False)
+
+
+class LogPipeline:
+    """
+    Logging of a run through a queue: the calling threads only put the records on the queue, and a background
+    thread formats and writes them.
+
+    - log_file gets every record as a JSON line (time, level, thread, message).
+    - The console only gets warnings, errors and the summary messages logged with console().
+    - audit_file, if given, gets one compact JSON line per object the run touched, logged with audit().
+
+    Args:
+        log_file (str): The JSON-lines log file. Overwritten on each run.
+        show_thread (bool): Add the thread name (the space ID in a multi-space sweep) to each console line.
+        audit_file (str): The per-object audit file. Overwritten on each run. Without it the audit records are dropped.
+    """
+    def __init__(self, log_file, show_thread=False, audit_file=None):
+        self.queue = queue.Queue()
+        console_format = "%(asctime)s - %(levelname)s - %(message)s"
+        if show_thread:
+            console_format = "%(asctime)s - %(levelname)s - [%(threadName)s] - %(message)s"
+
+        file_handler = logging.FileHandler(log_file, mode="w")
+        file_handler.setFormatter(JsonLinesFormatter())
+        file_handler.addFilter(is_not_audit)
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(logging.Formatter(console_format))
+        console_handler.addFilter(is_not_audit)
+        console_handler.addFilter(is_console)
+        self.handlers = [file_handler, console_handler]
+        if audit_file:
+            audit_handler = logging.FileHandler(audit_file, mode="w")
+            audit_handler.setFormatter(AuditFormatter())
+            audit_handler.addFilter(is_audit)
+            self.handlers.append(audit_handler)
+
+        self.queue_handler = DeferredFormatQueueHandler(self.queue)
+        self.listener = QueueListener(self.queue, *self.handlers)
+        self.audit_file = audit_file
+
+    def start(self):
+        root = logging.getLogger()
+        root.setLevel(logging.INFO)
+        root.addHandler(self.queue_handler)
+        audit_logger = logging.getLogger(AUDIT_LOGGER)
+        audit_logger.disabled = not self.audit_file
+        audit_logger.addHandler(self.queue_handler)
+        self.listener.start()
+
+    # Wait until every record logged so far is written
+    def flush(self):
+        self.queue.join()
+
+    # Write the records still on the queue and stop the background thread
+    def stop(self):
+        logging.getLogger().removeHandler(self.queue_handler)
+        audit_logger = logging.getLogger(AUDIT_LOGGER)
+        audit_logger.removeHandler(self.queue_handler)
+        audit_logger.disabled = True
+        self.listener.stop()
+        for handler in self.handlers:
+            handler.close()
+
+
+_pipeline = None
+
+
+# Configures logging of the run: JSON lines to log_file, per-object records to audit_file and a summary on the console
+def setup_logging(log_file="output.log", show_thread=False, audit_file=None):
+    global _pipeline
+    shutdown_logging()
+    _pipeline = LogPipeline(log_file, show_thread, audit_file)
+    _pipeline.start()
+    return _pipeline
+
+
+def flush_logging():
+    if _pipeline is not None:
+        _pipeline.flush()
+
+
+def shutdown_logging():
+    global _pipeline
+    if _pipeline is not None:
+        _pipeline.stop()
+        _pipeline = None
+
+
+# Records still on the queue are written before the process exits
+atexit.register(shutdown_logging)
+
+
+# Log a message that is shown on the console as well as written to the log file
+def console(message, level=logging.INFO):
+    logging.log(level, message, extra=CONSOLE)
+
+
+_audit_logger = logging.getLogger(AUDIT_LOGGER)
+_audit_logger.setLevel(logging.INFO)
+_audit_logger.propagate = False
+# Until an audit file is set up
+_audit_logger.disabled = True
+
+
+# Record what the run did to one object in the audit file
+def audit(action, space_id, object_type, object_id, status, **detail):
+    if _audit_logger.isEnabledFor(logging.INFO):
+        _audit_logger.info({"action": action, "space_id": space_id, "type": object_type, "id": object_id, "status": status,
+                            **detail})
@@ -0,0 +1,55 @@
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from json_stream import iter_json_array
+
+
+# A _find response with numbers (decimals, exponents, negatives), booleans and null at every level
+FIND_RESPONSE = json.dumps({
+    "took": 1.5,
+    "page": 1,
+    "per_page": 2,
+    "total": 2,
+    "saved_objects": [
+        {"type": "dashboard", "id": "d-1", "version": "WzEsMV0=", "score": 1e-3, "namespaces": ["default"],
+         "attributes": {"title": "Dashboard é", "timeRestore": False, "refreshInterval": {"pause": True, "value": -12.25}},
+         "references": [{"name": "panel_0", "type": "index-pattern", "id": "dv-1"}]},
+        {"type": "lens", "id": "l-1", "score": 2.5E+10, "updated_at": None, "attributes": {"title": "Lens"}, "references": []}
+    ],
+    "pit_id": None,
+    "max_score": 10
+}, ensure_ascii=False).encode("utf-8")
+
+
+class IterJsonArrayTest(unittest.TestCase):
+    def test_whole_body(self):
+        header = {}
+        objects = list(iter_json_array([FIND_RESPONSE], "saved_objects", header))
+        expected = json.loads(FIND_RESPONSE)
+        self.assertEqual(objects, expected.pop("saved_objects"))
+        self.assertEqual(header, expected)
+
+    # Every value must be decoded the same wherever the body is cut, e.g. in the middle of '1.5' or of a UTF-8 character
+    def test_split_at_every_position(self):
+        expected = json.loads(FIND_RESPONSE)
+        expected_objects = expected.pop("saved_objects")
+        for split in range(1, len(FIND_RESPONSE)):
+            with self.subTest(split=split):
+                header = {}
+                chunks = [FIND_RESPONSE[:split], FIND_RESPONSE[split:]]
+                self.assertEqual(list(iter_json_array(chunks, "saved_objects", header)), expected_objects)
+                self.assertEqual(header, expected)
+
+    def test_number_cut_after_the_decimal_point(self):
+        header = {}
+        objects = list(iter_json_array([b'{"took":1.', b'5,"saved_objects":[]}'], "saved_objects", header))
+        self.assertEqual(objects, [])
+        self.assertEqual(header, {"took": 1.5})
+
+
+if __name__ == "__main__":
+    unittest.main()